@@ -0,0 +1,118 @@
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from allocation.domain import model
+
+
+def snapshot(product: model.Product) -> Tuple[int, bytes]:
+    # taken after a flush, so version_number is the one in the database
+    return (
+        product.version_number,
+        pickle.dumps(product, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+
+
+class AggregateCache:
+    # Products as they were last committed by this process, kept as
+    # pickled snapshots so every get returns a fresh copy no other session
+    # shares. An entry is only used if its version_number is still the one
+    # in the database, see repository.CachedSQLAlchemyRepository.
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[int, bytes]]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, sku: str, version_number: int) -> Optional[model.Product]:
+        with self._lock:
+            entry = self._entries.get(sku)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != version_number:
+                self.stale += 1
+                del self._entries[sku]
+                return None
+            self.hits += 1
+            self._entries.move_to_end(sku)
+        return pickle.loads(entry[1])
+
+    def put(self, sku: str, version_number: int, data: bytes):
+        with self._lock:
+            entry = self._entries.get(sku)
+            # commits can be published out of order, keep the newest
+            if entry is not None and entry[0] > version_number:
+                return
+            self._entries[sku] = (version_number, data)
+            self._entries.move_to_end(sku)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, sku: str):
+        with self._lock:
+            self._entries.pop(sku, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                stale=self.stale,
+                evictions=self.evictions,
+            )
+
+
+class BatchrefCache:
+    # Which product each batch belongs to. Batches never move between
+    # products, so entries don't go stale; the repository still checks the
+    # product it loads has the batch, in case its creation was rolled back.
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._skus = OrderedDict()  # type: OrderedDict[str, str]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, batchref: str) -> Optional[str]:
+        with self._lock:
+            sku = self._skus.get(batchref)
+            if sku is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._skus.move_to_end(batchref)
+            return sku
+
+    def put(self, batchref: str, sku: str):
+        with self._lock:
+            self._skus[batchref] = sku
+            self._skus.move_to_end(batchref)
+            if len(self._skus) > self.max_size:
+                self._skus.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._skus),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+            )
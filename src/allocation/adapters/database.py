@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from allocation import config
+
+
+class PoolStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return dict(
+                checkouts=self.checkouts,
+                timeouts=self.timeouts,
+                avg_wait_ms=(
+                    self.total_wait / self.checkouts * 1000 if self.checkouts else 0
+                ),
+                max_wait_ms=self.max_wait * 1000,
+            )
+
+
+class TimedQueuePool(QueuePool):
+    # a QueuePool that records how long each checkout waited for a
+    # connection, to size pool_size and max_overflow from real numbers
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+_engines = {}  # type: Dict[str, Engine]
+_lock = threading.Lock()
+
+
+def get_engine(uri: Optional[str] = None) -> Engine:
+    uri = uri or config.get_database_uri()
+    with _lock:
+        if uri not in _engines:
+            _engines[uri] = _create_engine(uri, config.get_database_settings())
+        return _engines[uri]
+
+
+def pool_stats(engine: Engine) -> dict:
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    stats = dict(
+        pool_size=pool.size(),
+        checked_out=pool.checkedout(),
+        overflow=pool.overflow(),
+    )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(pool.stats.as_dict())
+    return stats
+
+
+def _create_engine(uri: str, settings: dict) -> Engine:
+    kwargs = {}  # type: dict
+    connect_args = {}  # type: dict
+    if uri.startswith("sqlite"):
+        # sqlite only offers its own isolation levels, and an in-memory
+        # database lives in a single connection, so it keeps sqlite's pool
+        if ":memory:" in uri or uri.rstrip("/") == "sqlite:":
+            return _guarded(enable_sqlite_savepoints(create_engine(uri)))
+        sqlite_settings = config.get_sqlite_settings()
+        connect_args["check_same_thread"] = False
+        connect_args["timeout"] = sqlite_settings["busy_timeout"]
+    else:
+        kwargs["isolation_level"] = settings["isolation_level"]
+    if uri.startswith("postgresql") and settings["statement_timeout_ms"]:
+        connect_args["options"] = (
+            f"-c statement_timeout={settings['statement_timeout_ms']}"
+        )
+    kwargs.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_timeout=settings["pool_timeout"],
+        pool_pre_ping=settings["pool_pre_ping"],
+        pool_recycle=settings["pool_recycle"],
+        connect_args=connect_args,
+    )
+    engine = create_engine(uri, **kwargs)
+    if uri.startswith("sqlite"):
+        tune_sqlite(engine, sqlite_settings)
+        enable_sqlite_savepoints(engine, begin=sqlite_settings["begin"])
+    return _guarded(engine)
+
+
+def tune_sqlite(engine: Engine, settings: dict) -> Engine:
+    # WAL lets readers carry on while a transaction writes, NORMAL only
+    # syncs at checkpoints in WAL mode, and mmap saves a copy per page read
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+        cursor.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+        cursor.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+        cursor.close()
+
+    return engine
+
+
+# execution options for a connection that only reads: on sqlite it begins
+# DEFERRED, so it doesn't take the write lock whatever the engine's default
+READ_ONLY = dict(sqlite_begin="DEFERRED")
+
+
+def enable_sqlite_savepoints(engine: Engine, begin: str = "DEFERRED") -> Engine:
+    # pysqlite starts transactions itself, and not in a way SAVEPOINT can
+    # nest in, so take that over and let SQLAlchemy emit BEGIN (the recipe
+    # from SQLAlchemy's pysqlite docs)
+
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def start_transaction(connection):
+        mode = connection.get_execution_options().get("sqlite_begin", begin)
+        connection.execute(f"BEGIN {mode}")
+
+    return engine
+
+
+def _guarded(engine: Engine) -> Engine:
+    # A forked worker must not reuse its parent's sockets. Connections are
+    # stamped with the pid that opened them, and any checked out in another
+    # process are dropped without being closed (closing would end the
+    # parent's session too), so the pool opens a fresh one instead.
+
+    @event.listens_for(engine, "connect")
+    def stamp_pid(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get("pid", pid) != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                f"Connection belongs to pid {connection_record.info['pid']},"
+                f" attempting to check out in pid {pid}"
+            )
+
+    return engine
+
+
+def _reset_pools_after_fork():
+    # replace each pool in the child without closing the inherited
+    # connections, which the parent is still using
+    for engine in _engines.values():
+        engine.pool = engine.pool.recreate()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
@@ -0,0 +1,115 @@
+import abc
+import json
+import threading
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Any, List, Optional, cast
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters.orm import dead_letters
+from allocation.domain import events
+
+
+@dataclass
+class DeadLetter:
+    event: events.Event
+    handler: str
+    error: str
+    attempts: int
+    failed_at: datetime = field(default_factory=datetime.utcnow)
+    id: Optional[int] = None
+
+
+#############################
+#           PORT            #
+#############################
+class AbstractDeadLetterStore(abc.ABC):
+
+    @abc.abstractmethod
+    def add(self, letter: DeadLetter):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list(self) -> List[DeadLetter]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, letter: DeadLetter):
+        raise NotImplementedError
+
+
+#############################
+#         ADAPTERS          #
+#############################
+class InMemoryDeadLetterStore(AbstractDeadLetterStore):
+
+    def __init__(self):
+        self._letters = []  # type: List[DeadLetter]
+        self._lock = threading.Lock()
+
+    def add(self, letter: DeadLetter):
+        with self._lock:
+            self._letters.append(letter)
+
+    def list(self) -> List[DeadLetter]:
+        with self._lock:
+            return list(self._letters)
+
+    def remove(self, letter: DeadLetter):
+        with self._lock:
+            self._letters.remove(letter)
+
+
+class SqlAlchemyDeadLetterStore(AbstractDeadLetterStore):
+
+    def __init__(self, session_factory: sessionmaker):
+        self.session_factory = session_factory
+
+    def add(self, letter: DeadLetter):
+        session = self.session_factory()
+        try:
+            session.execute(dead_letters.insert(), dict(
+                event_type=type(letter.event).__name__,
+                payload=json.dumps(asdict(cast(Any, letter.event))),
+                handler=letter.handler,
+                error=letter.error,
+                attempts=letter.attempts,
+                failed_at=letter.failed_at,
+            ))
+            session.commit()
+        finally:
+            session.close()
+
+    def list(self) -> List[DeadLetter]:
+        session = self.session_factory()
+        try:
+            rows = session.execute(
+                select([dead_letters]).order_by(dead_letters.c.id)
+            )
+            return [
+                DeadLetter(
+                    event=getattr(events, row.event_type)(
+                        **json.loads(row.payload)
+                    ),
+                    handler=row.handler,
+                    error=row.error,
+                    attempts=row.attempts,
+                    failed_at=row.failed_at,
+                    id=row.id,
+                )
+                for row in rows
+            ]
+        finally:
+            session.close()
+
+    def remove(self, letter: DeadLetter):
+        session = self.session_factory()
+        try:
+            session.execute(
+                dead_letters.delete().where(dead_letters.c.id == letter.id)
+            )
+            session.commit()
+        finally:
+            session.close()
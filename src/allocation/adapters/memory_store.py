@@ -0,0 +1,187 @@
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+from allocation.domain import model
+
+logger = logging.getLogger(__name__)
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class InMemoryStore:
+    # Committed products, indexed by sku and by the ref of each of their
+    # batches, with a lock per sku that InMemorySession holds while a
+    # product is checked out.
+
+    def __init__(self, products: Iterable[model.Product] = ()):
+        self._products = {}  # type: Dict[str, model.Product]
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._locks = {}  # type: Dict[str, threading.Lock]
+        self._lock = threading.Lock()
+        for product in products:
+            self.put(product)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def lock_for(self, sku: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(sku, threading.Lock())
+
+    def get(self, sku: str) -> Optional[model.Product]:
+        return self._products.get(sku)
+
+    def sku_for(self, batchref: str) -> Optional[str]:
+        return self._skus_by_batchref.get(batchref)
+
+    def skus(self) -> List[str]:
+        with self._lock:
+            return sorted(self._products)
+
+    def put(self, product: model.Product):
+        with self._lock:
+            self._products[product.sku] = product
+            for batch in product.batches:
+                self._skus_by_batchref[batch.ref] = product.sku
+
+    def save(self, path: str, lock_timeout: float = 10.0) -> int:
+        # each product is copied under its lock, so what is written is
+        # what was last committed, never a change in progress
+        snapshots = []
+        for sku in self.skus():
+            lock = self.lock_for(sku)
+            if not lock.acquire(timeout=lock_timeout):
+                raise LockTimeout(f"Timed out waiting for product {sku}")
+            try:
+                snapshots.append(pickle.dumps(
+                    self._products[sku], protocol=pickle.HIGHEST_PROTOCOL,
+                ))
+            finally:
+                lock.release()
+        # written next to the old file and swapped in, so a crash midway
+        # leaves the last complete snapshot
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            pickle.dump(snapshots, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, path)
+        return len(snapshots)
+
+    @classmethod
+    def load(cls, path: str) -> "InMemoryStore":
+        with open(path, "rb") as file:
+            snapshots = pickle.load(file)
+        return cls(pickle.loads(snapshot) for snapshot in snapshots)
+
+
+class InMemorySession:
+    # What a SQLAlchemy session is to the database. A product is checked
+    # out as a private copy, under its sku's lock, held until commit or
+    # rollback like a row lock. Commit puts another copy in the store, so
+    # nothing done to a checked out product reaches it otherwise.
+
+    def __init__(self, store: InMemoryStore, lock_timeout: float = 10.0):
+        self.store = store
+        self.lock_timeout = lock_timeout
+        self._checked_out = {}  # type: Dict[str, model.Product]
+        # every sku whose lock this session holds
+        self._locked = set()  # type: Set[str]
+
+    def get(self, sku: str) -> Optional[model.Product]:
+        if sku in self._checked_out:
+            return self._checked_out[sku]
+        # locked until commit or rollback even if there is no such product,
+        # so two sessions can't both find it missing and add it
+        self._acquire(sku)
+        committed = self.store.get(sku)
+        if committed is None:
+            return None
+        product = _copy(committed)
+        self._checked_out[sku] = product
+        return product
+
+    def add(self, product: model.Product):
+        if product.sku not in self._checked_out:
+            self._acquire(product.sku)
+            if self.store.get(product.sku) is not None:
+                raise ValueError(f"Product {product.sku} already exists")
+        self._checked_out[product.sku] = product
+
+    def sku_for(self, batchref: str) -> Optional[str]:
+        for sku, product in self._checked_out.items():
+            if product.get_batch(batchref) is not None:
+                return sku
+        return self.store.sku_for(batchref)
+
+    def skus(self) -> List[str]:
+        return sorted(set(self.store.skus()) | set(self._checked_out))
+
+    def commit(self):
+        for product in self._checked_out.values():
+            self.store.put(_copy(product))
+        self._end()
+
+    def rollback(self):
+        self._end()
+
+    def _end(self):
+        self._checked_out.clear()
+        while self._locked:
+            self.store.lock_for(self._locked.pop()).release()
+
+    def _acquire(self, sku: str):
+        if sku in self._locked:
+            return
+        if not self.store.lock_for(sku).acquire(timeout=self.lock_timeout):
+            raise LockTimeout(f"Timed out waiting for product {sku}")
+        self._locked.add(sku)
+
+
+def _copy(product: model.Product) -> model.Product:
+    copy = pickle.loads(pickle.dumps(product, protocol=pickle.HIGHEST_PROTOCOL))
+    # events belong to the unit of work that raised them
+    copy.events.clear()
+    return copy
+
+
+class SnapshotWriter:
+    # Saves the store to a file every `interval` seconds on its own thread,
+    # and once more when stopped.
+
+    def __init__(self, store: InMemoryStore, path: str, interval: float = 60.0):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def save(self) -> int:
+        saved = self.store.save(self.path)
+        logger.debug("saved %s products to %s", saved, self.path)
+        return saved
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="snapshot-writer", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.save()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.save()
+            except Exception:
+                logger.exception("failed to save snapshot to %s", self.path)
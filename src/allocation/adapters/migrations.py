@@ -0,0 +1,127 @@
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.engine import Connection, Engine
+
+from allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+# the tables create_all made before there were migrations; databases from
+# back then may be missing any that came after their first create_all
+INITIAL_TABLES = [
+    "products",
+    "batches",
+    "order_lines",
+    "allocations",
+    "allocations_view",
+    "outbox",
+    "dead_letters",
+]
+
+LOOKUP_INDEXES = [
+    "ix_batches_ref",
+    "ix_batches_sku",
+    "ix_order_lines_orderid",
+    "ix_allocations_batch_id",
+    "ix_allocations_order_line_id",
+    "ix_allocations_view_orderid_sku",
+]
+
+
+def _initial_schema(connection: Connection):
+    for name in INITIAL_TABLES:
+        orm.metadata.tables[name].create(connection, checkfirst=True)
+
+
+def _lookup_indexes(connection: Connection):
+    # CREATE UNIQUE INDEX rather than ALTER TABLE ... ADD CONSTRAINT,
+    # which sqlite doesn't have; fails if existing rows break uniqueness
+    _create_indexes(connection, LOOKUP_INDEXES)
+
+
+# Version 1 is the schema as it was before migrations, which databases
+# created back then are taken to have. Append only, never edit one that
+# has been released.
+MIGRATIONS = [
+    Migration(1, "initial schema", _initial_schema),
+    Migration(2, "indexes for lookups by batchref, sku and orderid",
+              _lookup_indexes),
+]  # type: List[Migration]
+HEAD = MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> Optional[int]:
+    if not _has_table(connection, orm.schema_version.name):
+        return None
+    return connection.execute(
+        select([func.max(orm.schema_version.c.version)])
+    ).scalar()
+
+
+def upgrade(engine: Engine, target: int = HEAD) -> List[int]:
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # one upgrade at a time, whichever process starts it
+            connection.execute("SELECT pg_advisory_xact_lock(4242)")
+        version = current_version(connection)
+        if version is None and not _has_table(connection, orm.products.name):
+            # a new database gets the latest schema straight away
+            orm.metadata.create_all(connection)
+            _record(connection, MIGRATIONS)
+            logger.info("created schema at version %s", HEAD)
+            return [migration.version for migration in MIGRATIONS]
+        orm.schema_version.create(connection, checkfirst=True)
+        version = version or 0
+        for migration in MIGRATIONS:
+            if version < migration.version <= target:
+                logger.info("migrating to version %s: %s",
+                            migration.version, migration.description)
+                migration.upgrade(connection)
+                _record(connection, [migration])
+                applied.append(migration.version)
+    return applied
+
+
+def _has_table(connection: Connection, name: str) -> bool:
+    return connection.dialect.has_table(connection, name)
+
+
+def _record(connection: Connection, migrations: List[Migration]):
+    connection.execute(orm.schema_version.insert(), [
+        dict(
+            version=migration.version,
+            description=migration.description,
+            applied_at=datetime.utcnow(),
+        )
+        for migration in migrations
+    ])
+
+
+def _create_indexes(connection: Connection, names: List[str]):
+    indexes = {
+        index.name: index
+        for table in orm.metadata.tables.values()
+        for index in table.indexes
+    }
+    for name in names:
+        index = indexes[name]
+        existing = {
+            found["name"] for found in inspect(connection).get_indexes(
+                index.table.name
+            )
+        }
+        if name not in existing:
+            index.create(connection)
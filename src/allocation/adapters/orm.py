@@ -1,27 +1,44 @@
+import sys
+from collections import deque
+
 from sqlalchemy import (
     Column,
     Date,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     MetaData,
     Table,
     String,
+    Text,
+    TypeDecorator,
     event,
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm import joinedload, mapper, relationship, selectinload
 
 from allocation.domain.model import Batch, Orderline, Product
 
 
 metadata = MetaData()
 
+
+class InternedString(TypeDecorator):
+    # for columns repeated on every row of a big aggregate, such as the sku
+    # of each order line: all loaded rows then share one str object
+    impl = String
+
+    def process_result_value(self, value, dialect):
+        return sys.intern(value) if value is not None else None
+
+
 order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255)),
+    Column("sku", InternedString(255)),
     Column("qty", Integer, nullable=False),
-    Column("orderid", String(255)),
+    Column("orderid", String(255), index=True),
 )
 
 products = Table(
@@ -35,8 +52,8 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("ref", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("ref", String(255), unique=True, index=True),
+    Column("sku", ForeignKey("products.sku"), index=True),
     Column("_purchased_qty", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
@@ -45,8 +62,9 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("batch_id", ForeignKey("batches.id")),
-    Column("order_line_id", ForeignKey("order_lines.id")),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
+    # a line is allocated to one batch at most
+    Column("order_line_id", ForeignKey("order_lines.id"), unique=True, index=True),
 )
 
 allocations_view = Table(
@@ -55,6 +73,38 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    # looked up by orderid, and deleted by orderid and sku
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("sent_at", DateTime, nullable=True, index=True),
+)
+
+dead_letters = Table(
+    "dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("handler", String(255), nullable=False),
+    Column("error", Text, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("failed_at", DateTime, nullable=False),
+)
+
+# one row per migration applied, see adapters/migrations.py
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
 )
 
 def start_mappers():
@@ -74,8 +124,41 @@ def start_mappers():
         Product,
         products,
         properties={"batches": relationship(batches_mapper)},
+        # the domain sets the new version itself, and the UPDATE only
+        # applies if the row still has the version that was loaded
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
+
+def product_loader_options(strategy: str) -> list:
+    # how Product.batches and each Batch._allocations get loaded: "lazy" is
+    # a query per batch, "selectin" one extra query per relationship, and
+    # "joined" a single outer-joined query
+    if strategy == "lazy":
+        return []
+    if strategy == "selectin":
+        return [selectinload("batches").selectinload("_allocations")]
+    if strategy == "joined":
+        return [joinedload("batches").joinedload("_allocations")]
+    raise ValueError(f"Unknown loading strategy {strategy!r}")
+
+
 @event.listens_for(Product, "load")
 def receive_load(product, _):
-    product.events = []
+    product.events = deque()
+    product._reset_indexes()
+
+
+@event.listens_for(Product, "expire")
+def reset_indexes(product, _):
+    if product is not None:
+        product._reset_indexes()
+
+
+@event.listens_for(Batch, "load")
+@event.listens_for(Batch, "expire")
+def reset_allocated_quantity(batch, _):
+    # expire can fire for batches that were already garbage collected
+    if batch is not None:
+        batch._allocated_quantity = None
@@ -0,0 +1,61 @@
+import json
+from dataclasses import asdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple, Type, cast
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from allocation.adapters.orm import outbox
+from allocation.domain import events
+
+# events that leave the service, and the redis channel each one goes to
+CHANNELS = {
+    events.Allocated: "line_allocated",
+}  # type: Dict[Type[events.Event], str]
+
+
+def add(session: Session, pending: Iterable[events.Event]) -> int:
+    rows = [
+        dict(
+            channel=CHANNELS[type(event)],
+            payload=json.dumps(asdict(cast(Any, event))),
+        )
+        for event in pending
+        if type(event) in CHANNELS
+    ]
+    if rows:
+        session.execute(outbox.insert(), rows)
+    return len(rows)
+
+
+def unsent(session: Session, limit: int) -> List[Tuple[int, str, str]]:
+    # several relays can share the table: each one skips the rows another
+    # has locked (postgres; sqlite ignores FOR UPDATE and locks the database)
+    query = (
+        select([outbox.c.id, outbox.c.channel, outbox.c.payload])
+        .where(outbox.c.sent_at.is_(None))
+        .order_by(outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return [tuple(row) for row in session.execute(query)]
+
+
+def mark_sent(session: Session, ids: List[int]):
+    session.execute(
+        outbox.update()
+        .where(outbox.c.id.in_(ids))
+        .values(sent_at=datetime.utcnow())
+    )
+
+
+def prune(session: Session, sent_before: datetime, limit: int) -> int:
+    # a bounded delete, so pruning a backlog doesn't hold one long transaction
+    expired = (
+        select([outbox.c.id])
+        .where(outbox.c.sent_at < sent_before)
+        .order_by(outbox.c.id)
+        .limit(limit)
+    )
+    return session.execute(outbox.delete().where(outbox.c.id.in_(expired))).rowcount
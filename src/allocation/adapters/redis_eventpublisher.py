@@ -1,6 +1,7 @@
 import json
 import logging
 from dataclasses import asdict
+from typing import Iterable, Tuple
 
 import redis
 
@@ -15,3 +16,11 @@ r = redis.Redis(**config.get_redis_host_and_port())
 def publish(channel, event: events.Event):
     logger.debug("publishing: channel=%s, event=%s", channel, event)
     r.publish(channel, json.dumps(asdict(event)))
+
+
+def publish_many(messages: Iterable[Tuple[str, str]], client: redis.Redis = r):
+    # one round trip for the whole batch of already serialised messages
+    pipe = client.pipeline(transaction=False)
+    for channel, payload in messages:
+        pipe.publish(channel, payload)
+    pipe.execute()
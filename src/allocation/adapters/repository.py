@@ -1,7 +1,11 @@
 import abc
-from typing import List, Set
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy.orm.util import identity_key
 
 from allocation.adapters import orm
+from allocation.adapters.cache import AggregateCache, BatchrefCache
+from allocation.adapters.memory_store import InMemorySession
 from allocation.domain import model
 
 
@@ -17,13 +21,13 @@ class AbstractRepository(abc.ABC):
         self._add(product)
         self.seen.add(product)
 
-    def get(self, sku: str) -> model.Product:
+    def get(self, sku: str) -> Optional[model.Product]:
         product = self._get(sku)
         if product:
             self.seen.add(product)
         return product
 
-    def get_by_batchref(self, batchref: str) -> model.Product:
+    def get_by_batchref(self, batchref: str) -> Optional[model.Product]:
         product = self._get_by_batchref(batchref)
         if product:
             self.seen.add(product)
@@ -40,7 +44,7 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get(self, sku: str) -> model.Product:
+    def _get(self, sku: str) -> Optional[model.Product]:
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -48,7 +52,7 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get_by_batchref(self, batchref: str) -> model.Product:
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
         raise NotImplementedError
 
 
@@ -57,28 +61,117 @@ class AbstractRepository(abc.ABC):
 #############################
 class SQLAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+    # per method, see orm.product_loader_options; "joined" returns a row
+    # per allocation, so it only pays off for products with few of them
+    loading = dict(
+        get="selectin",
+        list="selectin",
+    )  # type: Dict[str, str]
+
+    def __init__(
+            self,
+            session,
+            loading: Optional[Dict[str, str]] = None,
+            lock: bool = True,
+            batchrefs: Optional[BatchrefCache] = None,
+    ):
         super().__init__()
         self.session = session
+        # without the row lock, concurrent changes to a product are caught
+        # by the version check when it is flushed (see orm.start_mappers)
+        self.lock = lock
+        self.batchrefs = batchrefs
+        if loading:
+            self.loading = {**self.loading, **loading}
 
     def _add(self, product: model.Product):
         self.session.add(product)
 
-    def _get(self, sku: str) -> model.Product:
-        return (
-            self.session.query(model.Product)
-                .filter_by(sku=sku)
-                .with_for_update()
-                .first()
+    def _get(self, sku: str) -> Optional[model.Product]:
+        query = self._query("get").filter_by(sku=sku)
+        if self.lock:
+            query = query.with_for_update(of=orm.products)
+        return query.first()
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        # resolve the sku (an index lookup, or no query at all), then load
+        # and lock the product the same way get does
+        if self.batchrefs is not None:
+            sku = self.batchrefs.get(batchref)
+            if sku is not None:
+                product = self._get(sku)
+                if product is not None and product.get_batch(batchref) is not None:
+                    return product
+        sku = (
+            self.session.query(orm.batches.c.sku)
+            .filter(orm.batches.c.ref == batchref)
+            .scalar()
         )
+        if sku is None:
+            return None
+        if self.batchrefs is not None:
+            self.batchrefs.put(batchref, sku)
+        return self._get(sku)
 
-    def _get_by_batchref(self, batchref: str) -> model.Product:
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
-            .filter(orm.batches.c.ref == batchref)
-            .first()
+    def _list(self) -> List[model.Product]:
+        return self._query("list").all()
+
+    def _query(self, method: str):
+        return self.session.query(model.Product).options(
+            *orm.product_loader_options(self.loading[method])
         )
 
+
+class CachedSQLAlchemyRepository(SQLAlchemyRepository):
+
+    def __init__(
+            self,
+            session,
+            cache: AggregateCache,
+            loading: Optional[Dict[str, str]] = None,
+            lock: bool = True,
+            batchrefs: Optional[BatchrefCache] = None,
+    ):
+        super().__init__(session, loading, lock, batchrefs)
+        self.cache = cache
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        # already in this session (a chained uow), which may hold changes
+        # the cache doesn't have yet
+        if identity_key(model.Product, (sku,)) in self.session.identity_map:
+            return super()._get(sku)
+        # a one-row check, taking the same lock the full load would
+        query = self.session.query(orm.products.c.version_number).filter(
+            orm.products.c.sku == sku
+        )
+        if self.lock:
+            query = query.with_for_update()
+        version_number = query.scalar()
+        if version_number is None:
+            return None
+        product = self.cache.get(sku, version_number)
+        if product is None:
+            return super()._get(sku)
+        return self.session.merge(product, load=False)
+
+
+class InMemoryRepository(AbstractRepository):
+
+    def __init__(self, session: InMemorySession):
+        super().__init__()
+        self.session = session
+
+    def _add(self, product: model.Product):
+        self.session.add(product)
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        return self.session.get(sku)
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        sku = self.session.sku_for(batchref)
+        return self.session.get(sku) if sku is not None else None
+
     def _list(self) -> List[model.Product]:
-        return self.session.query(model.Product).all()
+        # checked out in sku order, like any other session doing the same
+        products = [self.session.get(sku) for sku in self.session.skus()]
+        return [product for product in products if product is not None]
@@ -0,0 +1,113 @@
+import functools
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Type
+
+from allocation.adapters import orm
+from allocation.adapters.dead_letters import AbstractDeadLetterStore
+from allocation.domain import commands, events, model
+from allocation.service_layer import (
+    async_messagebus, background, handlers, messagebus, read_model, retries,
+    unit_of_work,
+)
+
+
+def bootstrap(
+        start_orm: bool = True,
+        event_handlers: Optional[Dict[Type[events.Event], List[Callable]]] = None,
+        command_handlers: Optional[Dict[Type[commands.Command], Callable]] = None,
+        background_pool: Optional[background.BackgroundWorkerPool] = None,
+        retry_scheduler: Optional[retries.RetryScheduler] = None,
+        dead_letters: Optional[AbstractDeadLetterStore] = None,
+        read_model_batcher: Optional[read_model.ReadModelBatcher] = None,
+        chain_sessions: bool = False,
+        deallocation_policy: Optional[model.DeallocationPolicy] = None,
+) -> messagebus.MessageBus:
+    if start_orm:
+        orm.start_mappers()
+    if event_handlers is None:
+        event_handlers = messagebus.EVENT_HANDLERS
+    if command_handlers is None:
+        command_handlers = messagebus.COMMAND_HANDLERS
+    if deallocation_policy is not None:
+        command_handlers = with_deallocation_policy(
+            command_handlers, deallocation_policy
+        )
+    flushers = []  # type: List[Callable]
+    if read_model_batcher is not None:
+        event_handlers = batch_read_model_handlers(
+            event_handlers, read_model_batcher
+        )
+        flushers.append(read_model_batcher.flush)
+    return messagebus.MessageBus(
+        event_handlers=event_handlers,
+        command_handlers=command_handlers,
+        background_pool=background_pool,
+        retry_scheduler=retry_scheduler,
+        dead_letters=dead_letters,
+        flushers=flushers,
+        chain_sessions=chain_sessions,
+    )
+
+
+def batch_read_model_handlers(
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        batcher: read_model.ReadModelBatcher,
+) -> Dict[Type[events.Event], List[Callable]]:
+    batched = {
+        handlers.add_allocation_to_read_model: batcher.add_allocation,
+        handlers.remove_allocation_from_read_model: batcher.remove_allocation,
+    }  # type: Dict[Callable, Callable]
+    return {
+        event_type: [batched.get(handler, handler) for handler in handler_list]
+        for event_type, handler_list in event_handlers.items()
+    }
+
+
+def with_deallocation_policy(
+        command_handlers: Dict[Type[commands.Command], Callable],
+        policy: model.DeallocationPolicy,
+) -> Dict[Type[commands.Command], Callable]:
+    return {
+        command_type: (
+            inject(handler, policy=policy)
+            if handler is handlers.change_batch_quantity else handler
+        )
+        for command_type, handler in command_handlers.items()
+    }
+
+
+def inject(handler: Callable, **dependencies) -> Callable:
+    # keeps the handler's name and retry policy, which the bus looks up
+    injected = functools.partial(handler, **dependencies)
+    return functools.update_wrapper(injected, handler)
+
+
+def async_bootstrap(
+        start_orm: bool = True,
+        uow_factory: async_messagebus.UnitOfWorkFactory = (
+            unit_of_work.SqlAlchemyUnitOfWork
+        ),
+        event_handlers: Optional[Dict[Type[events.Event], List[Callable]]] = None,
+        command_handlers: Optional[Dict[Type[commands.Command], Callable]] = None,
+        executor: Optional[Executor] = None,
+        dead_letters: Optional[AbstractDeadLetterStore] = None,
+        deallocation_policy: Optional[model.DeallocationPolicy] = None,
+) -> async_messagebus.AsyncMessageBus:
+    if start_orm:
+        orm.start_mappers()
+    if command_handlers is None:
+        command_handlers = messagebus.COMMAND_HANDLERS
+    if deallocation_policy is not None:
+        command_handlers = with_deallocation_policy(
+            command_handlers, deallocation_policy
+        )
+    return async_messagebus.AsyncMessageBus(
+        event_handlers=(
+            messagebus.EVENT_HANDLERS if event_handlers is None
+            else event_handlers
+        ),
+        command_handlers=command_handlers,
+        uow_factory=uow_factory,
+        executor=executor,
+        dead_letters=dead_letters,
+    )
@@ -9,6 +9,40 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_database_uri():
+    # postgres by default; DB_BACKEND=sqlite keeps everything in one local
+    # file, for single-node deployments
+    if os.environ.get("DB_BACKEND", "postgres") == "sqlite":
+        path = os.path.abspath(os.environ.get("SQLITE_PATH", "allocation.db"))
+        return f"sqlite:///{path}"
+    return get_postgres_uri()
+
+
+def get_sqlite_settings():
+    return dict(
+        journal_mode=os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        synchronous=os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        mmap_size=int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        busy_timeout=float(os.environ.get("SQLITE_BUSY_TIMEOUT", 10)),
+        # IMMEDIATE takes the write lock when a transaction starts, which
+        # is what SELECT ... FOR UPDATE would have done; read-only units of
+        # work begin DEFERRED whatever this says
+        begin=os.environ.get("SQLITE_BEGIN", "IMMEDIATE"),
+    )
+
+
+def get_database_settings():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        statement_timeout_ms=int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0)),
+        isolation_level=os.environ.get("DB_ISOLATION_LEVEL", "REPEATABLE READ"),
+    )
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -19,3 +53,53 @@ def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 63791 if host == "localhost" else 6379
     return dict(host=host, port=port)
+
+
+def get_background_pool_settings():
+    return dict(
+        workers=int(os.environ.get("BACKGROUND_WORKERS", 4)),
+        queue_size=int(os.environ.get("BACKGROUND_QUEUE_SIZE", 1000)),
+        overflow=os.environ.get("BACKGROUND_OVERFLOW", "drop_newest"),
+    )
+
+
+def get_outbox_relay_settings():
+    return dict(
+        batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 100)),
+        poll_interval=float(os.environ.get("OUTBOX_POLL_INTERVAL", 0.1)),
+        # sent rows are deleted once they are this many seconds old
+        retention=float(os.environ.get("OUTBOX_RETENTION", 7 * 24 * 3600)),
+        prune_interval=float(os.environ.get("OUTBOX_PRUNE_INTERVAL", 60)),
+    )
+
+
+def get_read_model_batch_settings():
+    return dict(
+        max_count=int(os.environ.get("READ_MODEL_BATCH_SIZE", 500)),
+        max_age=float(os.environ.get("READ_MODEL_BATCH_MAX_AGE", 0.5)),
+    )
+
+
+def get_aggregate_cache_settings():
+    return dict(
+        max_size=int(os.environ.get("AGGREGATE_CACHE_SIZE", 1024)),
+    )
+
+
+def get_batchref_cache_settings():
+    return dict(
+        max_size=int(os.environ.get("BATCHREF_CACHE_SIZE", 10000)),
+    )
+
+
+def get_deallocation_policy():
+    # which lines a shrinking batch gives up, see model.DEALLOCATION_POLICIES
+    return os.environ.get("DEALLOCATION_POLICY", "fewest_lines")
+
+
+def get_concurrency_settings():
+    # "optimistic" checks products.version_number on commit instead of
+    # locking the product's row for the whole transaction
+    return dict(
+        optimistic=os.environ.get("CONCURRENCY_MODE", "pessimistic") == "optimistic",
+    )
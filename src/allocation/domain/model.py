@@ -1,7 +1,13 @@
 from __future__ import annotations
+import abc
+import bisect
+import sys
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set, Union
+from typing import (
+    Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union,
+)
 
 from allocation.domain import events, commands
 
@@ -11,38 +17,202 @@ class OutOfStock(Exception): ...
 
 class Product:
 
-    def __init__(self, sku: str, batches: List[Batch], version_number: int=0):
+    # "python", "numpy", or None to choose by number of batches
+    allocation_engine = None  # type: Optional[str]
+
+    def __init__(
+            self,
+            sku: str,
+            batches: List[Batch],
+            version_number: int=0,
+            allocation_engine: Optional[str]=None,
+    ):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
-        self.events = []  # type: List[Union[events.Event, commands.Command]]
+        self.allocation_engine = allocation_engine
+        self.events = deque()  # type: Deque[Union[events.Event, commands.Command]]
+        self._reset_indexes()
 
-    def allocate(self, line: Orderline) -> str:
-        try:
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
+    def allocate(self, line: Orderline) -> Optional[str]:
+        [batchref] = self._allocate([line])
+        if batchref is not None:
+            self.version_number += 1
+        return batchref
+
+    def allocate_many(self, lines: List[Orderline]) -> List[Optional[str]]:
+        batchrefs = self._allocate(lines)
+        if any(batchref is not None for batchref in batchrefs):
             self.version_number += 1
+        return batchrefs
+
+    def _allocate(self, lines: List[Orderline]) -> List[Optional[str]]:
+        queue = self._build_indexes()
+        batchrefs = []  # type: List[Optional[str]]
+        for line, batch in zip(lines, queue.allocate(lines)):
+            if batch is None:
+                self.events.append(events.OutOfStock(line.sku))
+                batchrefs.append(None)
+                continue
+            self._allocations_by_orderid[line.orderid] = (batch, line)
             self.events.append(events.Allocated(
                 orderid=line.orderid,
                 sku=line.sku,
                 qty=line.qty,
                 batchref=batch.ref,
             ))
-            return batch.ref
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
-            return None
+            batchrefs.append(batch.ref)
+        return batchrefs
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        self.version_number += 1
+        if self._batch_queue is not None:
+            self._batch_queue.add(batch)
+            self._batches_by_ref[batch.ref] = batch
+
+    def get_batch(self, ref: str) -> Optional[Batch]:
+        self._build_indexes()
+        return self._batches_by_ref.get(ref)
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.ref == ref)
+    def get_allocation(self, orderid: str) -> Optional[Tuple[Batch, Orderline]]:
+        self._build_indexes()
+        return self._allocations_by_orderid.get(orderid)
+
+    def change_batch_quantity(
+            self,
+            ref: str,
+            qty: int,
+            policy: Optional[DeallocationPolicy] = None,
+    ):
+        queue = self._build_indexes()
+        batch = self._batches_by_ref[ref]
         batch._purchased_qty = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(
+        self.version_number += 1
+        excess = -batch.available_quantity
+        if excess > 0:
+            policy = policy or fewest_lines
+            deallocated = []  # type: List[Orderline]
+            for line in policy(batch._allocations, excess):
+                batch.deallocate(line)
+                deallocated.append(line)
+            while batch.available_quantity < 0:
+                deallocated.append(batch.deallocate_one())
+            for line in deallocated:
+                if self._allocations_by_orderid.get(line.orderid) == (batch, line):
+                    del self._allocations_by_orderid[line.orderid]
+            self.events.append(commands.AllocateMany([
                 commands.Allocate(line.orderid, line.sku, line.qty)
-            )
+                for line in deallocated
+            ]))
+        queue.update(batch)
+
+    def _reset_indexes(self):
+        self._batch_queue = None  # type: Optional[AbstractAllocationQueue]
+        self._batches_by_ref = {}  # type: Dict[str, Batch]
+        self._allocations_by_orderid = {}  # type: Dict[str, Tuple[Batch, Orderline]]
+
+    def _build_indexes(self) -> AbstractAllocationQueue:
+        # built lazily, so products loaded by the ORM pay for it only once
+        if self._batch_queue is not None:
+            return self._batch_queue
+        self._batch_queue = allocation_queue(
+            self.batches, self.allocation_engine,
+        )
+        self._batches_by_ref = {batch.ref: batch for batch in self.batches}
+        self._allocations_by_orderid = {
+            line.orderid: (batch, line)
+            for batch in self.batches
+            for line in batch._allocations
+        }
+        return self._batch_queue
+
+
+# Products with at least this many batches use the numpy engine, if
+# numpy is installed and the product doesn't name an engine itself
+NUMPY_ENGINE_THRESHOLD = 500
+
+
+def allocation_queue(
+        batches: List[Batch],
+        engine: Optional[str] = None,
+) -> AbstractAllocationQueue:
+    if engine is None:
+        engine = "python"
+        if len(batches) >= NUMPY_ENGINE_THRESHOLD:
+            try:
+                import numpy  # pylint: disable=unused-import
+                engine = "numpy"
+            except ImportError:
+                pass
+    if engine == "numpy":
+        from allocation.domain.numpy_engine import NumpyBatchQueue
+        return NumpyBatchQueue(batches)
+    if engine == "python":
+        return BatchQueue(batches)
+    raise ValueError(f"Unknown allocation engine {engine!r}")
+
+
+def allocation_key(batch: Batch, position: int) -> Tuple[bool, date, int]:
+    # warehouse stock (no ETA) first, then by ETA, ties broken by the order
+    # the batches were added in
+    return batch.eta is not None, batch.eta or date.min, position
+
+
+# An allocation queue picks a batch for each line, in allocation order,
+# and allocates the line to it. All engines make exactly the same choices.
+class AbstractAllocationQueue(abc.ABC):
+
+    @abc.abstractmethod
+    def add(self, batch: Batch):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, batch: Batch):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def allocate(self, lines: List[Orderline]) -> List[Optional[Batch]]:
+        raise NotImplementedError
+
+
+# Keeps only the batches with stock left, so full ones are never looked at
+class BatchQueue(AbstractAllocationQueue):
+
+    def __init__(self, batches: List[Batch]):
+        self._keys = {}  # type: Dict[str, Tuple[bool, date, int]]
+        self._queue = []  # type: List[Tuple[Tuple[bool, date, int], Batch]]
+        for batch in batches:
+            self.add(batch)
+
+    def __iter__(self):
+        return (batch for _, batch in self._queue)
+
+    def add(self, batch: Batch):
+        self._keys[batch.ref] = allocation_key(batch, len(self._keys))
+        self.update(batch)
+
+    def update(self, batch: Batch):
+        key = self._keys[batch.ref]
+        i = bisect.bisect_left(self._queue, (key,))
+        queued = i < len(self._queue) and self._queue[i][0] == key
+        if batch.available_quantity > 0 and not queued:
+            self._queue.insert(i, (key, batch))
+        elif batch.available_quantity <= 0 and queued:
+            del self._queue[i]
+
+    def allocate(self, lines: List[Orderline]) -> List[Optional[Batch]]:
+        allocated = []  # type: List[Optional[Batch]]
+        for line in lines:
+            batch = self.first_fit(line)
+            if batch is not None:
+                batch.allocate(line)
+                self.update(batch)
+            allocated.append(batch)
+        return allocated
+
+    def first_fit(self, line: Orderline) -> Optional[Batch]:
+        return next((b for b in self if b.can_allocate(line)), None)
 
 
 @dataclass(unsafe_hash=True)
@@ -51,6 +221,11 @@ class Orderline:
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # hot products hold thousands of lines, all with the same sku
+        if isinstance(self.sku, str):
+            self.sku = sys.intern(self.sku)
+
     def __repr__(self):
         return f"<({self.__class__.__name__}): {self.orderid}>"
 
@@ -69,6 +244,7 @@ class Batch:
         self.eta = eta
         self._purchased_qty = qty
         self._allocations = set()  # type: Set[Orderline]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<({self.__class__.__name__}): {self.ref}>"
@@ -77,7 +253,7 @@ class Batch:
         if self.eta is None:
             return False
         elif other.eta is None:
-            return False
+            return True
         return self.eta > other.eta
 
     def __eq__(self, other):
@@ -89,19 +265,29 @@ class Batch:
         return hash(self.ref)
 
     def allocate(self, line: Orderline):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line: Orderline):
         if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
 
     def deallocate_one(self) -> Orderline:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None means "not counted yet", e.g. right after an ORM load/expire
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(
+                line.qty for line in self._allocations
+            )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -109,3 +295,54 @@ class Batch:
 
     def can_allocate(self, line: Orderline) -> bool:
         return line.sku == self.sku and self.available_quantity >= line.qty
+
+
+# A deallocation policy picks which of a batch's lines to give up when it
+# shrinks: given the allocated lines and the quantity to free, it returns
+# lines adding up to at least that quantity.
+DeallocationPolicy = Callable[[Set[Orderline], int], List[Orderline]]
+
+
+def any_lines(lines: Iterable[Orderline], excess: int) -> List[Orderline]:
+    chosen = []
+    for line in lines:
+        if excess <= 0:
+            break
+        chosen.append(line)
+        excess -= line.qty
+    return chosen
+
+
+def fewest_lines(lines: Set[Orderline], excess: int) -> List[Orderline]:
+    return any_lines(
+        sorted(lines, key=lambda line: (-line.qty, line.orderid)), excess,
+    )
+
+
+def smallest_overshoot(lines: Set[Orderline], excess: int) -> List[Orderline]:
+    # best-fit decreasing: take the biggest lines that still fit in what is
+    # left to free, then close any gap with the smallest line that covers it
+    chosen, skipped = [], []
+    for line in sorted(lines, key=lambda line: (-line.qty, line.orderid)):
+        if line.qty <= excess:
+            chosen.append(line)
+            excess -= line.qty
+        else:
+            skipped.append(line)
+    if excess > 0 and skipped:
+        chosen.append(skipped[-1])
+    return chosen
+
+
+DEALLOCATION_POLICIES = {
+    "any_lines": any_lines,
+    "fewest_lines": fewest_lines,
+    "smallest_overshoot": smallest_overshoot,
+}  # type: Dict[str, DeallocationPolicy]
+
+
+def deallocation_policy(name: str) -> DeallocationPolicy:
+    try:
+        return DEALLOCATION_POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown deallocation policy {name!r}") from None
@@ -0,0 +1,87 @@
+from __future__ import annotations
+import bisect
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from allocation.domain.model import (
+    AbstractAllocationQueue,
+    Batch,
+    Orderline,
+    allocation_key,
+)
+
+
+# Keeps every batch's available quantity in an array sorted in allocation
+# order, so picking a batch is one vectorised scan instead of a Python loop
+# over Batch objects. Choices are made on the array first; the Batch
+# objects are then updated in one go at the end of each allocate() call.
+class NumpyBatchQueue(AbstractAllocationQueue):
+
+    def __init__(self, batches: List[Batch]):
+        keyed = sorted(
+            (allocation_key(batch, position), batch)
+            for position, batch in enumerate(batches)
+        )
+        self._keys = [key for key, _ in keyed]
+        self._batches = [batch for _, batch in keyed]
+        self._available = np.array(
+            [batch.available_quantity for batch in self._batches],
+            dtype=np.int64,
+        )
+        self._positions = {}  # type: Dict[str, int]
+        self._sku_masks = {}  # type: Dict[str, np.ndarray]
+        self._reindex()
+
+    def add(self, batch: Batch):
+        key = allocation_key(batch, len(self._keys))
+        i = bisect.bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._batches.insert(i, batch)
+        self._available = np.insert(
+            self._available, i, batch.available_quantity,
+        )
+        self._reindex()
+
+    def update(self, batch: Batch):
+        self._available[self._positions[batch.ref]] = batch.available_quantity
+
+    def allocate(self, lines: List[Orderline]) -> List[Optional[Batch]]:
+        if not self._available.size:
+            return [None] * len(lines)
+        chosen = []  # type: List[Optional[int]]
+        for line in lines:
+            # a batch with nothing left never takes a line, even of qty 0
+            fits = self._available >= max(line.qty, 1)
+            fits &= self._sku_mask(line.sku)
+            i = int(fits.argmax())
+            if not fits[i]:
+                chosen.append(None)
+                continue
+            self._available[i] -= line.qty
+            chosen.append(i)
+
+        allocated = []  # type: List[Optional[Batch]]
+        for line, position in zip(lines, chosen):
+            if position is None:
+                allocated.append(None)
+                continue
+            batch = self._batches[position]
+            batch.allocate(line)
+            allocated.append(batch)
+            self._available[position] = batch.available_quantity
+        return allocated
+
+    def _sku_mask(self, sku: str) -> np.ndarray:
+        if sku not in self._sku_masks:
+            self._sku_masks[sku] = np.array(
+                [batch.sku == sku for batch in self._batches], dtype=bool,
+            )
+        return self._sku_masks[sku]
+
+    def _reindex(self):
+        self._positions = {
+            batch.ref: i for i, batch in enumerate(self._batches)
+        }
+        self._sku_masks = {}
@@ -0,0 +1,39 @@
+import argparse
+import logging
+import os
+
+from allocation.adapters import orm
+from allocation.service_layer import batch_import, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import batches from a CSV or JSON-lines stock file."
+    )
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=batch_import.FORMATS,
+                        help="taken from the file extension by default")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    file_format = args.format or os.path.splitext(args.path)[1].lstrip(".")
+    if file_format == "ndjson":
+        file_format = "jsonl"
+
+    orm.start_mappers()
+    with open(args.path, newline="", encoding="utf-8") as stream:
+        report = batch_import.import_batches(
+            batch_import.read_records(stream, file_format),
+            unit_of_work.SqlAlchemyUnitOfWork(),
+            chunk_size=args.chunk_size,
+        )
+    for line_no, reason in report.errors:
+        print(f"line {line_no}: {reason}")
+    print(f"imported {report.rows} batches ({report.products_created} new"
+          f" products) in {report.seconds:.2f}s,"
+          f" {report.rows_per_second:.0f} rows/s; skipped {report.skipped}")
+
+
+if __name__ == "__main__":
+    main()
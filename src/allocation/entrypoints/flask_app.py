@@ -1,20 +1,54 @@
+import atexit
+import io
+import json
 import logging
 from datetime import datetime
 
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Response, request, jsonify
 
-from allocation import config, views
-from allocation.domain import commands
-from allocation.adapters import orm
-from allocation.service_layer import handlers, unit_of_work, messagebus
+from allocation import bootstrap, config, views
+from allocation.adapters import database
+from allocation.adapters.cache import AggregateCache, BatchrefCache
+from allocation.adapters.dead_letters import SqlAlchemyDeadLetterStore
+from allocation.domain import commands, model
+from allocation.service_layer import (
+    background, batch_import, handlers, read_model, retries, unit_of_work,
+)
 
 _logger = logging.getLogger(__name__)
 
 
-orm.start_mappers()
-get_session = sessionmaker(bind=create_engine(config.get_postgres_uri()))
+aggregate_cache = AggregateCache(**config.get_aggregate_cache_settings())
+batchref_cache = BatchrefCache(**config.get_batchref_cache_settings())
+
+
+def new_uow():
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        aggregate_cache=aggregate_cache,
+        batchref_cache=batchref_cache,
+        **config.get_concurrency_settings(),
+    )
+
+
+background_pool = background.BackgroundWorkerPool(
+    **config.get_background_pool_settings()
+)
+atexit.register(background_pool.shutdown, timeout=10)
+retry_scheduler = retries.RetryScheduler(new_uow)
+retry_scheduler.start()
+atexit.register(retry_scheduler.stop, timeout=10)
+bus = bootstrap.bootstrap(
+    background_pool=background_pool,
+    retry_scheduler=retry_scheduler,
+    dead_letters=SqlAlchemyDeadLetterStore(unit_of_work.DEFAULT_SESSION_FACTORY),
+    read_model_batcher=read_model.ReadModelBatcher(
+        **config.get_read_model_batch_settings()
+    ),
+    chain_sessions=True,
+    deallocation_policy=model.deallocation_policy(
+        config.get_deallocation_policy()
+    ),
+)
 app = Flask(__name__)
 
 @app.route("/add_batch", methods=["POST"])
@@ -28,9 +62,25 @@ def add_batch():
         request.json["qty"],
         eta
     )
-    messagebus.handle(cmd, unit_of_work.SqlAlchemyUnitOfWork())
+    bus.handle(cmd, new_uow())
     return "OK", 201
 
+@app.route("/batches/import", methods=["POST"])
+def import_batches_endpoint():
+    file_format = "csv" if request.mimetype == "text/csv" else "jsonl"
+    # read as it arrives, the file may be large
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    report = batch_import.import_batches(
+        batch_import.read_records(stream, file_format), new_uow(),
+    )
+    return jsonify(
+        imported=report.rows,
+        skipped=report.skipped,
+        products_created=report.products_created,
+        rows_per_second=report.rows_per_second,
+        errors=[dict(line=line, reason=reason) for line, reason in report.errors],
+    ), 200
+
 @app.route("/allocate", methods=["POST"])
 def allocate():
     try:
@@ -39,15 +89,40 @@ def allocate():
             request.json["sku"],
             request.json["qty"],
         )
-        messagebus.handle(cmd, unit_of_work.SqlAlchemyUnitOfWork())
+        bus.handle(cmd, new_uow())
     except handlers.InvalidSku as e:
         return {"message": str(e)}, 400
     return "OK", 202
 
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(read_only=True)
     result = views.allocations(orderid, uow)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+@app.route("/batches", methods=["GET"])
+def batches_endpoint():
+    after = request.args.get("after", 0, type=int)
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(read_only=True)
+    rows, cursor = views.batches_page(uow, after=after, limit=limit)
+    return jsonify(batches=rows, next=cursor), 200
+
+@app.route("/batches.ndjson", methods=["GET"])
+def batches_ndjson_endpoint():
+    rows = views.stream_batches(unit_of_work.SqlAlchemyUnitOfWork(read_only=True))
+    return Response(
+        (json.dumps(row) + "\n" for row in rows),
+        mimetype="application/x-ndjson",
+    )
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(
+        database=database.pool_stats(database.get_engine()),
+        background=background_pool.stats(),
+        aggregate_cache=aggregate_cache.stats(),
+        batchref_cache=batchref_cache.stats(),
+    ), 200
@@ -0,0 +1,29 @@
+import argparse
+import logging
+
+from allocation.adapters import database, migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Upgrade the database schema in place."
+    )
+    parser.add_argument("--target", type=int, default=migrations.HEAD)
+    parser.add_argument("--show", action="store_true",
+                        help="only print the current version")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = database.get_engine()
+    if args.show:
+        with engine.connect() as connection:
+            print(migrations.current_version(connection))
+        return
+    applied = migrations.upgrade(engine, target=args.target)
+    with engine.connect() as connection:
+        version = migrations.current_version(connection)
+    print(f"applied {applied or 'nothing'}, now at version {version}")
+
+
+if __name__ == "__main__":
+    main()
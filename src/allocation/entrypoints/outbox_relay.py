@@ -0,0 +1,76 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import orm, outbox, redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+Publisher = Callable[[Iterable[Tuple[str, str]]], None]
+
+
+def relay(
+        session_factory: sessionmaker,
+        publish_many: Publisher = redis_eventpublisher.publish_many,
+        batch_size: int = 100,
+) -> int:
+    session = session_factory()
+    try:
+        rows = outbox.unsent(session, limit=batch_size)
+        if not rows:
+            return 0
+        publish_many([(channel, payload) for _, channel, payload in rows])
+        outbox.mark_sent(session, [row_id for row_id, _, _ in rows])
+        session.commit()
+        logger.debug("relayed %s outbox messages", len(rows))
+        return len(rows)
+    finally:
+        session.close()
+
+
+def prune(
+        session_factory: sessionmaker,
+        retention: timedelta,
+        batch_size: int = 1000,
+) -> int:
+    sent_before = datetime.utcnow() - retention
+    pruned = 0
+    while True:
+        session = session_factory()
+        try:
+            deleted = outbox.prune(session, sent_before, limit=batch_size)
+            session.commit()
+        finally:
+            session.close()
+        pruned += deleted
+        if deleted < batch_size:
+            logger.debug("pruned %s sent outbox messages", pruned)
+            return pruned
+
+
+def main(session_factory: sessionmaker = unit_of_work.DEFAULT_SESSION_FACTORY):
+    orm.start_mappers()
+    settings = config.get_outbox_relay_settings()
+    retention = timedelta(seconds=settings["retention"])
+    next_prune = time.monotonic()
+    while True:
+        try:
+            sent = relay(session_factory, batch_size=settings["batch_size"])
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + settings["prune_interval"]
+                prune(session_factory, retention)
+        except Exception:
+            logger.exception("outbox relay failed, will retry")
+            sent = 0
+        # a full batch means there is probably more waiting
+        if sent < settings["batch_size"]:
+            time.sleep(settings["poll_interval"])
+
+
+if __name__ == "__main__":
+    main()
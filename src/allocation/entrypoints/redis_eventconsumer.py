@@ -3,30 +3,58 @@ import logging
 
 import redis
 
-from allocation import config
-from allocation.adapters import orm
-from allocation.domain import commands
-from allocation.service_layer import messagebus, unit_of_work
+from allocation import bootstrap, config
+from allocation.adapters.cache import BatchrefCache
+from allocation.adapters.dead_letters import SqlAlchemyDeadLetterStore
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus, read_model, retries, unit_of_work
 
 logger = logging.getLogger(__name__)
 
 r = redis.Redis(**config.get_redis_host_and_port())
+# every message names its batch by ref
+batchref_cache = BatchrefCache(**config.get_batchref_cache_settings())
+
+
+def new_uow():
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        batchref_cache=batchref_cache,
+        **config.get_concurrency_settings(),
+    )
 
 
 def main():
-    orm.start_mappers()
+    retry_scheduler = retries.RetryScheduler(new_uow)
+    retry_scheduler.start()
+    bus = bootstrap.bootstrap(
+        retry_scheduler=retry_scheduler,
+        dead_letters=SqlAlchemyDeadLetterStore(
+            unit_of_work.DEFAULT_SESSION_FACTORY
+        ),
+        read_model_batcher=read_model.ReadModelBatcher(
+            **config.get_read_model_batch_settings()
+        ),
+        chain_sessions=True,
+        deallocation_policy=model.deallocation_policy(
+            config.get_deallocation_policy()
+        ),
+    )
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
 
     for m in pubsub.listen():
-        handle_change_batch_quantity(m)
+        # one message that can't be handled mustn't stop the consumer
+        try:
+            handle_change_batch_quantity(m, bus)
+        except Exception:
+            logger.exception("failed to handle %s", m)
 
 
-def handle_change_batch_quantity(m):
+def handle_change_batch_quantity(m, bus: messagebus.MessageBus):
     logger.debug("handling %s", m)
     data = json.loads(m["data"])
     cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    messagebus.handle(cmd, uow=unit_of_work.SqlAlchemyUnitOfWork())
+    bus.handle(cmd, uow=new_uow())
 
 if __name__ == "__main__":
     main()
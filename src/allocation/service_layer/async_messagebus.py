@@ -0,0 +1,163 @@
+import asyncio
+import functools
+import inspect
+import logging
+from collections import deque
+from concurrent.futures import Executor
+from typing import (
+    Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Type, cast,
+)
+
+from allocation.adapters.dead_letters import (
+    AbstractDeadLetterStore, DeadLetter, InMemoryDeadLetterStore,
+)
+from allocation.domain import commands, events
+from allocation.service_layer import retries, unit_of_work
+from allocation.service_layer.messagebus import Dispatcher, Message
+
+logger = logging.getLogger(__name__)
+AsyncHandler = Callable[..., Awaitable]
+UnitOfWorkFactory = Callable[[], unit_of_work.AbstractUnitOfWork]
+
+
+def threaded(handler: Callable, executor: Optional[Executor] = None) -> AsyncHandler:
+    if inspect.iscoroutinefunction(handler):
+        return handler
+
+    @functools.wraps(handler)
+    async def run_in_executor(message, uow):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(handler, message, uow=uow)
+        )
+
+    return run_in_executor
+
+
+class AsyncMessageBus:
+    # Commands are handled one at a time, in the order they were raised.
+    # All handlers of an event run concurrently, each with its own unit of
+    # work from uow_factory, and the next message waits for all of them.
+
+    def __init__(
+            self,
+            event_handlers: Dict[Type[events.Event], List[Callable]],
+            command_handlers: Dict[Type[commands.Command], Callable],
+            uow_factory: UnitOfWorkFactory,
+            executor: Optional[Executor] = None,
+            dead_letters: Optional[AbstractDeadLetterStore] = None,
+    ):
+        self.uow_factory = uow_factory
+        self.executor = executor
+        self.dead_letters = (
+            InMemoryDeadLetterStore() if dead_letters is None else dead_letters
+        )
+        self.dispatcher = Dispatcher(
+            event_handlers, command_handlers,
+            wrap=lambda handler: threaded(handler, executor),
+        )
+
+    async def handle(self, message: Message) -> List:
+        return await self._process(deque([message]))
+
+    async def replay_dead_letters(self) -> int:
+        replayed = 0
+        for letter in self.dead_letters.list():
+            _, message_handlers = self.dispatcher.handlers_for(letter.event)
+            handler = next((
+                h for h in message_handlers
+                if retries.handler_name(h) == letter.handler
+            ), None)
+            if handler is None:
+                logger.warning("no handler %s to replay %s",
+                               letter.handler, letter.event)
+                continue
+            # a replay that fails again is dead-lettered again
+            self.dead_letters.remove(letter)
+            raised = await self._run_event_handler(letter.event, handler)
+            await self._process(deque(raised))
+            replayed += 1
+        return replayed
+
+    async def handle_event(
+            self,
+            event: events.Event,
+            event_handlers: Tuple[AsyncHandler, ...],
+            queue: Deque[Message],
+    ):
+        raised = await asyncio.gather(*(
+            self._run_event_handler(event, handler)
+            for handler in event_handlers
+        ))
+        for new_messages in raised:
+            queue.extend(new_messages)
+
+    async def handle_command(
+            self,
+            command: commands.Command,
+            handler: AsyncHandler,
+            queue: Deque[Message],
+    ):
+        policy = retries.policy_for(handler, default=retries.NO_RETRY)
+        attempt = 1
+        while True:
+            logger.debug("handling command %s, attempt %s", command, attempt)
+            uow = self.uow_factory()
+            try:
+                result = await handler(command, uow=uow)
+                queue.extend(uow.collect_new_events())
+                return result
+            except Exception as error:
+                if not policy.should_retry(error, attempt):
+                    logger.exception("Exception handling command %s", command)
+                    raise
+                logger.info("retrying command %s after %r", command, error)
+                await asyncio.sleep(policy.delay(attempt))
+                attempt += 1
+
+    async def _process(self, queue: Deque[Message]) -> List:
+        results = []
+        while queue:
+            message = queue.popleft()
+            is_command, message_handlers = self.dispatcher.handlers_for(message)
+            if is_command:
+                [handler] = message_handlers
+                results.append(await self.handle_command(
+                    cast(commands.Command, message), handler, queue,
+                ))
+            else:
+                await self.handle_event(
+                    cast(events.Event, message), message_handlers, queue,
+                )
+        return results
+
+    async def _run_event_handler(
+            self,
+            event: events.Event,
+            handler: AsyncHandler,
+    ) -> List[Message]:
+        # backing off here only suspends this handler's task
+        policy = retries.policy_for(handler)
+        attempt = 1
+        while True:
+            uow = self.uow_factory()
+            try:
+                logger.debug("handling event %s with handler %s, attempt %s",
+                             event, handler, attempt)
+                await handler(event, uow=uow)
+                return list(uow.collect_new_events())
+            except Exception as error:
+                if not policy.should_retry(error, attempt):
+                    logger.error(
+                        "Failed to handle event %s with %s after %s attempts,"
+                        " giving up!", event, handler, attempt,
+                    )
+                    self.dead_letters.add(DeadLetter(
+                        event=event,
+                        handler=retries.handler_name(handler),
+                        error=repr(error),
+                        attempts=attempt,
+                    ))
+                    return []
+                await asyncio.sleep(policy.delay(attempt))
+                attempt += 1
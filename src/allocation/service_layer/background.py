@@ -0,0 +1,166 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+CALLER_RUNS = "caller_runs"
+OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, CALLER_RUNS)
+
+
+def fire_and_forget(handler: Callable) -> Callable:
+    # the bus hands these to its BackgroundWorkerPool, if it has one, instead
+    # of running them before handle() returns; they get no unit of work and
+    # cannot raise new messages
+    setattr(handler, "fire_and_forget", True)
+    return handler
+
+
+def is_fire_and_forget(handler: Callable) -> bool:
+    return getattr(handler, "fire_and_forget", False)
+
+
+class PoolClosed(Exception):
+    pass
+
+
+class BackgroundWorkerPool:
+
+    def __init__(
+            self,
+            workers: int = 4,
+            queue_size: int = 1000,
+            overflow: str = DROP_NEWEST,
+            block_timeout: Optional[float] = None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopping = threading.Event()
+        self._counters = dict(
+            submitted=0, completed=0, failed=0, rejected=0, ran_inline=0,
+        )  # type: Dict[str, int]
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f"background-{i}", daemon=True,
+            )
+            for i in range(workers)
+        ]  # type: List[threading.Thread]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, task: Callable[[], None]) -> bool:
+        if self._closed:
+            raise PoolClosed("Background worker pool has been shut down")
+        self._count("submitted")
+        if self.overflow == BLOCK:
+            try:
+                self._queue.put(task, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                return self._reject(task)
+        try:
+            self._queue.put_nowait(task)
+            return True
+        except queue.Full:
+            pass
+        if self.overflow == DROP_OLDEST:
+            with self._lock:
+                try:
+                    dropped = self._queue.get_nowait()
+                    self._queue.task_done()
+                    self._counters["rejected"] += 1
+                    logger.warning("background queue full, dropped %s", dropped)
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(task)
+                    return True
+                except queue.Full:
+                    return self._reject(task)
+        if self.overflow == CALLER_RUNS:
+            self._count("ran_inline")
+            self._run(task)
+            return True
+        return self._reject(task)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, queue_depth=self._queue.qsize())
+
+    def shutdown(self, drain: bool = True, timeout: Optional[float] = None) -> bool:
+        self._closed = True
+        if not drain:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._queue.task_done()
+                self._count("rejected")
+        # one deadline for draining and stopping, so shutdown never takes
+        # longer than timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        drained = self._wait_until_empty(deadline)
+        # workers stop after the task in hand; the None wakes any waiting
+        # on an empty queue, and a full queue has no one waiting
+        self._stopping.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(self._remaining(deadline))
+        return drained
+
+    def _wait_until_empty(self, deadline: Optional[float]) -> bool:
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = self._remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                self._run(task)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, task: Callable[[], None]):
+        try:
+            task()
+            self._count("completed")
+        except Exception:
+            logger.exception("background task %s failed", task)
+            self._count("failed")
+
+    def _reject(self, task: Callable[[], None]) -> bool:
+        self._count("rejected")
+        logger.warning("background queue full, rejected %s", task)
+        return False
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,200 @@
+import bisect
+import csv
+import itertools
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import bindparam, select
+
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# (line number, ref, sku, qty, eta)
+Row = Tuple[int, str, str, int, Optional[date]]
+FORMATS = ("csv", "jsonl")
+MAX_REPORTED_ERRORS = 100
+
+
+class InvalidRow(Exception):
+    pass
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    skipped: int = 0
+    products_created: int = 0
+    seconds: float = 0.0
+    # the first MAX_REPORTED_ERRORS, as (line number, reason)
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def read_records(stream: IO[str], file_format: str) -> Iterator[Tuple[int, dict]]:
+    # one record at a time, numbered by the line it starts on
+    if file_format == "csv":
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        while header is not None:
+            # line_num is where the last record ended, and a quoted field
+            # can run over several lines, so take it before reading
+            line_no = reader.line_num + 1
+            row = next(reader, None)
+            if row is None:
+                break
+            if row:
+                yield line_no, dict(zip(header, row))
+    elif file_format == "jsonl":
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = {"__error__": f"invalid JSON: {e}"}
+            yield line_no, record
+    else:
+        raise ValueError(f"Unknown import format {file_format!r}")
+
+
+def validate(line_no: int, record: dict) -> Row:
+    if not isinstance(record, dict):
+        raise InvalidRow("not an object")
+    if "__error__" in record:
+        raise InvalidRow(record["__error__"])
+    ref, sku = record.get("ref"), record.get("sku")
+    if not ref or not isinstance(ref, str):
+        raise InvalidRow("ref is missing")
+    if not sku or not isinstance(sku, str):
+        raise InvalidRow("sku is missing")
+    try:
+        # through str, so 2.5 and true are refused rather than truncated
+        qty = int(str(record.get("qty")))
+    except ValueError:
+        raise InvalidRow(f"qty {record.get('qty')!r} is not a whole number")
+    if qty <= 0:
+        raise InvalidRow(f"qty {qty} is not positive")
+    eta = record.get("eta") or None
+    if eta is not None:
+        try:
+            eta = date.fromisoformat(eta)
+        except (TypeError, ValueError):
+            raise InvalidRow(f"eta {eta!r} is not an ISO date")
+    return line_no, ref, sku, qty, eta
+
+
+def import_batches(
+        records: Iterable[Tuple[int, dict]],
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        chunk_size: int = 1000,
+) -> ImportReport:
+    # Bypasses the domain model: rows are validated and written a chunk at
+    # a time, one transaction per chunk, so the file is never held in
+    # memory and each product is locked once per chunk.
+    report = ImportReport()
+    start = time.perf_counter()
+    rows = _valid_rows(records, report)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        chunk = _unique_refs(chunk, report)
+        created, duplicates = _write_chunk(chunk, uow)
+        report.products_created += created
+        report.rows += len(chunk) - len(duplicates)
+        for line_no, ref, *_ in duplicates:
+            _skip(report, line_no, f"batch {ref} already exists")
+        logger.debug("imported %s batches", report.rows)
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def _valid_rows(records: Iterable[Tuple[int, dict]], report: ImportReport):
+    for line_no, record in records:
+        try:
+            yield validate(line_no, record)
+        except InvalidRow as e:
+            _skip(report, line_no, str(e))
+
+
+def _unique_refs(chunk: List[Row], report: ImportReport) -> List[Row]:
+    # a ref repeating one from an earlier chunk is already in the database
+    # by then, and _write_chunk skips it, so only this chunk's refs are kept
+    first_seen = {}  # type: Dict[str, int]
+    unique = []
+    for row in chunk:
+        line_no, ref = row[0], row[1]
+        if ref in first_seen:
+            _skip(report, line_no, f"ref {ref} repeats line {first_seen[ref]}")
+            continue
+        first_seen[ref] = line_no
+        unique.append(row)
+    return unique
+
+
+def _skip(report: ImportReport, line_no: int, reason: str):
+    # errors turn up out of order, as each chunk is validated before its
+    # batches are checked against the database
+    report.skipped += 1
+    bisect.insort(report.errors, (line_no, reason))
+    del report.errors[MAX_REPORTED_ERRORS:]
+
+
+def _write_chunk(
+        chunk: List[Row], uow: unit_of_work.SqlAlchemyUnitOfWork,
+) -> Tuple[int, List[Row]]:
+    # returns how many products were created, and the rows left out because
+    # their batch is already in the database
+    with uow:
+        existing_refs = {
+            ref for [ref] in uow.session.execute(
+                select([orm.batches.c.ref])
+                .where(orm.batches.c.ref.in_([row[1] for row in chunk]))
+            )
+        }
+        duplicates = [row for row in chunk if row[1] in existing_refs]
+        by_sku = {}  # type: Dict[str, List[Row]]
+        for row in sorted(chunk, key=lambda row: row[2]):
+            if row[1] not in existing_refs:
+                by_sku.setdefault(row[2], []).append(row)
+        if not by_sku:
+            return 0, duplicates
+        # lock in sku order, so concurrent imports can't deadlock
+        existing = {
+            sku for [sku] in uow.session.execute(
+                select([orm.products.c.sku])
+                .where(orm.products.c.sku.in_(list(by_sku)))
+                .order_by(orm.products.c.sku)
+                .with_for_update()
+            )
+        }
+        missing = [sku for sku in by_sku if sku not in existing]
+        if missing:
+            uow.session.execute(orm.products.insert(), [
+                dict(sku=sku, version_number=1) for sku in missing
+            ])
+        if existing:
+            # products changed without the domain model still need a new
+            # version, or cached and optimistic copies would miss it
+            uow.session.execute(
+                orm.products.update()
+                .where(orm.products.c.sku == bindparam("_sku"))
+                .values(version_number=orm.products.c.version_number + 1),
+                [dict(_sku=sku) for sku in sorted(existing)],
+            )
+        uow.session.execute(orm.batches.insert(), [
+            dict(ref=ref, sku=sku, _purchased_qty=qty, eta=eta)
+            for rows in by_sku.values()
+            for _, ref, sku, qty, eta in rows
+        ])
+        uow.commit()
+    return len(missing), duplicates
@@ -1,33 +1,64 @@
 from __future__ import annotations
 
+import logging
+import time
+from collections import defaultdict
 from dataclasses import asdict
-from typing import List, TYPE_CHECKING
+from typing import Dict, List, Optional, TYPE_CHECKING
 
-from allocation.adapters import email, redis_eventpublisher
+from sqlalchemy.exc import OperationalError
+
+from allocation.adapters import email
 from allocation.domain import model, events, commands
+from allocation.service_layer.background import fire_and_forget
+from allocation.service_layer.retries import RetryPolicy, retry_policy
+from allocation.service_layer.unit_of_work import ConcurrencyConflict
 
 
 if TYPE_CHECKING:
     from allocation.service_layer import unit_of_work
 
+logger = logging.getLogger(__name__)
+
+
 class InvalidSku(Exception):
     pass
 
 
-def get_batches(repo) -> List[dict]:
-    return [dict(ref=batch.ref, sku=batch.sku, qty=batch._purchased_qty)
-            for product in repo.list()
-            for batch in product.batches]
+class InvalidBatchref(Exception):
+    pass
+
 
+CONFLICT_RETRIES = RetryPolicy(
+    attempts=5,
+    backoff=0.01,
+    max_backoff=0.2,
+    jitter=1.0,
+    retry_on=(ConcurrencyConflict,),
+)
+# commands that change a single product are simply run again when an
+# optimistic unit of work loses a race for it
+retry_on_conflict = retry_policy(CONFLICT_RETRIES)
 
-def exists_orderid_in_batch(orderid: str, batch: model.Batch) -> bool:
-    return orderid in {line.orderid for line in batch._allocations}
 
+def exists_orderid_in_batch(
+        orderid: str,
+        batch: model.Batch,
+        product: model.Product,
+) -> bool:
+    allocation = product.get_allocation(orderid)
+    return allocation is not None and allocation[0] == batch
 
-def get_order_line_by_orderid(orderid: str, batch) -> model.Orderline:
-    return next(line for line in batch._allocations if line.orderid == orderid)
 
+def get_order_line_by_orderid(
+        orderid: str,
+        product: model.Product,
+) -> Optional[model.Orderline]:
+    allocation = product.get_allocation(orderid)
+    return allocation[1] if allocation else None
 
+
+@retry_on_conflict
 def add_batch(
         cmd: commands.CreateBatch,
         uow: unit_of_work.AbstractUnitOfWork,
@@ -37,7 +68,7 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product=product)
-        product.batches.append(model.Batch(
+        product.add_batch(model.Batch(
             cmd.ref,
             cmd.sku,
             cmd.qty,
@@ -46,6 +77,7 @@ def add_batch(
         uow.commit()
 
 
+@retry_on_conflict
 def allocate(
         cmd: commands.Allocate,
         uow: unit_of_work.AbstractUnitOfWork,
@@ -59,26 +91,86 @@ def allocate(
         uow.commit()
 
 
+def allocate_many(
+        cmd: commands.AllocateMany,
+        uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    positions_by_sku = defaultdict(list)  # type: Dict[str, List[int]]
+    for position, line in enumerate(cmd.lines):
+        positions_by_sku[line.sku].append(position)
+    batchrefs = [None] * len(cmd.lines)  # type: List[Optional[str]]
+    with uow:
+        # every sku is checked before anything is committed, in sku order
+        # like anything else that locks several products
+        for sku in sorted(positions_by_sku):
+            if uow.products.get(sku=sku) is None:
+                raise InvalidSku(f"Invalid sku {sku}!")
+        # one transaction per sku, so each product is locked only once; a
+        # conflict only runs that sku's again, the ones before it are
+        # committed
+        for sku, positions in positions_by_sku.items():
+            requested = [cmd.lines[position] for position in positions]
+            attempt = 1
+            while True:
+                try:
+                    allocated = _allocate_lines(sku, requested, uow)
+                    break
+                except ConcurrencyConflict as error:
+                    uow.rollback()
+                    if not CONFLICT_RETRIES.should_retry(error, attempt):
+                        raise
+                    logger.info("retrying sku %s after %r", sku, error)
+                    time.sleep(CONFLICT_RETRIES.delay(attempt))
+                    attempt += 1
+            for position, batchref in zip(positions, allocated):
+                batchrefs[position] = batchref
+    return batchrefs
+
+
+def _allocate_lines(
+        sku: str,
+        requested: List[commands.Allocate],
+        uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    product = uow.products.get(sku=sku)
+    if product is None:
+        raise InvalidSku(f"Invalid sku {sku}!")
+    allocated = product.allocate_many([
+        model.Orderline(line.orderid, line.sku, line.qty) for line in requested
+    ])
+    uow.commit()
+    return allocated
+
+
 def reallocate(
         event: events.Deallocated,
         uow: unit_of_work.AbstractUnitOfWork,
 ):
     with uow:
         product = uow.products.get(sku=event.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {event.sku}!")
         product.events.append(commands.Allocate(**asdict(event)))
         uow.commit()
 
 
+@retry_on_conflict
 def change_batch_quantity(
         cmd: commands.ChangeBatchQuantity,
         uow: unit_of_work.AbstractUnitOfWork,
+        policy: Optional[model.DeallocationPolicy] = None,
 ):
+    # policy is set per deployment, see bootstrap.with_deallocation_policy
     with uow:
         product = uow.products.get_by_batchref(batchref=cmd.ref)
-        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        if product is None:
+            raise InvalidBatchref(f"Invalid batch ref {cmd.ref}!")
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty, policy=policy)
         uow.commit()
 
 
+@fire_and_forget
+@retry_policy(attempts=5, backoff=2.0, retry_on=(OSError,))
 def send_out_of_stock_notification(
         event: events.OutOfStock,
         uow: unit_of_work.AbstractUnitOfWork,
@@ -89,13 +181,7 @@ def send_out_of_stock_notification(
     )
 
 
-def publish_allocated_event(
-        event: events.Allocated,
-        uow: unit_of_work.AbstractUnitOfWork,
-):
-    redis_eventpublisher.publish("line_allocated", event)
-
-
+@retry_policy(attempts=3, backoff=0.5, retry_on=(OperationalError,))
 def add_allocation_to_read_model(
        event: events.Allocated,
        uow: unit_of_work.SqlAlchemyUnitOfWork,
@@ -115,6 +201,7 @@ def add_allocation_to_read_model(
         uow.commit()
 
 
+@retry_policy(attempts=3, backoff=0.5, retry_on=(OperationalError,))
 def remove_allocation_from_read_model(
         event: events.Deallocated,
         uow: unit_of_work.SqlAlchemyUnitOfWork,
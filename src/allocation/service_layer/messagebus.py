@@ -1,75 +1,255 @@
+import contextlib
+import functools
 import logging
-from typing import Callable, Dict, List, Type, Union
-
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
+import time
+from collections import deque
+from typing import (
+    Callable, Deque, Dict, List, Optional, Sequence, Tuple, Type, Union, cast,
+)
 
+from allocation.adapters.dead_letters import (
+    AbstractDeadLetterStore, DeadLetter, InMemoryDeadLetterStore,
+)
 from allocation.domain import events, commands
-from allocation.service_layer import unit_of_work, handlers
+from allocation.service_layer import background, handlers, retries, unit_of_work
 
 logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]
+# is the message a command?, and the handlers to run for it
+Dispatch = Tuple[bool, Tuple[Callable, ...]]
 
 
-def handle(message: Message, uow: unit_of_work.AbstractUnitOfWork) -> List:
-    results = []
-    queue = [message]
-    while queue:
-        message = queue.pop(0)
-        if isinstance(message, events.Event):
-            handle_event(message, queue, uow)
-        elif isinstance(message, commands.Command):
-            command_result = handle_command(message, queue, uow)
-            results.append(command_result)
+class Dispatcher:
+    # Which handlers each message type gets, resolved through its MRO, so
+    # subclasses of a message get their parents' handlers too, and cached.
+    # Every resolved handler is passed through wrap first.
+
+    def __init__(
+            self,
+            event_handlers: Dict[Type[events.Event], List[Callable]],
+            command_handlers: Dict[Type[commands.Command], Callable],
+            wrap: Callable[[Callable], Callable] = lambda handler: handler,
+    ):
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.wrap = wrap
+        self._dispatch = {}  # type: Dict[type, Dispatch]
+        for message_type in [*event_handlers, *command_handlers]:
+            self._resolve(message_type)
+
+    def handlers_for(self, message: Message) -> Dispatch:
+        try:
+            return self._dispatch[type(message)]
+        except KeyError:
+            return self._resolve(type(message))
+
+    def _resolve(self, message_type: type) -> Dispatch:
+        if issubclass(message_type, commands.Command):
+            handler = self._command_handler_for(message_type)
+            if handler is None:
+                raise Exception(f"No handler for command {message_type}!")
+            found = (handler,)  # type: Tuple[Callable, ...]
+            is_command = True
+        elif issubclass(message_type, events.Event):
+            found = self._event_handlers_for(message_type)
+            is_command = False
         else:
-            raise Exception(f"{message} was not an Event or Command!")
-    return results
+            raise Exception(f"{message_type} was not an Event or Command!")
+        resolved = (is_command, tuple(self.wrap(handler) for handler in found))
+        self._dispatch[message_type] = resolved
+        return resolved
+
+    def _command_handler_for(self, command_type: type) -> Optional[Callable]:
+        for cls in command_type.__mro__:
+            if cls in self.command_handlers:
+                return self.command_handlers[cls]
+        return None
+
+    def _event_handlers_for(self, event_type: type) -> Tuple[Callable, ...]:
+        resolved = []  # type: List[Callable]
+        for cls in event_type.__mro__:
+            for handler in self.event_handlers.get(cls, []):
+                if handler not in resolved:
+                    resolved.append(handler)
+        return tuple(resolved)
+
+
+class MessageBus:
+
+    def __init__(
+            self,
+            event_handlers: Dict[Type[events.Event], List[Callable]],
+            command_handlers: Dict[Type[commands.Command], Callable],
+            background_pool: Optional[background.BackgroundWorkerPool] = None,
+            retry_scheduler: Optional[retries.RetryScheduler] = None,
+            dead_letters: Optional[AbstractDeadLetterStore] = None,
+            flushers: Sequence[Callable] = (),
+            chain_sessions: bool = False,
+    ):
+        self.dispatcher = Dispatcher(event_handlers, command_handlers)
+        self.background_pool = background_pool
+        # without a scheduler, failed event handlers are dead-lettered at
+        # once, since there is nowhere to wait out their backoff
+        self.retry_scheduler = retry_scheduler
+        self.dead_letters = (
+            InMemoryDeadLetterStore() if dead_letters is None else dead_letters
+        )
+        # called with the unit of work once the queue is empty, to write out
+        # whatever handlers have been buffering
+        self.flushers = flushers
+        # share one session across everything a handle() call does; see
+        # SqlAlchemyUnitOfWork.chain
+        self.chain_sessions = chain_sessions
+
+    def handle(
+            self,
+            message: Message,
+            uow: unit_of_work.AbstractUnitOfWork,
+    ) -> List:
+        with self._chained(uow):
+            return self._process(deque([message]), uow)
 
+    def handle_event(
+            self,
+            event: events.Event,
+            event_handlers: Tuple[Callable, ...],
+            queue: Deque[Message],
+            uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        for handler in event_handlers:
+            if self.background_pool and background.is_fire_and_forget(handler):
+                # detached handlers get no unit of work and raise nothing
+                self.background_pool.submit(functools.partial(
+                    self._run_event_handler, event, handler, 1, None, None,
+                ))
+                continue
+            self._run_event_handler(event, handler, 1, uow, queue)
 
-def handle_event(
-        event: events.Event,
-        queue: List[Message],
-        uow: unit_of_work.AbstractUnitOfWork,
-):
-    for handler in EVENT_HANDLERS[type(event)]:
+    def replay_dead_letters(self, uow: unit_of_work.AbstractUnitOfWork) -> int:
+        replayed = 0
+        for letter in self.dead_letters.list():
+            _, message_handlers = self.dispatcher.handlers_for(letter.event)
+            handler = next((
+                h for h in message_handlers
+                if retries.handler_name(h) == letter.handler
+            ), None)
+            if handler is None:
+                logger.warning("no handler %s to replay %s",
+                               letter.handler, letter.event)
+                continue
+            self.dead_letters.remove(letter)
+            self._retry(letter.event, handler, 1, uow)
+            replayed += 1
+        return replayed
+
+    def _process(
+            self,
+            queue: Deque[Message],
+            uow: unit_of_work.AbstractUnitOfWork,
+    ) -> List:
+        results = []
+        try:
+            while queue:
+                message = queue.popleft()
+                is_command, message_handlers = self.dispatcher.handlers_for(
+                    message
+                )
+                if is_command:
+                    [handler] = message_handlers
+                    results.append(self.handle_command(
+                        cast(commands.Command, message), handler, queue, uow,
+                    ))
+                else:
+                    self.handle_event(
+                        cast(events.Event, message), message_handlers, queue, uow,
+                    )
+        finally:
+            for flush in self.flushers:
+                try:
+                    flush(uow)
+                except Exception:
+                    logger.exception("Exception in flusher %s", flush)
+        return results
+
+    def _run_event_handler(
+            self,
+            event: events.Event,
+            handler: Callable,
+            attempt: int,
+            uow: Optional[unit_of_work.AbstractUnitOfWork],
+            queue: Optional[Deque[Message]],
+    ):
+        policy = retries.policy_for(handler)
         try:
-            for attempt in Retrying(
-                stop=stop_after_attempt(3),
-                wait=wait_exponential(),
-            ):
-                with attempt:
-                    logger.debug("handling event %s with handler %s",
-                                 event, handler)
-                    handler(event, uow=uow)
-                    queue.extend(uow.collect_new_events())
-        except RetryError as retry_failure:
-            logger.error(
-                "Failed to handle event %s times, giving up!",
-                retry_failure.last_attempt.attempt_number,
+            logger.debug("handling event %s with handler %s, attempt %s",
+                         event, handler, attempt)
+            handler(event, uow=uow)
+            if uow is not None and queue is not None:
+                queue.extend(uow.collect_new_events())
+        except Exception as error:
+            scheduler = self.retry_scheduler
+            if scheduler is None or not policy.should_retry(error, attempt):
+                logger.error(
+                    "Failed to handle event %s with %s after %s attempts,"
+                    " giving up!", event, handler, attempt,
+                )
+                self.dead_letters.add(DeadLetter(
+                    event=event,
+                    handler=retries.handler_name(handler),
+                    error=repr(error),
+                    attempts=attempt,
+                ))
+                return
+            logger.warning("handler %s failed on %s, retrying in %ss",
+                           handler, event, policy.delay(attempt))
+            scheduler.schedule(
+                policy.delay(attempt),
+                functools.partial(self._retry, event, handler, attempt + 1),
             )
-            continue
 
+    def _retry(
+            self,
+            event: events.Event,
+            handler: Callable,
+            attempt: int,
+            uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        queue = deque()  # type: Deque[Message]
+        with self._chained(uow):
+            self._run_event_handler(event, handler, attempt, uow, queue)
+            self._process(queue, uow)
 
-def handle_command(
-        command: commands.Command,
-        queue: List[Message],
-        uow: unit_of_work.AbstractUnitOfWork,
-):
-        logger.debug("handling command %s", command)
-        try:
-            handler = COMMAND_HANDLERS[type(command)]
-            result = handler(command, uow=uow)
-            queue.extend(uow.collect_new_events())
-            return result
-        except Exception:
-            logger.exception("Exception handling command %s", command)
-            raise
+    def _chained(self, uow: unit_of_work.AbstractUnitOfWork):
+        return uow.chain() if self.chain_sessions else contextlib.nullcontext()
+
+    def handle_command(
+            self,
+            command: commands.Command,
+            handler: Callable,
+            queue: Deque[Message],
+            uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        # commands are only retried if their handler asks to be, and
+        # inline, since the caller is waiting for the result
+        policy = retries.policy_for(handler, default=retries.NO_RETRY)
+        attempt = 1
+        while True:
+            logger.debug("handling command %s, attempt %s", command, attempt)
+            try:
+                result = handler(command, uow=uow)
+                queue.extend(uow.collect_new_events())
+                return result
+            except Exception as error:
+                if not policy.should_retry(error, attempt):
+                    logger.exception("Exception handling command %s", command)
+                    raise
+                logger.info("retrying command %s after %r", command, error)
+                time.sleep(policy.delay(attempt))
+                attempt += 1
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [
-        handlers.publish_allocated_event,
-        handlers.add_allocation_to_read_model,
-    ],
+    events.Allocated: [handlers.add_allocation_to_read_model],
     events.Deallocated: [
         handlers.remove_allocation_from_read_model,
         handlers.reallocate,
@@ -80,6 +260,19 @@ EVENT_HANDLERS = {
 
 COMMAND_HANDLERS = {
     commands.Allocate: handlers.allocate,
+    commands.AllocateMany: handlers.allocate_many,
     commands.CreateBatch: handlers.add_batch,
     commands.ChangeBatchQuantity: handlers.change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
+
+
+_default_bus = None  # type: Optional[MessageBus]
+
+
+def handle(message: Message, uow: unit_of_work.AbstractUnitOfWork) -> List:
+    # shortcut for scripts and tests; entrypoints build their own bus with
+    # allocation.bootstrap
+    global _default_bus
+    if _default_bus is None:
+        _default_bus = MessageBus(EVENT_HANDLERS, COMMAND_HANDLERS)
+    return _default_bus.handle(message, uow)
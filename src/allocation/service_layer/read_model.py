@@ -0,0 +1,117 @@
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from allocation.domain import events
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+INSERT_ALLOCATION = """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+"""
+DELETE_ALLOCATION = """
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku
+"""
+
+
+class ReadModelBatcher:
+    # Stands in for the one-row read-model handlers: events are queued in
+    # the order they were handled and written by flush() in a single
+    # transaction, one executemany per run of inserts or deletes, so an
+    # insert and a later delete for the same order still apply in order.
+
+    def __init__(
+            self,
+            max_count: int = 500,
+            max_age: float = 0.5,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.clock = clock
+        self._pending = []  # type: List[Tuple[str, dict]]
+        self._oldest = None  # type: Optional[float]
+        self._lock = threading.Lock()
+        # one flush at a time: a failed one puts its updates back in front,
+        # and they must not land after newer ones that another flush wrote
+        # for the same order meanwhile
+        self._flushing = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def add_allocation(
+            self,
+            event: events.Allocated,
+            uow: unit_of_work.SqlAlchemyUnitOfWork,
+    ):
+        self._queue(INSERT_ALLOCATION, dict(
+            orderid=event.orderid, sku=event.sku, batchref=event.batchref,
+        ), uow)
+
+    def remove_allocation(
+            self,
+            event: events.Deallocated,
+            uow: unit_of_work.SqlAlchemyUnitOfWork,
+    ):
+        self._queue(DELETE_ALLOCATION, dict(
+            orderid=event.orderid, sku=event.sku,
+        ), uow)
+
+    def flush(self, uow: unit_of_work.SqlAlchemyUnitOfWork) -> int:
+        with self._flushing:
+            return self._flush(uow)
+
+    def _flush(self, uow: unit_of_work.SqlAlchemyUnitOfWork) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._oldest = None
+        if not pending:
+            return 0
+        try:
+            with uow:
+                for statement, run in itertools.groupby(
+                    pending, key=lambda op: op[0]
+                ):
+                    uow.session.execute(statement, [params for _, params in run])
+                uow.commit()
+        except Exception:
+            # put them back in front of anything queued meanwhile
+            with self._lock:
+                self._pending[:0] = pending
+                self._oldest = self.clock()
+            raise
+        logger.debug("flushed %s read model updates", len(pending))
+        return len(pending)
+
+    def _queue(
+            self,
+            statement: str,
+            params: dict,
+            uow: unit_of_work.SqlAlchemyUnitOfWork,
+    ):
+        with self._lock:
+            self._pending.append((statement, params))
+            if self._oldest is None:
+                self._oldest = self.clock()
+            due = (
+                len(self._pending) >= self.max_count
+                or self.clock() - self._oldest >= self.max_age
+            )
+        # if another flush is running, this update waits for the next one;
+        # waiting here could deadlock on the database with that flush
+        if due and self._flushing.acquire(blocking=False):
+            try:
+                self._flush(uow)
+            except Exception:
+                # left queued for the next flush rather than raised, since a
+                # retry of the handler would queue the event twice
+                logger.exception("failed to flush read model updates")
+            finally:
+                self._flushing.release()
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple, Type
+
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+Retry = Callable[[unit_of_work.AbstractUnitOfWork], None]
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 3
+    # seconds to wait after the first failure, multiplied after each one
+    backoff: float = 1.0
+    multiplier: float = 2.0
+    max_backoff: float = 60.0
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,)
+    # up to this fraction of each delay is taken off at random, so callers
+    # that failed together don't all retry together
+    jitter: float = 0.0
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt < self.attempts and isinstance(error, self.retry_on)
+
+    def delay(self, attempt: int) -> float:
+        delay = min(
+            self.backoff * self.multiplier ** (attempt - 1), self.max_backoff,
+        )
+        return delay * (1 - self.jitter * random.random())
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+def retry_policy(
+        policy: Optional[RetryPolicy] = None, **kwargs,
+) -> Callable[[Callable], Callable]:
+    policy = policy or RetryPolicy(**kwargs)
+
+    def decorate(handler: Callable) -> Callable:
+        setattr(handler, "retry_policy", policy)
+        return handler
+
+    return decorate
+
+
+def policy_for(
+        handler: Callable,
+        default: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> RetryPolicy:
+    return getattr(handler, "retry_policy", default)
+
+
+def handler_name(handler: Callable) -> str:
+    qualname = getattr(handler, "__qualname__", type(handler).__qualname__)
+    return f"{handler.__module__}.{qualname}"
+
+
+class RetryScheduler:
+    # Holds failed handler calls until their backoff has passed, then runs
+    # them on its own thread with a fresh unit of work, so nothing sleeps on
+    # the thread that is handling a request.
+
+    def __init__(
+            self,
+            uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.uow_factory = uow_factory
+        self.clock = clock
+        self._pending = []  # type: List[Tuple[float, int, Retry]]
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._stopping = False
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def schedule(self, delay: float, retry: Retry):
+        with self._condition:
+            heapq.heappush(
+                self._pending, (self.clock() + delay, next(self._order), retry)
+            )
+            self._condition.notify()
+
+    def run_due(self) -> int:
+        ran = 0
+        while True:
+            with self._condition:
+                if not self._pending or self._pending[0][0] > self.clock():
+                    return ran
+                _, _, retry = heapq.heappop(self._pending)
+            try:
+                retry(self.uow_factory())
+            except Exception:
+                logger.exception("scheduled retry %s failed", retry)
+            ran += 1
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="retry-scheduler", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and not self._is_due():
+                    self._condition.wait(self._seconds_until_due())
+                if self._stopping:
+                    return
+            self.run_due()
+
+    def _is_due(self) -> bool:
+        return bool(self._pending) and self._pending[0][0] <= self.clock()
+
+    def _seconds_until_due(self) -> Optional[float]:
+        if not self._pending:
+            return None
+        return max(self._pending[0][0] - self.clock(), 0)
@@ -1,19 +1,25 @@
 from __future__ import annotations
 import abc
+import contextlib
+from collections import deque
+from typing import Dict, Iterator, Optional, Set, Tuple
 
-from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.session import Session, SessionTransaction
 
-from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import cache, database, memory_store, outbox, repository
+from allocation.domain import events
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
-)
+DEFAULT_SESSION_FACTORY = sessionmaker(bind=database.get_engine())
+SERIALIZATION_FAILURE = "40001"
+
+
+class ConcurrencyConflict(Exception):
+    # another transaction changed a product this one changed too, and
+    # committed first
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -29,10 +35,15 @@ class AbstractUnitOfWork(abc.ABC):
     def commit(self):
         self._commit()
 
+    @contextlib.contextmanager
+    def chain(self) -> Iterator[AbstractUnitOfWork]:
+        # see SqlAlchemyUnitOfWork.chain; nothing to share by default
+        yield self
+
     def collect_new_events(self):
         for product in self.products.seen:
             while product.events:
-                yield product.events.pop(0)
+                yield product.events.popleft()
 
     @abc.abstractmethod
     def _commit(self):
@@ -45,17 +56,172 @@ class AbstractUnitOfWork(abc.ABC):
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+            self,
+            session_factory=DEFAULT_SESSION_FACTORY,
+            aggregate_cache: Optional[cache.AggregateCache] = None,
+            optimistic: bool = False,
+            batchref_cache: Optional[cache.BatchrefCache] = None,
+            read_only: bool = False,
+    ):
         self.session_factory = session_factory
+        self.aggregate_cache = aggregate_cache
+        self.optimistic = optimistic
+        self.batchref_cache = batchref_cache
+        self.read_only = read_only
+        self._chained = False
+        self._chain_committed = False
+        self._savepoint = None  # type: Optional[SessionTransaction]
+
+    @contextlib.contextmanager
+    def chain(self) -> Iterator[SqlAlchemyUnitOfWork]:
+        # Every `with uow:` inside the chain shares one session, so one
+        # connection and one identity map, and runs in a savepoint: commit
+        # releases it and rollback undoes only that block. Until something
+        # has been committed the outer transaction serves instead, which
+        # saves a SAVEPOINT and RELEASE for single-handler chains. What was
+        # committed is written when the chain ends, even if it ends with
+        # an exception.
+        # Optimistic units of work don't chain: a block retried after a
+        # conflict has to see what the other transaction committed, which
+        # under REPEATABLE READ takes a transaction of its own.
+        if self._chained or self.optimistic:
+            yield self
+            return
+        self._start_session()
+        self._chained = True
+        self._chain_committed = False
+        try:
+            yield self
+        finally:
+            self._chained = False
+            try:
+                self.session.commit()
+                self._publish_snapshots()
+            finally:
+                self.session.close()
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SQLAlchemyRepository(self.session)
+        if self._chained:
+            self._savepoint = (
+                self.session.begin_nested() if self._chain_committed else None
+            )
+        else:
+            self._start_session()
+        self._outboxed = set()  # type: Set[int]
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
-        self.session.close()
+        if not self._chained:
+            self.session.close()
+
+    def _commit(self):
+        try:
+            self._write()
+        except (StaleDataError, DBAPIError) as e:
+            if isinstance(e, DBAPIError) and (
+                getattr(e.orig, "pgcode", None) != SERIALIZATION_FAILURE
+            ):
+                raise
+            # none of it happened, so none of it gets published; events
+            # committed earlier in this block are kept for the bus
+            for product in self.products.seen:
+                product.events = deque(
+                    event for event in product.events
+                    if id(event) in self._outboxed
+                )
+            raise ConcurrencyConflict(str(e)) from e
+
+    def _write(self):
+        # external events are stored with the changes that raised them and
+        # published later by entrypoints/outbox_relay.py
+        pending = [
+            event
+            for product in self.products.seen
+            for event in product.events
+            if id(event) not in self._outboxed
+        ]
+        outbox.add(self.session, [
+            event for event in pending if isinstance(event, events.Event)
+        ])
+        if self.aggregate_cache is not None:
+            self.session.flush()
+            self._snapshots.update(
+                (product.sku, cache.snapshot(product))
+                for product in self.products.seen
+            )
+        if self._chained:
+            if self._savepoint is None:
+                self.session.flush()
+            else:
+                self._savepoint.commit()
+            self._chain_committed = True
+            # sqlalchemy emits the SAVEPOINT only if it gets used
+            self._savepoint = self.session.begin_nested()
+        else:
+            self.session.commit()
+            self._publish_snapshots()
+        self._outboxed.update(id(event) for event in pending)
+
+    def rollback(self):
+        if not self._chained or not self._chain_committed:
+            self.session.rollback()
+        elif self._savepoint is not None and self._savepoint_open():
+            # also when a failed flush has deactivated it, which leaves the
+            # session unusable until it is rolled back
+            self._savepoint.rollback()
+
+    def _savepoint_open(self) -> bool:
+        transaction = self.session.transaction
+        while transaction is not None:
+            if transaction is self._savepoint:
+                return True
+            transaction = transaction.parent
+        return False
+
+    def _start_session(self):
+        self.session = self.session_factory()  # type: Session
+        if self.read_only:
+            self.session.connection(execution_options=database.READ_ONLY)
+        lock = not self.optimistic
+        if self.aggregate_cache is None:
+            self.products = repository.SQLAlchemyRepository(
+                self.session, lock=lock, batchrefs=self.batchref_cache,
+            )
+        else:
+            self.products = repository.CachedSQLAlchemyRepository(
+                self.session, self.aggregate_cache,
+                lock=lock, batchrefs=self.batchref_cache,
+            )
+        # what _commit snapshotted, cached once the transaction commits
+        self._snapshots = {}  # type: Dict[str, Tuple[int, bytes]]
+
+    def _publish_snapshots(self):
+        if self.aggregate_cache is None:
+            return
+        for sku, (version_number, data) in self._snapshots.items():
+            self.aggregate_cache.put(sku, version_number, data)
+        self._snapshots = {}
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    # Products live in an InMemoryStore instead of a database. There is no
+    # outbox or read model here, so bootstrap it with handlers that don't
+    # need uow.session.
+
+    def __init__(
+            self,
+            store: Optional[memory_store.InMemoryStore] = None,
+            lock_timeout: float = 10.0,
+    ):
+        self.store = store if store is not None else memory_store.InMemoryStore()
+        self.lock_timeout = lock_timeout
+
+    def __enter__(self):
+        self.session = memory_store.InMemorySession(self.store, self.lock_timeout)
+        self.products = repository.InMemoryRepository(self.session)
+        return super().__enter__()
 
     def _commit(self):
         self.session.commit()
@@ -1,3 +1,8 @@
+from datetime import date
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
 from allocation.service_layer import unit_of_work
 
 
@@ -10,3 +15,58 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             dict(orderid=orderid)
         )
     return [dict(r) for r in results]
+
+
+def batches_page(
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        after: int = 0,
+        limit: int = 100,
+) -> Tuple[List[dict], Optional[int]]:
+    # keyset pagination on batches.id: each page is an index range scan,
+    # however deep into the listing it is, and the cursor for the next page
+    # is the id of the last row (None once there are no more)
+    with uow:
+        results = uow.session.execute(
+            """
+            SELECT id, ref, sku, _purchased_qty AS qty, eta FROM batches
+            WHERE id > :after ORDER BY id LIMIT :limit
+            """,
+            dict(after=after, limit=limit),
+        )
+        rows = [dict(r) for r in results]
+    cursor = rows[-1]["id"] if len(rows) == limit else None
+    return [_batch(row) for row in rows], cursor
+
+
+def stream_batches(
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        chunk_size: int = 1000,
+) -> Iterator[dict]:
+    # one query read through a server-side cursor where the driver has one
+    # (psycopg2), chunk_size rows at a time, so memory stays flat
+    with uow:
+        connection = uow.session.connection().execution_options(
+            stream_results=True,
+        )
+        results = connection.execute(
+            text(
+                "SELECT id, ref, sku, _purchased_qty AS qty, eta FROM batches"
+                " ORDER BY id"
+            )
+        )
+        while True:
+            chunk = results.fetchmany(chunk_size)
+            if not chunk:
+                return
+            for row in chunk:
+                yield _batch(dict(row))
+
+
+def _batch(row: dict) -> dict:
+    eta = row["eta"]
+    return dict(
+        ref=row["ref"],
+        sku=row["sku"],
+        qty=row["qty"],
+        eta=eta.isoformat() if isinstance(eta, date) else eta,
+    )
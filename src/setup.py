@@ -4,4 +4,5 @@ setup(
     name="allocation",
     version="0.1",
     packages=["allocation"],
+    extras_require={"numpy": ["numpy"]},
 )
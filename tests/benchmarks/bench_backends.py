@@ -0,0 +1,133 @@
+"""
+Allocate throughput on the SQLite backend, as tuned for single-node
+deployments (WAL, synchronous=NORMAL, mmap, BEGIN IMMEDIATE), on SQLite
+with its own defaults, and on Postgres. Worker threads allocate against
+a spread of SKUs through the message bus, one unit of work per command.
+
+    cd tests && python -m benchmarks.bench_backends --workers 8
+
+With its defaults SQLite starts transactions DEFERRED, so two that read
+then write can deadlock on upgrading their locks, and one of them fails
+with "database is locked" straight away; those count as failed.
+
+Postgres is skipped if it can't be reached (see config.get_postgres_uri,
+or pass --postgres-uri).
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+from unittest import mock
+
+from sqlalchemy import exc
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap, config
+from allocation.adapters import database, migrations
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from benchmarks.bench_messagebus import summarise
+
+# what sqlite does when nothing is set
+SQLITE_DEFAULTS = dict(
+    SQLITE_JOURNAL_MODE="DELETE",
+    SQLITE_SYNCHRONOUS="FULL",
+    SQLITE_MMAP_SIZE="0",
+    SQLITE_BEGIN="DEFERRED",
+)
+
+
+def run(uri: str, workers: int, per_worker: int, skus: int,
+        environ: Optional[Dict[str, str]] = None) -> Dict:
+    with mock.patch.dict(os.environ, environ or {}):
+        engine = database.get_engine(uri)
+    migrations.upgrade(engine)
+    bus = bootstrap.bootstrap()
+    session_factory = sessionmaker(bind=engine)
+    prefix = uuid.uuid4().hex[:8]
+    hot = [f"{prefix}-sku-{n}" for n in range(skus)]
+    for sku in hot:
+        bus.handle(
+            commands.CreateBatch(f"{sku}-batch", sku, workers * per_worker, None),
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+    latencies = []  # type: List[float]
+    failures = []  # type: List[Exception]
+    start_line = threading.Barrier(workers)
+
+    def allocator(n: int):
+        pick = random.Random(n)
+        start_line.wait()
+        for i in range(per_worker):
+            uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+            sku = pick.choice(hot)
+            start = time.perf_counter()
+            try:
+                bus.handle(commands.Allocate(f"{sku}-{n}-{i}", sku, 1), uow)
+            except Exception as e:  # pylint: disable=broad-except
+                failures.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    threads = [
+        threading.Thread(target=allocator, args=(n,)) for n in range(workers)
+    ]
+    try:
+        with mock.patch("allocation.adapters.email.send"):
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+    finally:
+        clear_mappers()
+        engine.dispose()
+    stats = summarise(latencies)
+    stats.update(throughput=len(latencies) / elapsed, failures=len(failures))
+    return stats
+
+
+def reachable(uri: str) -> bool:
+    try:
+        database.get_engine(uri).connect().close()
+    except exc.OperationalError:
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--postgres-uri", default=config.get_postgres_uri())
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-worker", type=int, default=100)
+    parser.add_argument("--skus", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = [
+            ("sqlite tuned", f"sqlite:///{os.path.join(tmp, 'tuned.db')}", None),
+            ("sqlite default", f"sqlite:///{os.path.join(tmp, 'default.db')}",
+             SQLITE_DEFAULTS),
+            ("postgres", args.postgres_uri, None),
+        ]
+        print(f"{'backend':16} {'cmd/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'failed':>7}")
+        for name, uri, environ in backends:
+            if name == "postgres" and not reachable(uri):
+                print(f"{name:16} skipped, can't connect to {uri}")
+                continue
+            stats = run(uri, args.workers, args.per_worker, args.skus, environ)
+            print(f"{name:16} {stats['throughput']:8.0f} {stats['p50_ms']:8.2f} "
+                  f"{stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f} "
+                  f"{stats['failures']:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Many threads allocating against one hot SKU, with units of work that lock
+the product's row (pessimistic) and with ones that check its version on
+commit and retry the command after a conflict (optimistic). Reports
+throughput, latency percentiles per command (retries included) and how
+many conflicts were retried.
+
+    cd tests && python -m benchmarks.bench_contention --workers 16
+
+Needs Postgres (see config.get_postgres_uri, or pass --uri): SQLite has no
+row locks and allows one writer at a time, so both modes would measure the
+same file lock.
+"""
+import argparse
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, List
+from unittest import mock
+
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap, config
+from allocation.adapters import database, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from benchmarks.bench_messagebus import summarise
+
+
+class RetryCounter(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.retries = 0
+
+    def emit(self, record):
+        if record.getMessage().startswith("retrying command"):
+            self.retries += 1
+
+
+def run(optimistic: bool, uri: str, workers: int, per_worker: int) -> Dict:
+    engine = database.get_engine(uri)
+    bus = bootstrap.bootstrap()
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    sku = f"hot-{uuid.uuid4().hex[:8]}"
+    bus.handle(
+        commands.CreateBatch(f"{sku}-batch", sku, workers * per_worker, None),
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+    )
+    counter = RetryCounter()
+    bus_logger = logging.getLogger("allocation.service_layer.messagebus")
+    bus_logger.addHandler(counter)
+    bus_logger.setLevel(logging.INFO)
+    latencies = []  # type: List[float]
+    failures = []  # type: List[Exception]
+    start_line = threading.Barrier(workers)
+
+    def allocator(n: int):
+        start_line.wait()
+        for i in range(per_worker):
+            uow = unit_of_work.SqlAlchemyUnitOfWork(
+                session_factory, optimistic=optimistic,
+            )
+            start = time.perf_counter()
+            try:
+                bus.handle(commands.Allocate(f"{sku}-{n}-{i}", sku, 1), uow)
+            except Exception as e:  # pylint: disable=broad-except
+                failures.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    threads = [
+        threading.Thread(target=allocator, args=(n,)) for n in range(workers)
+    ]
+    try:
+        with mock.patch("allocation.adapters.email.send"):
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+    finally:
+        bus_logger.removeHandler(counter)
+        clear_mappers()
+    stats = summarise(latencies)
+    stats.update(
+        throughput=len(latencies) / elapsed,
+        retries=counter.retries,
+        failures=len(failures),
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--uri", default=config.get_postgres_uri())
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--per-worker", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'mode':12} {'cmd/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'retries':>8} {'failed':>7}")
+    for name, optimistic in [("pessimistic", False), ("optimistic", True)]:
+        stats = run(optimistic, args.uri, args.workers, args.per_worker)
+        print(f"{name:12} {stats['throughput']:8.0f} {stats['p50_ms']:8.2f} "
+              f"{stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f} "
+              f"{stats['retries']:8d} {stats['failures']:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Latency of the hot lookups on a SQLite database with a million rows per
+table, at schema version 1 (no secondary indexes) and again after
+migrating it in place to the latest version.
+
+    cd tests && python -m benchmarks.bench_indexes --rows 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from sqlalchemy import create_engine
+
+from allocation.adapters import migrations, orm
+from allocation.adapters.database import enable_sqlite_savepoints
+
+BATCHES_PER_SKU = 100
+CHUNK = 50_000
+
+LOOKUPS = {
+    # repository._get_by_batchref
+    "batch by ref": (
+        "SELECT sku FROM batches WHERE ref = :key",
+        lambda i: f"batch-{i}",
+    ),
+    "batches by sku": (
+        "SELECT id FROM batches WHERE sku = :key",
+        lambda i: f"sku-{i // BATCHES_PER_SKU}",
+    ),
+    # views.allocations
+    "view by orderid": (
+        "SELECT sku, batchref FROM allocations_view WHERE orderid = :key",
+        lambda i: f"order-{i}",
+    ),
+    "lines by orderid": (
+        "SELECT id FROM order_lines WHERE orderid = :key",
+        lambda i: f"order-{i}",
+    ),
+    "allocation by line": (
+        "SELECT batch_id FROM allocations WHERE order_line_id = :key",
+        lambda i: i + 1,
+    ),
+    "batch allocations": (
+        "SELECT order_line_id FROM allocations WHERE batch_id = :key",
+        lambda i: i + 1,
+    ),
+}  # type: Dict[str, tuple]
+
+
+def populate(engine, rows: int):
+    orm.metadata.create_all(engine)
+    with engine.begin() as connection:
+        # back to how databases looked before migrations
+        for table in orm.metadata.tables.values():
+            for index in table.indexes:
+                if index.name in migrations.LOOKUP_INDEXES:
+                    index.drop(connection)
+        orm.schema_version.drop(connection)
+    for start in range(0, rows, CHUNK):
+        ids = range(start, min(start + CHUNK, rows))
+        with engine.begin() as connection:
+            skus = [
+                dict(sku=f"sku-{i // BATCHES_PER_SKU}")
+                for i in ids if i % BATCHES_PER_SKU == 0
+            ]
+            if skus:
+                connection.execute(orm.products.insert(), skus)
+            connection.execute(orm.batches.insert(), [
+                dict(id=i + 1, ref=f"batch-{i}", sku=f"sku-{i // BATCHES_PER_SKU}",
+                     _purchased_qty=100, eta=None)
+                for i in ids
+            ])
+            connection.execute(orm.order_lines.insert(), [
+                dict(id=i + 1, orderid=f"order-{i}",
+                     sku=f"sku-{i // BATCHES_PER_SKU}", qty=1)
+                for i in ids
+            ])
+            connection.execute(orm.allocations.insert(), [
+                dict(batch_id=i + 1, order_line_id=i + 1) for i in ids
+            ])
+            connection.execute(orm.allocations_view.insert(), [
+                dict(orderid=f"order-{i}", sku=f"sku-{i // BATCHES_PER_SKU}",
+                     batchref=f"batch-{i}")
+                for i in ids
+            ])
+
+
+def measure(engine, rows: int, lookups: int, seed: int) -> Dict[str, float]:
+    results = {}
+    with engine.connect() as connection:
+        for name, (query, key) in LOOKUPS.items():
+            keys = random.Random(seed).sample(range(rows), lookups)
+            samples = []  # type: List[float]
+            for i in keys:
+                start = time.perf_counter()
+                connection.execute(query, key=key(i)).fetchall()
+                samples.append(time.perf_counter() - start)
+            results[name] = statistics.median(samples) * 1000
+    return results
+
+
+def timed(do: Callable) -> float:
+    start = time.perf_counter()
+    do()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = enable_sqlite_savepoints(
+            create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        )
+        seconds = timed(lambda: populate(engine, args.rows))
+        print(f"loaded {args.rows} rows per table in {seconds:.1f}s")
+        before = measure(engine, args.rows, args.lookups, args.seed)
+        seconds = timed(lambda: migrations.upgrade(engine))
+        print(f"migrated to version {migrations.HEAD} in {seconds:.1f}s")
+        after = measure(engine, args.rows, args.lookups, args.seed)
+        engine.dispose()
+
+    print(f"{'lookup':20} {'v1 ms':>10} {'v2 ms':>10} {'speedup':>9}"
+          "   (median)")
+    for name in LOOKUPS:
+        print(f"{name:20} {before[name]:10.3f} {after[name]:10.3f} "
+              f"{before[name] / after[name]:8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Memory footprint of allocated order lines, and how long it takes to load a
+product with many of them.
+
+    cd tests && python -m benchmarks.bench_memory --lines 20000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import orm, repository
+from allocation.domain import model
+from random_refs import random_element, random_suffix
+
+
+def orderid(i: int) -> str:
+    return f"order-{i}-{random_suffix()}"
+
+
+def fresh(text: str) -> str:
+    # a new str object, like the ones a JSON parser or DB driver hands us
+    return "".join(list(text))
+
+
+def bytes_per_allocated_line(n_lines: int) -> float:
+    sku = random_element("sku")
+    product = model.Product(sku, [model.Batch("b1", sku, n_lines)])
+    lines = [
+        model.Orderline(orderid(i), fresh(sku), 1)
+        for i in range(n_lines)
+    ]
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    product.allocate_many(lines)
+    product.events.clear()  # drained by the message bus in real use
+    del lines
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # the lines themselves were allocated before tracing started, so add
+    # back what a line costs to build
+    return (after - before) / n_lines + line_size(sku)
+
+
+def line_size(sku: str) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    lines = [
+        model.Orderline(orderid(i), fresh(sku), 1)
+        for i in range(1000)
+    ]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del lines
+    return (after - before) / 1000
+
+
+def load_product(n_lines: int):
+    engine = create_engine("sqlite:///:memory:")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        sku = random_element("sku")
+        with engine.begin() as conn:
+            conn.execute(orm.products.insert(), sku=sku, version_number=1)
+            [batch_id] = conn.execute(
+                orm.batches.insert(),
+                ref="b1", sku=sku, _purchased_qty=n_lines, eta=None,
+            ).inserted_primary_key
+            conn.execute(orm.order_lines.insert(), [
+                dict(id=i, orderid=orderid(i), sku=sku, qty=1)
+                for i in range(1, n_lines + 1)
+            ])
+            conn.execute(orm.allocations.insert(), [
+                dict(batch_id=batch_id, order_line_id=i)
+                for i in range(1, n_lines + 1)
+            ])
+
+        session = sessionmaker(bind=engine)()
+        gc.collect()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        product = repository.SQLAlchemyRepository(session).get(sku)
+        assert product.batches[0].available_quantity == 0
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        session.close()
+        return elapsed, (after - before) / n_lines
+    finally:
+        clear_mappers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"domain objects:  {bytes_per_allocated_line(args.lines):8.0f} "
+          f"bytes per allocated line")
+    elapsed, per_line = load_product(args.lines)
+    print(f"ORM-loaded:      {per_line:8.0f} bytes per allocated line")
+    print(f"aggregate load:  {elapsed * 1000:8.1f} ms "
+          f"for {args.lines} lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Throughput and latency of MessageBus.handle, per command type, against an
+in-memory unit of work and against SQLite through SqlAlchemyUnitOfWork.
+
+    cd tests && python -m benchmarks.bench_messagebus --save baseline.json
+    cd tests && python -m benchmarks.bench_messagebus --compare baseline.json
+
+Email is replaced by a no-op, and redis messages only reach the outbox
+table, so the numbers cover the bus, the domain model and the database.
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import events
+from allocation.service_layer import handlers, messagebus, unit_of_work
+from benchmarks.workloads import Workload, WorkloadSpec
+
+
+@contextlib.contextmanager
+def memory_backend():
+    # the read model and the outbox live in SQL, so there is nothing to
+    # update in memory
+    bus = bootstrap.bootstrap(start_orm=False, event_handlers={
+        **messagebus.EVENT_HANDLERS,
+        events.Allocated: [],
+        events.Deallocated: [handlers.reallocate],
+    })
+    yield bus, unit_of_work.InMemoryUnitOfWork()
+
+
+@contextlib.contextmanager
+def sqlite_backend():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        orm.metadata.create_all(engine)
+        bus = bootstrap.bootstrap()
+        try:
+            yield bus, unit_of_work.SqlAlchemyUnitOfWork(
+                sessionmaker(bind=engine)
+            )
+        finally:
+            clear_mappers()
+            engine.dispose()
+
+
+BACKENDS = {
+    "memory": memory_backend,
+    "sqlite": sqlite_backend,
+}
+
+
+def run(backend: str, spec: WorkloadSpec) -> Dict[str, dict]:
+    workload = Workload(spec)
+    latencies = defaultdict(list)  # type: Dict[str, List[float]]
+    with BACKENDS[backend]() as (bus, uow), \
+            mock.patch("allocation.adapters.email.send"):
+        for command in workload.setup():
+            bus.handle(command, uow)
+        for command in workload.stream():
+            start = time.perf_counter()
+            bus.handle(command, uow)
+            latencies[type(command).__name__].append(
+                time.perf_counter() - start
+            )
+    return {name: summarise(samples) for name, samples in latencies.items()}
+
+
+def summarise(samples: List[float]) -> dict:
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0]
+    return dict(
+        count=len(samples),
+        throughput=len(samples) / sum(samples),
+        p50_ms=p50 * 1000,
+        p95_ms=p95 * 1000,
+        p99_ms=p99 * 1000,
+    )
+
+
+def report(results: Dict[str, Dict[str, dict]]):
+    print(f"{'backend':8} {'command':20} {'count':>6} {'cmd/s':>9} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for backend, by_command in results.items():
+        for name, stats in sorted(by_command.items()):
+            print(f"{backend:8} {name:20} {stats['count']:6d} "
+                  f"{stats['throughput']:9.0f} {stats['p50_ms']:8.2f} "
+                  f"{stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f}")
+
+
+def regressions(results, baseline, tolerance: float) -> List[str]:
+    found = []
+    for backend, by_command in results.items():
+        for name, stats in by_command.items():
+            before = baseline.get(backend, {}).get(name)
+            if before is None:
+                continue
+            if stats["throughput"] < before["throughput"] * (1 - tolerance):
+                found.append(
+                    f"{backend} {name}: throughput {stats['throughput']:.0f}"
+                    f" < baseline {before['throughput']:.0f} cmd/s"
+                )
+            if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                found.append(
+                    f"{backend} {name}: p95 {stats['p95_ms']:.2f}"
+                    f" > baseline {before['p95_ms']:.2f} ms"
+                )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--backend", choices=BACKENDS, action="append")
+    parser.add_argument("--skus", type=int, default=WorkloadSpec.skus)
+    parser.add_argument("--batches-per-sku", type=int,
+                        default=WorkloadSpec.batches_per_sku)
+    parser.add_argument("--sku-skew", type=float,
+                        default=WorkloadSpec.sku_skew)
+    parser.add_argument("--eta-spread-days", type=int,
+                        default=WorkloadSpec.eta_spread_days)
+    parser.add_argument("--commands", type=int, default=WorkloadSpec.commands)
+    parser.add_argument("--mix", type=json.loads,
+                        help='e.g. \'{"Allocate": 0.8, "CreateBatch": 0.2}\'')
+    parser.add_argument("--seed", type=int, default=WorkloadSpec.seed)
+    parser.add_argument("--save", metavar="PATH",
+                        help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="fail if results regress against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    spec = WorkloadSpec(
+        skus=args.skus,
+        batches_per_sku=args.batches_per_sku,
+        sku_skew=args.sku_skew,
+        eta_spread_days=args.eta_spread_days,
+        commands=args.commands,
+        seed=args.seed,
+    )
+    if args.mix:
+        spec.mix = args.mix
+    results = {
+        backend: run(backend, spec)
+        for backend in args.backend or list(BACKENDS)
+    }
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for problem in found:
+            print("REGRESSION:", problem)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Connection checkouts, database round trips and latency per command, with
+one session per `with uow:` block and with one session chained across the
+whole messagebus.handle call.
+
+    cd tests && python -m benchmarks.bench_sessions --commands 2000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict
+from unittest import mock
+
+from sqlalchemy import event
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import database, orm
+from allocation.service_layer import unit_of_work
+from benchmarks.workloads import Workload, WorkloadSpec
+
+
+def run(chain_sessions: bool, spec: WorkloadSpec) -> Dict[str, float]:
+    counts = dict(checkouts=0, round_trips=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = database.get_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        orm.metadata.create_all(engine)
+
+        def count(name):
+            def counter(*args):
+                counts[name] += 1
+            return counter
+
+        # pre-ping on checkout and the rollback on checkin are round trips
+        # too, as are commits and rollbacks that never reach a cursor
+        event.listen(engine, "checkout", count("checkouts"))
+        for name in ["checkout", "reset", "commit", "rollback"]:
+            event.listen(engine, name, count("round_trips"))
+        event.listen(engine, "before_cursor_execute", count("round_trips"))
+
+        bus = bootstrap.bootstrap(chain_sessions=chain_sessions)
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+        workload = Workload(spec)
+        try:
+            with mock.patch("allocation.adapters.email.send"):
+                for command in workload.setup():
+                    bus.handle(command, uow)
+                commands = list(workload.stream())
+                counts.update(checkouts=0, round_trips=0)
+                start = time.perf_counter()
+                for command in commands:
+                    bus.handle(command, uow)
+                elapsed = time.perf_counter() - start
+        finally:
+            clear_mappers()
+            engine.dispose()
+    return dict(
+        checkouts=counts["checkouts"] / len(commands),
+        round_trips=counts["round_trips"] / len(commands),
+        ms=elapsed / len(commands) * 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--skus", type=int, default=WorkloadSpec.skus)
+    parser.add_argument("--batches-per-sku", type=int,
+                        default=WorkloadSpec.batches_per_sku)
+    parser.add_argument("--commands", type=int, default=WorkloadSpec.commands)
+    parser.add_argument("--mix", type=json.loads,
+                        help='e.g. \'{"Allocate": 0.5, "ChangeBatchQuantity": 0.5}\'')
+    parser.add_argument("--seed", type=int, default=WorkloadSpec.seed)
+    args = parser.parse_args()
+    spec = WorkloadSpec(
+        skus=args.skus,
+        batches_per_sku=args.batches_per_sku,
+        commands=args.commands,
+        seed=args.seed,
+    )
+    if args.mix:
+        spec.mix = args.mix
+
+    print(f"{'sessions':10} {'checkouts':>10} {'round trips':>12} {'ms':>8}"
+          "   (per command)")
+    for name, chain_sessions in [("per block", False), ("chained", True)]:
+        result = run(chain_sessions, spec)
+        print(f"{name:10} {result['checkouts']:10.2f} "
+              f"{result['round_trips']:12.2f} {result['ms']:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Synthetic command streams for benchmarking the message bus.
+"""
+import random
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from allocation.domain import commands
+from random_refs import random_element
+
+
+@dataclass
+class WorkloadSpec:
+    skus: int = 20
+    batches_per_sku: int = 10
+    batch_qty: int = 1000
+    # 0 picks skus uniformly; higher values concentrate traffic on a few
+    # hot skus (sku i gets weight 1 / (i + 1) ** sku_skew)
+    sku_skew: float = 1.0
+    eta_spread_days: int = 30
+    warehouse_share: float = 0.2
+    line_qty: int = 10
+    commands: int = 2000
+    mix: Dict[str, float] = field(default_factory=lambda: {
+        "Allocate": 0.90,
+        "CreateBatch": 0.05,
+        "ChangeBatchQuantity": 0.05,
+    })
+    seed: int = 0
+
+
+class Workload:
+
+    def __init__(self, spec: WorkloadSpec):
+        self.spec = spec
+        self._rnd = random.Random(spec.seed)
+        self._skus = [random_element("sku") for _ in range(spec.skus)]
+        self._weights = [
+            1 / (i + 1) ** spec.sku_skew for i in range(spec.skus)
+        ]
+        self._batchrefs = {
+            sku: [] for sku in self._skus
+        }  # type: Dict[str, List[str]]
+
+    def setup(self) -> List[commands.Command]:
+        return [
+            self._create_batch(sku)
+            for sku in self._skus
+            for _ in range(self.spec.batches_per_sku)
+        ]
+
+    def stream(self) -> Iterator[commands.Command]:
+        names = list(self.spec.mix)
+        weights = [self.spec.mix[name] for name in names]
+        for _ in range(self.spec.commands):
+            name = self._rnd.choices(names, weights)[0]
+            sku = self._rnd.choices(self._skus, self._weights)[0]
+            if name == "Allocate":
+                yield commands.Allocate(
+                    random_element("order"),
+                    sku,
+                    self._rnd.randint(1, self.spec.line_qty),
+                )
+            elif name == "CreateBatch":
+                yield self._create_batch(sku)
+            elif name == "ChangeBatchQuantity":
+                yield commands.ChangeBatchQuantity(
+                    self._rnd.choice(self._batchrefs[sku]),
+                    self._rnd.randint(0, self.spec.batch_qty),
+                )
+            else:
+                raise ValueError(f"Unknown command {name!r} in workload mix")
+
+    def _create_batch(self, sku: str) -> commands.CreateBatch:
+        ref = random_element("batch")
+        self._batchrefs[sku].append(ref)
+        return commands.CreateBatch(ref, sku, self.spec.batch_qty, self._eta())
+
+    def _eta(self) -> Optional[date]:
+        if self._rnd.random() < self.spec.warehouse_share:
+            return None
+        days = self._rnd.randint(0, self.spec.eta_spread_days)
+        return date.today() + timedelta(days=days)
@@ -11,23 +11,26 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
-from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters import database, migrations
+from allocation.adapters.orm import start_mappers
 from allocation import config
 
 pytest.register_assert_rewrite("tests.e2e.api_client")
 
 
 @pytest.fixture
-def in_memory_db():
-    engine = create_engine("sqlite:///:memory:")
-    metadata.create_all(engine)
-    return engine
+def sqlite_db(tmp_path):
+    # a file with the settings a single-node deployment runs with
+    engine = database.get_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    migrations.upgrade(engine)
+    yield engine
+    engine.dispose()
 
 
 @pytest.fixture
-def sqlite_session_factory(in_memory_db):
+def sqlite_session_factory(sqlite_db):
     start_mappers()
-    yield sessionmaker(bind=in_memory_db)
+    yield sessionmaker(bind=sqlite_db)
     clear_mappers()
 
 
@@ -56,7 +59,7 @@ def wait_for_redis_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_for_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    migrations.upgrade(engine)
     return engine
 
 
@@ -25,3 +25,22 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
+
+
+def get_batches(after=0, limit=100):
+    url = config.get_api_url()
+    return requests.get(f"{url}/batches", params=dict(after=after, limit=limit))
+
+
+def get_batches_ndjson():
+    url = config.get_api_url()
+    return requests.get(f"{url}/batches.ndjson", stream=True)
+
+
+def post_batches_csv(text):
+    url = config.get_api_url()
+    return requests.post(
+        f"{url}/batches/import",
+        data=text.encode(),
+        headers={"Content-Type": "text/csv"},
+    )
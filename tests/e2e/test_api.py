@@ -1,3 +1,5 @@
+import json
+
 import pytest
 import requests
 
@@ -80,7 +82,7 @@ def test_happy_path_returns_202_and_batch_is_allocated():
     other_batch = random_element("batch3")
     api_client.post_to_add_batch(later_batch, sku, 100, "2011-01-02")
     api_client.post_to_add_batch(early_batch, sku, 100, "2011-01-01")
-    api_client.post_to_add_batch(other_batch, sku, 100, None)
+    api_client.post_to_add_batch(other_batch, other_sku, 100, None)
 
     response = api_client.post_to_allocate(orderid, sku, qty=3)
     assert response.status_code == 202
@@ -105,3 +107,60 @@ def test_unhappy_path_returns_400_and_error_message():
 
     response = api_client.get_allocation(orderid)
     assert response.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_batches_can_be_paged_and_streamed():
+    sku = random_element("sku")
+    refs = [random_element("batch", str(i)) for i in range(3)]
+    for ref in refs:
+        api_client.post_to_add_batch(ref, sku, 10, "2011-01-01")
+
+    listed, cursor = [], 0
+    while cursor is not None:
+        page = api_client.get_batches(after=cursor, limit=2).json()
+        listed.extend(page["batches"])
+        cursor = page["next"]
+    assert [b["ref"] for b in listed if b["sku"] == sku] == refs
+
+    streamed = [
+        json.loads(line)
+        for line in api_client.get_batches_ndjson().iter_lines()
+    ]
+    assert [b for b in streamed if b["sku"] == sku] == [
+        dict(ref=ref, sku=sku, qty=10, eta="2011-01-01") for ref in refs
+    ]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+@pytest.mark.parametrize("limit", [0, -1])
+def test_batch_page_sizes_are_at_least_one(limit):
+    sku, batch = random_element("sku"), random_element("batch")
+    api_client.post_to_add_batch(batch, sku, 10, "2011-01-01")
+    r = api_client.get_batches(after=0, limit=limit)
+    assert r.status_code == 200
+    assert len(r.json()["batches"]) == 1
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_imported_batches_can_be_allocated():
+    sku, orderid = random_element("sku"), random_element("order")
+    batch = random_element("batch")
+    r = api_client.post_batches_csv(
+        "ref,sku,qty,eta\n"
+        f"{batch},{sku},100,2011-01-01\n"
+        f"{random_element('batch')},{sku},none,\n"
+    )
+    assert r.status_code == 200
+    assert r.json()["imported"] == 1
+    assert r.json()["errors"] == [
+        dict(line=3, reason="qty 'none' is not a whole number")
+    ]
+
+    api_client.post_to_allocate(orderid, sku, 3)
+    assert api_client.get_allocation(orderid).json() == [
+        dict(sku=sku, batchref=batch)
+    ]
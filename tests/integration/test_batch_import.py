@@ -0,0 +1,140 @@
+import io
+from datetime import date
+
+from allocation.adapters.cache import AggregateCache
+from allocation.domain import model
+from allocation.service_layer import batch_import, unit_of_work
+
+
+def import_text(text, file_format, session_factory, **kwargs):
+    return batch_import.import_batches(
+        batch_import.read_records(io.StringIO(text), file_format),
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        **kwargs,
+    )
+
+
+def test_imports_csv_creating_missing_products(sqlite_session_factory):
+    report = import_text(
+        "ref,sku,qty,eta\n"
+        "b1,sku1,100,2030-01-01\n"
+        "b2,sku2,20,\n"
+        "b3,sku1,5,\n",
+        "csv", sqlite_session_factory, chunk_size=2,
+    )
+
+    assert (report.rows, report.skipped, report.products_created) == (3, 0, 2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get("sku1")
+        assert {batch.ref for batch in product.batches} == {"b1", "b3"}
+        assert product.get_batch("b1").eta == date(2030, 1, 1)
+        assert product.get_batch("b3").available_quantity == 5
+
+
+def test_skips_and_reports_invalid_rows(sqlite_session_factory):
+    report = import_text(
+        '{"ref": "b1", "sku": "sku1", "qty": 10, "eta": null}\n'
+        '{"ref": "b2", "sku": "sku1", "qty": 2.5}\n'
+        '\n'
+        '{"ref": "b3", "sku": "", "qty": 1}\n'
+        'not json\n'
+        '{"ref": "b4", "sku": "sku1", "qty": 1, "eta": "soon"}\n'
+        '{"ref": "b5", "sku": "sku1", "qty": -1}\n',
+        "jsonl", sqlite_session_factory,
+    )
+
+    assert (report.rows, report.skipped) == (1, 5)
+    assert [line for line, _ in report.errors] == [2, 4, 5, 6, 7]
+    assert "qty 2.5" in report.errors[0][1]
+
+
+def test_skips_refs_repeated_in_the_file(sqlite_session_factory):
+    report = import_text(
+        "ref,sku,qty,eta\n"
+        "b1,sku1,10,\n"
+        "b2,sku1,10,\n"
+        "b1,sku2,20,\n"
+        "b1,sku3,30,\n",
+        "csv", sqlite_session_factory, chunk_size=3,
+    )
+
+    assert (report.rows, report.skipped, report.products_created) == (2, 2, 1)
+    assert report.errors == [
+        (4, "ref b1 repeats line 2"),
+        (5, "batch b1 already exists"),
+    ]
+
+
+def test_reports_errors_in_line_order(sqlite_session_factory):
+    import_text("ref,sku,qty,eta\nb1,sku1,10,\n", "csv", sqlite_session_factory)
+
+    report = import_text(
+        "ref,sku,qty,eta\n"
+        "b1,sku1,10,\n"
+        "b2,sku1,lots,\n"
+        "b3,sku1,10,\n",
+        "csv", sqlite_session_factory, chunk_size=2,
+    )
+
+    assert [line for line, _ in report.errors] == [2, 3]
+
+
+def test_skips_batches_already_in_the_database(sqlite_session_factory):
+    import_text("ref,sku,qty,eta\nb1,sku1,10,\n", "csv", sqlite_session_factory)
+
+    report = import_text(
+        "ref,sku,qty,eta\n"
+        "b2,sku1,5,\n"
+        "b1,sku1,99,\n"
+        "b3,sku2,5,\n",
+        "csv", sqlite_session_factory, chunk_size=2,
+    )
+
+    assert (report.rows, report.skipped, report.products_created) == (2, 1, 1)
+    assert report.errors == [(3, "batch b1 already exists")]
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get("sku1")
+        assert {batch.ref for batch in product.batches} == {"b1", "b2"}
+        assert product.get_batch("b1").available_quantity == 10
+
+
+def test_bumps_the_version_of_existing_products(sqlite_session_factory):
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    with uow:
+        product = model.Product("sku1", batches=[])
+        product.add_batch(model.Batch("b1", "sku1", 10, eta=None))
+        uow.products.add(product)
+        uow.commit()
+
+    report = import_text("ref,sku,qty,eta\nb2,sku1,5,\n", "csv",
+                         sqlite_session_factory)
+
+    assert report.products_created == 0
+    with uow:
+        assert len(uow.products.get("sku1").batches) == 2
+    assert cache.stats()["stale"] == 1
+
+
+def test_numbers_csv_records_by_the_line_they_start_on():
+    records = batch_import.read_records(io.StringIO(
+        "ref,sku,qty,eta\n"
+        'b1,"sku\n1",1,\n'
+        "\n"
+        "b2,sku2,x,\n"
+    ), "csv")
+    assert [(line, record["ref"]) for line, record in records] == [
+        (2, "b1"), (5, "b2"),
+    ]
+
+
+def test_reads_records_lazily():
+    def lines():
+        yield "ref,sku,qty,eta\n"
+        yield "b1,sku1,1,\n"
+        raise AssertionError("read past the first record")
+
+    records = batch_import.read_records(lines(), "csv")
+    assert next(records) == (2, dict(ref="b1", sku="sku1", qty="1", eta=""))
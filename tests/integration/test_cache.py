@@ -0,0 +1,172 @@
+# pylint: disable=redefined-outer-name
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.adapters.cache import AggregateCache
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from integration.test_repository import count_selects
+
+
+def add_product(session_factory, sku, qty=100):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = model.Product(sku, batches=[])
+        product.add_batch(model.Batch(f"{sku}-batch", sku, qty, eta=None))
+        uow.products.add(product)
+        uow.commit()
+
+
+def allocate(uow, sku, orderid, qty=10):
+    with uow:
+        batchref = uow.products.get(sku).allocate(
+            model.Orderline(orderid, sku, qty)
+        )
+        uow.commit()
+    return batchref
+
+
+def available(uow, sku):
+    with uow:
+        return uow.products.get(sku).batches[0].available_quantity
+
+
+def test_a_cached_product_is_checked_with_a_single_select(
+        sqlite_db, sqlite_session_factory,
+):
+    add_product(sqlite_session_factory, "sku1")
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    allocate(uow, "sku1", "o1")
+    assert cache.stats()["misses"] == 1
+
+    assert count_selects(sqlite_db, lambda: allocate(uow, "sku1", "o2")) == 1
+    assert cache.stats()["hits"] == 1
+    assert available(uow, "sku1") == 80
+
+
+def test_changes_committed_elsewhere_make_the_entry_stale(sqlite_session_factory):
+    add_product(sqlite_session_factory, "sku1")
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    allocate(uow, "sku1", "o1")
+
+    # another process, with its own cache, allocates against the product
+    allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+             "sku1", "o2")
+
+    assert available(uow, "sku1") == 80
+    assert cache.stats()["stale"] == 1
+
+
+def test_rolled_back_changes_are_not_cached(sqlite_session_factory):
+    add_product(sqlite_session_factory, "sku1")
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    allocate(uow, "sku1", "o1")
+    with uow:
+        uow.products.get("sku1").allocate(model.Orderline("o2", "sku1", 10))
+
+    assert available(uow, "sku1") == 90
+
+
+def test_chained_commits_are_cached_once_the_chain_commits(sqlite_session_factory):
+    add_product(sqlite_session_factory, "sku1")
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    with uow.chain():
+        allocate(uow, "sku1", "o1")
+        allocate(uow, "sku1", "o2")
+        assert len(cache) == 0
+    assert len(cache) == 1
+
+    assert available(uow, "sku1") == 80
+    assert cache.stats()["hits"] == 1
+
+
+def test_evicts_the_least_recently_used_product(sqlite_session_factory):
+    for sku in ["sku1", "sku2", "sku3"]:
+        add_product(sqlite_session_factory, sku)
+    cache = AggregateCache(max_size=2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache)
+    allocate(uow, "sku1", "o1")
+    allocate(uow, "sku2", "o2")
+    available(uow, "sku1")
+    allocate(uow, "sku3", "o3")
+
+    assert cache.stats()["evictions"] == 1
+    available(uow, "sku1")
+    available(uow, "sku2")
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 4
+
+
+def test_keeps_the_newest_snapshot():
+    cache = AggregateCache()
+    cache.put("sku1", 3, b"newer")
+    cache.put("sku1", 2, b"older")
+    assert cache.get("sku1", 2) is None
+
+
+@pytest.fixture
+def file_session_factory(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}",
+        connect_args=dict(check_same_thread=False, timeout=30),
+    )
+
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    # writers queue for the database as they would for the product's row
+    # lock in postgres
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN IMMEDIATE")
+
+    orm.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def test_concurrent_writers_with_separate_caches_never_overallocate(
+        sqlite_session_factory, file_session_factory,
+):
+    add_product(file_session_factory, "sku1", qty=100)
+    caches = [AggregateCache(), AggregateCache()]
+    exceptions = []
+
+    def worker(n):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            file_session_factory, caches[n % 2],
+        )
+        try:
+            for i in range(10):
+                allocate(uow, "sku1", f"o{n}-{i}", qty=1)
+        except Exception as e:  # pylint: disable=broad-except
+            exceptions.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    session = file_session_factory()
+    [[allocated, version]] = session.execute(
+        "SELECT count(*), max(p.version_number) FROM allocations"
+        " JOIN order_lines AS l ON l.id = order_line_id"
+        " JOIN products AS p ON p.sku = l.sku"
+    )
+    session.close()
+    assert allocated == 60
+    assert version == 61
+    for cache in caches:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(file_session_factory, cache)
+        assert available(uow, "sku1") == 40
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+from sqlalchemy import exc
+
+from allocation.adapters import database
+
+
+@pytest.fixture
+def small_pool(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_POOL_SIZE", "1")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.05")
+    return database.get_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+
+
+def test_engines_are_shared_per_uri(small_pool):
+    assert database.get_engine(str(small_pool.url)) is small_pool
+
+
+def test_pool_settings_come_from_the_environment(small_pool):
+    stats = database.pool_stats(small_pool)
+    assert stats["pool_size"] == 1
+
+
+def test_reports_checkout_waits_and_timeouts(small_pool):
+    connection = small_pool.connect()
+    with pytest.raises(exc.TimeoutError):
+        small_pool.connect()
+    connection.close()
+
+    stats = database.pool_stats(small_pool)
+    assert stats["checkouts"] == 1
+    assert stats["timeouts"] == 1
+    assert stats["max_wait_ms"] >= 50
+
+
+def test_connections_from_another_process_are_replaced(small_pool):
+    connection = small_pool.connect()
+    inherited = connection.connection.connection
+    # pretend the pooled connection was opened by a parent process
+    connection.connection.info["pid"] = os.getpid() + 1
+    connection.close()
+
+    connection = small_pool.connect()
+    assert connection.connection.connection is not inherited
+    assert connection.execute("SELECT 1").scalar() == 1
+    connection.close()
+
+
+@pytest.fixture
+def sqlite_engine(monkeypatch, tmp_path):
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT", "0.05")
+    engine = database.get_engine(f"sqlite:///{tmp_path / 'tuned.db'}")
+    yield engine
+    engine.dispose()
+
+
+def test_sqlite_connections_are_tuned(sqlite_engine):
+    connection = sqlite_engine.connect()
+    assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+    # NORMAL
+    assert connection.execute("PRAGMA synchronous").scalar() == 1
+    assert connection.execute("PRAGMA mmap_size").scalar() == 256 * 1024 * 1024
+    connection.close()
+
+
+def test_sqlite_transactions_take_the_write_lock_up_front(sqlite_engine):
+    holder = sqlite_engine.connect()
+    transaction = holder.begin()
+    holder.execute("SELECT 1")
+
+    waiter = sqlite_engine.connect()
+    with pytest.raises(exc.OperationalError, match="database is locked"):
+        waiter.begin()
+    # outside a transaction, readers aren't blocked by the writer
+    assert waiter.execute("SELECT 1").scalar() == 1
+    transaction.rollback()
+    holder.close()
+    waiter.close()
+
+
+def test_sqlite_is_chosen_by_configuration(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "allocation.db"))
+    assert database.get_engine().url.database == str(tmp_path / "allocation.db")
@@ -0,0 +1,17 @@
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters.dead_letters import DeadLetter, SqlAlchemyDeadLetterStore
+from allocation.domain import events
+
+
+def test_dead_letters_round_trip_through_the_database(sqlite_db):
+    store = SqlAlchemyDeadLetterStore(sessionmaker(bind=sqlite_db))
+    event = events.Allocated("o1", "sku1", 10, "b1")
+    store.add(DeadLetter(event, "handlers.publish", "ConnectionError()", 3))
+
+    [letter] = store.list()
+    assert letter.event == event
+    assert (letter.handler, letter.attempts) == ("handlers.publish", 3)
+
+    store.remove(letter)
+    assert store.list() == []
@@ -0,0 +1,113 @@
+import pytest
+from sqlalchemy import (
+    Column, Date, ForeignKey, Integer, MetaData, String, Table, create_engine,
+    inspect,
+)
+from sqlalchemy.exc import IntegrityError
+
+from allocation.adapters import migrations, orm
+from allocation.adapters.database import enable_sqlite_savepoints
+
+
+def index_names(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def version(engine):
+    with engine.connect() as connection:
+        return migrations.current_version(connection)
+
+
+def table_names(engine):
+    return set(inspect(engine).get_table_names())
+
+
+# the schema as the first create_all made it, before there were migrations
+baseline = MetaData()
+Table(
+    "order_lines", baseline,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("orderid", String(255)),
+)
+Table(
+    "products", baseline,
+    Column("sku", String(255), primary_key=True),
+    Column("version_number", Integer, nullable=False, server_default="0"),
+)
+Table(
+    "batches", baseline,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("ref", String(255)),
+    Column("sku", ForeignKey("products.sku")),
+    Column("_purchased_qty", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+)
+Table(
+    "allocations", baseline,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("batch_id", ForeignKey("batches.id")),
+    Column("order_line_id", ForeignKey("order_lines.id")),
+)
+
+
+@pytest.fixture
+def pre_migrations_db():
+    engine = enable_sqlite_savepoints(create_engine("sqlite://"))
+    baseline.create_all(engine)
+    engine.execute("INSERT INTO products (sku) VALUES ('sku1')")
+    return engine
+
+
+def test_new_databases_get_the_latest_schema():
+    engine = enable_sqlite_savepoints(create_engine("sqlite://"))
+    assert migrations.upgrade(engine) == [1, 2]
+    assert version(engine) == migrations.HEAD
+    assert table_names(engine) == set(orm.metadata.tables)
+    assert "ix_batches_ref" in index_names(engine, "batches")
+    assert migrations.upgrade(engine) == []
+
+
+def test_upgrades_an_existing_database_in_place(pre_migrations_db):
+    pre_migrations_db.execute(
+        "INSERT INTO batches (ref, sku, _purchased_qty) VALUES ('b1', 'sku1', 10)"
+    )
+    assert version(pre_migrations_db) is None
+
+    assert migrations.upgrade(pre_migrations_db) == [1, 2]
+
+    assert version(pre_migrations_db) == 2
+    assert table_names(pre_migrations_db) == set(orm.metadata.tables)
+    assert index_names(pre_migrations_db, "batches") == {
+        "ix_batches_ref", "ix_batches_sku",
+    }
+    assert index_names(pre_migrations_db, "allocations_view") == {
+        "ix_allocations_view_orderid_sku",
+    }
+    assert list(pre_migrations_db.execute("SELECT ref FROM batches")) == [("b1",)]
+    with pytest.raises(IntegrityError):
+        pre_migrations_db.execute(
+            "INSERT INTO batches (ref, sku, _purchased_qty)"
+            " VALUES ('b1', 'sku1', 10)"
+        )
+
+
+def test_can_stop_at_a_target_version(pre_migrations_db):
+    assert migrations.upgrade(pre_migrations_db, target=1) == [1]
+    assert table_names(pre_migrations_db) == set(orm.metadata.tables)
+    assert index_names(pre_migrations_db, "batches") == set()
+    assert migrations.upgrade(pre_migrations_db) == [2]
+
+
+def test_a_failed_upgrade_changes_nothing(pre_migrations_db):
+    pre_migrations_db.execute(
+        "INSERT INTO batches (ref, sku, _purchased_qty)"
+        " VALUES ('b1', 'sku1', 10), ('b1', 'sku1', 20)"
+    )
+    with pytest.raises(IntegrityError):
+        migrations.upgrade(pre_migrations_db)
+
+    assert version(pre_migrations_db) is None
+    assert index_names(pre_migrations_db, "batches") == set()
+    assert "outbox" not in table_names(pre_migrations_db)
@@ -0,0 +1,111 @@
+import json
+from datetime import timedelta
+
+import pytest
+
+from allocation.domain import commands, model
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import messagebus, unit_of_work
+from random_refs import random_element
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.published = []
+        self.round_trips = 0
+
+    def publish_many(self, messages):
+        self.round_trips += 1
+        self.published.extend(messages)
+
+
+def outbox_rows(session_factory):
+    return list(session_factory().execute(
+        "SELECT channel, payload, sent_at FROM outbox ORDER BY id"
+    ))
+
+
+def allocate_orders(session_factory, sku, orderids):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    batchref = random_element("batch")
+    messagebus.handle(commands.CreateBatch(batchref, sku, 100, None), uow)
+    for orderid in orderids:
+        messagebus.handle(commands.Allocate(orderid, sku, 1), uow)
+
+
+def test_allocated_events_are_written_to_the_outbox_on_commit(
+        sqlite_session_factory,
+):
+    sku, orderid = random_element("sku"), random_element("order")
+    allocate_orders(sqlite_session_factory, sku, [orderid])
+
+    [(channel, payload, sent_at)] = outbox_rows(sqlite_session_factory)
+    assert channel == "line_allocated"
+    assert json.loads(payload)["orderid"] == orderid
+    assert sent_at is None
+
+
+def test_nothing_reaches_the_outbox_without_a_commit(sqlite_session_factory):
+    sku = random_element("sku")
+    allocate_orders(sqlite_session_factory, sku, [])
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        uow.products.get(sku=sku).allocate(
+            model.Orderline(random_element("order"), sku, 1)
+        )
+    assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_relay_publishes_in_batches_and_marks_rows_sent(sqlite_session_factory):
+    sku = random_element("sku")
+    orderids = [random_element("order", str(i)) for i in range(5)]
+    allocate_orders(sqlite_session_factory, sku, orderids)
+    fake_redis = FakeRedis()
+
+    sent = [
+        outbox_relay.relay(
+            sqlite_session_factory, fake_redis.publish_many, batch_size=2,
+        )
+        for _ in range(4)
+    ]
+
+    assert sent == [2, 2, 1, 0]
+    assert fake_redis.round_trips == 3
+    assert [
+        json.loads(payload)["orderid"] for _, payload in fake_redis.published
+    ] == orderids
+    rows = outbox_rows(sqlite_session_factory)
+    assert all(sent_at for _, _, sent_at in rows)
+
+
+def test_relay_leaves_rows_unsent_if_publishing_fails(sqlite_session_factory):
+    allocate_orders(
+        sqlite_session_factory, random_element("sku"), [random_element("order")]
+    )
+
+    def broken_publish(messages):
+        raise ConnectionError("redis is down")
+
+    with pytest.raises(ConnectionError):
+        outbox_relay.relay(sqlite_session_factory, broken_publish)
+    [(_, _, sent_at)] = outbox_rows(sqlite_session_factory)
+    assert sent_at is None
+
+
+def test_prune_deletes_only_rows_sent_before_the_retention_period(
+        sqlite_session_factory,
+):
+    orderids = [random_element("order", str(i)) for i in range(5)]
+    allocate_orders(sqlite_session_factory, random_element("sku"), orderids)
+    outbox_relay.relay(
+        sqlite_session_factory, FakeRedis().publish_many, batch_size=3,
+    )
+
+    assert outbox_relay.prune(sqlite_session_factory, timedelta(days=1)) == 0
+    assert outbox_relay.prune(
+        sqlite_session_factory, timedelta(0), batch_size=2,
+    ) == 3
+    assert [sent_at for _, _, sent_at in outbox_rows(sqlite_session_factory)] == [
+        None, None,
+    ]
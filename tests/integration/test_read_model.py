@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+from allocation import bootstrap, views
+from allocation.domain import commands, events
+from allocation.service_layer import read_model, unit_of_work
+
+
+class CountingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+
+    def __init__(self, session_factory):
+        super().__init__(session_factory)
+        self.commits = 0
+
+    def _commit(self):
+        self.commits += 1
+        super()._commit()
+
+
+@pytest.fixture
+def batcher():
+    return read_model.ReadModelBatcher(max_count=100, max_age=60)
+
+
+@pytest.fixture
+def bus(sqlite_session_factory, batcher):
+    return bootstrap.bootstrap(start_orm=False, read_model_batcher=batcher)
+
+
+def test_read_model_is_written_once_per_handle(sqlite_session_factory, bus):
+    uow = CountingUnitOfWork(sqlite_session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 100, None), uow)
+    lines = [commands.Allocate(f"o{i}", "sku1", 1) for i in range(10)]
+    commits = uow.commits
+    bus.handle(commands.AllocateMany(lines), uow)
+
+    # one for the allocation, one for the whole read model flush
+    assert uow.commits - commits == 2
+    assert views.allocations("o7", uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_flush_applies_updates_for_an_order_in_order(
+        sqlite_session_factory, batcher,
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    batcher.add_allocation(events.Allocated("o1", "sku1", 10, "b1"), uow)
+    batcher.remove_allocation(events.Deallocated("o1", "sku1", 10), uow)
+    batcher.add_allocation(events.Allocated("o1", "sku1", 10, "b2"), uow)
+    batcher.add_allocation(events.Allocated("o2", "sku1", 10, "b2"), uow)
+
+    assert batcher.flush(uow) == 4
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b2"}]
+
+
+def test_flushes_early_when_the_batch_is_full(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    batcher = read_model.ReadModelBatcher(max_count=2, max_age=60)
+    batcher.add_allocation(events.Allocated("o1", "sku1", 1, "b1"), uow)
+    assert len(batcher) == 1
+    batcher.add_allocation(events.Allocated("o2", "sku1", 1, "b1"), uow)
+    assert len(batcher) == 0
+    assert views.allocations("o2", uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_flushes_early_when_the_oldest_update_is_too_old(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    now = [0.0]
+    batcher = read_model.ReadModelBatcher(
+        max_count=100, max_age=1, clock=lambda: now[0],
+    )
+    batcher.add_allocation(events.Allocated("o1", "sku1", 1, "b1"), uow)
+    now[0] = 2
+    batcher.add_allocation(events.Allocated("o2", "sku1", 1, "b1"), uow)
+    assert len(batcher) == 0
+
+
+def test_failed_flush_keeps_updates_queued(sqlite_session_factory, batcher):
+    batcher.add_allocation(
+        events.Allocated("o1", "sku1", 1, "b1"),
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+    )
+
+    class BrokenUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+        def _commit(self):
+            raise ConnectionError("database went away")
+
+    with pytest.raises(ConnectionError):
+        batcher.flush(BrokenUnitOfWork(sqlite_session_factory))
+    assert len(batcher) == 1
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    assert batcher.flush(uow) == 1
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_a_failed_flush_cannot_overwrite_newer_updates(
+        sqlite_session_factory, batcher,
+):
+    batcher.add_allocation(
+        events.Allocated("o1", "sku1", 1, "b1"),
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+    )
+    committing, release = threading.Event(), threading.Event()
+
+    class SlowBrokenUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+        def _commit(self):
+            committing.set()
+            release.wait(5)
+            raise ConnectionError("database went away")
+
+    def failing_flush():
+        with pytest.raises(ConnectionError):
+            batcher.flush(SlowBrokenUnitOfWork(sqlite_session_factory))
+
+    flushed = []
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    first = threading.Thread(target=failing_flush)
+    first.start()
+    committing.wait(5)
+    # newer updates for the same order, flushed while the first flush hangs
+    batcher.remove_allocation(events.Deallocated("o1", "sku1", 1), uow)
+    batcher.add_allocation(events.Allocated("o1", "sku1", 1, "b2"), uow)
+    second = threading.Thread(target=lambda: flushed.append(batcher.flush(uow)))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert flushed == [3]
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b2"}]
@@ -1,4 +1,8 @@
+import pytest
+from sqlalchemy import event
+
 from allocation.adapters import repository
+from allocation.adapters.cache import BatchrefCache
 from allocation.domain import model
 
 
@@ -13,3 +17,192 @@ def test_get_by_batchref(sqlite_session):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_allocated_quantity_is_recounted_after_loading(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SQLAlchemyRepository(session)
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    repo.add(model.Product(sku="sku1", batches=[batch]))
+    batch.allocate(model.Orderline("o1", "sku1", 10))
+    batch.allocate(model.Orderline("o2", "sku1", 15))
+    session.commit()
+
+    repo = repository.SQLAlchemyRepository(sqlite_session_factory())
+    [loaded] = repo.get("sku1").batches
+    assert loaded.allocated_quantity == 25
+    loaded.deallocate(model.Orderline("o1", "sku1", 10))
+    assert loaded.available_quantity == 85
+
+
+def test_product_indexes_are_rebuilt_after_loading(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SQLAlchemyRepository(session)
+    product = model.Product(sku="sku1", batches=[
+        model.Batch(ref="b1", sku="sku1", qty=10, eta=None),
+        model.Batch(ref="b2", sku="sku1", qty=10, eta=None),
+    ])
+    repo.add(product)
+    product.allocate(model.Orderline("o1", "sku1", 10))
+    session.commit()
+
+    repo = repository.SQLAlchemyRepository(sqlite_session_factory())
+    loaded = repo.get("sku1")
+    assert loaded.get_batch("b2").ref == "b2"
+    batch, line = loaded.get_allocation("o1")
+    assert batch.ref == "b1"
+    assert line == model.Orderline("o1", "sku1", 10)
+
+
+def test_loaded_order_lines_share_their_sku_string(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repository.SQLAlchemyRepository(session).add(model.Product(
+        sku="sku1",
+        batches=[model.Batch(ref="b1", sku="sku1", qty=100, eta=None)],
+    ))
+    session.commit()
+    session.execute(
+        "INSERT INTO order_lines (id, orderid, sku, qty) VALUES "
+        "(1, 'o1', 'sku1', 1), (2, 'o2', 'sku1', 1)"
+    )
+    session.execute(
+        "INSERT INTO allocations (batch_id, order_line_id) VALUES (1, 1), (1, 2)"
+    )
+    session.commit()
+
+    product = repository.SQLAlchemyRepository(sqlite_session_factory()).get("sku1")
+    line1, line2 = product.batches[0]._allocations
+    assert line1.sku is line2.sku
+
+
+def count_selects(engine, do):
+    selects = []
+
+    def record(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        do()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return len(selects)
+
+
+def allocate_against_product_with(batch_count, session_factory, engine, strategy):
+    session = session_factory()
+    sku = f"sku-{strategy}-{batch_count}"
+    batches = [
+        model.Batch(ref=f"{sku}-b{i}", sku=sku, qty=100, eta=None)
+        for i in range(batch_count)
+    ]
+    for i, batch in enumerate(batches):
+        batch.allocate(model.Orderline(f"{sku}-o{i}", sku, 1))
+    session.add(model.Product(sku=sku, batches=batches))
+    session.commit()
+
+    def allocate():
+        session = session_factory()
+        repo = repository.SQLAlchemyRepository(
+            session, loading=dict(get=strategy)
+        )
+        repo.get(sku).allocate(model.Orderline(f"{sku}-new", sku, 1))
+        session.commit()
+
+    return count_selects(engine, allocate)
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined"])
+def test_allocate_uses_a_constant_number_of_selects(
+        sqlite_db, sqlite_session_factory, strategy,
+):
+    few = allocate_against_product_with(
+        2, sqlite_session_factory, sqlite_db, strategy
+    )
+    many = allocate_against_product_with(
+        50, sqlite_session_factory, sqlite_db, strategy
+    )
+    assert few == many
+    assert many <= 3
+
+
+def test_lazy_loading_queries_once_per_batch(sqlite_db, sqlite_session_factory):
+    few = allocate_against_product_with(
+        2, sqlite_session_factory, sqlite_db, "lazy"
+    )
+    many = allocate_against_product_with(
+        50, sqlite_session_factory, sqlite_db, "lazy"
+    )
+    assert many - few == 48
+
+
+class RecordingRepository(repository.SQLAlchemyRepository):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.locked = []
+
+    def _get(self, sku):
+        self.locked.append(sku)
+        return super()._get(sku)
+
+
+def add_products_with_batches(session_factory):
+    session = session_factory()
+    session.add(model.Product(sku="sku1", batches=[
+        model.Batch(ref="b1", sku="sku1", qty=100, eta=None),
+    ]))
+    session.add(model.Product(sku="sku2", batches=[
+        model.Batch(ref="b2", sku="sku2", qty=100, eta=None),
+    ]))
+    session.commit()
+
+
+def test_get_by_batchref_resolves_the_sku_and_loads_like_get(
+        sqlite_db, sqlite_session_factory,
+):
+    add_products_with_batches(sqlite_session_factory)
+    repo = RecordingRepository(sqlite_session_factory())
+
+    selects = count_selects(sqlite_db, lambda: repo.get_by_batchref("b2"))
+
+    assert repo.locked == ["sku2"]
+    # the sku, then the product with its batches and their allocations
+    assert selects == 4
+    assert repo.get_by_batchref("nope") is None
+
+
+def test_cached_batchrefs_skip_the_sku_lookup(sqlite_db, sqlite_session_factory):
+    add_products_with_batches(sqlite_session_factory)
+    batchrefs = BatchrefCache()
+    session = sqlite_session_factory()
+    repository.SQLAlchemyRepository(
+        session, batchrefs=batchrefs,
+    ).get_by_batchref("b1")
+    session.close()
+
+    repo = repository.SQLAlchemyRepository(
+        sqlite_session_factory(), batchrefs=batchrefs,
+    )
+    product = None
+
+    def get():
+        nonlocal product
+        product = repo.get_by_batchref("b1")
+
+    assert count_selects(sqlite_db, get) == 3
+    assert product.sku == "sku1"
+    assert batchrefs.stats()["hits"] == 1
+
+
+def test_a_wrong_cached_sku_is_looked_up_again(sqlite_session_factory):
+    add_products_with_batches(sqlite_session_factory)
+    batchrefs = BatchrefCache()
+    # as if cached from a transaction that was then rolled back
+    batchrefs.put("b1", "sku2")
+    repo = repository.SQLAlchemyRepository(
+        sqlite_session_factory(), batchrefs=batchrefs,
+    )
+    assert repo.get_by_batchref("b1").sku == "sku1"
+    assert batchrefs.get("b1") == "sku1"
@@ -4,9 +4,11 @@ from typing import AnyStr, List
 
 import pytest
 import time
+from sqlalchemy import event, exc
 
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation import bootstrap
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
 from random_refs import *
 
 
@@ -36,10 +38,11 @@ def get_allocated_batch_ref(session, orderid, sku):
     return batchref
 
 
-def try_to_allocate(orderid: AnyStr, sku: AnyStr, exceptions: List):
+def try_to_allocate(orderid: AnyStr, sku: AnyStr, exceptions: List,
+                    session_factory=unit_of_work.DEFAULT_SESSION_FACTORY):
     line = model.Orderline(orderid, sku, 10)
     try:
-        with unit_of_work.SqlAlchemyUnitOfWork() as uow:
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
             product = uow.products.get(sku=sku)
             product.allocate(line)
             time.sleep(0.1)
@@ -65,6 +68,29 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(sqlite_session_factory):
     assert batchref == "batch1"
 
 
+def test_allocate_many_commits_one_transaction_per_sku(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None)
+    insert_batch(session, "batch2", "sku-002", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    handlers.allocate_many(commands.AllocateMany([
+        commands.Allocate("order-01", "sku-001", 10),
+        commands.Allocate("order-01", "sku-002", 10),
+        commands.Allocate("order-02", "sku-001", 10),
+    ]), uow)
+
+    assert get_allocated_batch_ref(session, "order-01", "sku-001") == "batch1"
+    assert get_allocated_batch_ref(session, "order-01", "sku-002") == "batch2"
+    assert get_allocated_batch_ref(session, "order-02", "sku-001") == "batch1"
+    assert len(list(uow.collect_new_events())) == 3
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='sku-001'"
+    )
+    assert version == 2
+
+
 def test_rolls_back_uncommitted_work_by_default(sqlite_session_factory):
     uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
     with uow:
@@ -89,6 +115,292 @@ def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+def test_chained_blocks_share_one_session_and_identity_map(
+        sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow.chain():
+        with uow:
+            product = uow.products.get(sku="sku-001")
+            product.allocate(model.Orderline("order-01", "sku-001", 10))
+            uow.commit()
+        first_session = uow.session
+        with uow:
+            assert uow.session is first_session
+            assert uow.products.get(sku="sku-001") is product
+            product.allocate(model.Orderline("order-02", "sku-001", 10))
+            uow.commit()
+
+    assert get_allocated_batch_ref(session, "order-02", "sku-001") == "batch1"
+
+
+def test_chained_rollback_only_undoes_its_own_block(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow.chain():
+        with uow:
+            insert_batch(uow.session, "batch-01", "sku-001", 100, None)
+            uow.commit()
+        with uow:
+            insert_batch(uow.session, "batch-02", "sku-002", 100, None)
+
+    new_session = sqlite_session_factory()
+    rows = list(new_session.execute("SELECT ref FROM batches"))
+    assert rows == [("batch-01",)]
+
+
+def test_bus_can_handle_a_whole_chain_in_one_session(sqlite_session_factory):
+    opened = []
+
+    def counting_session_factory():
+        opened.append(sqlite_session_factory())
+        return opened[-1]
+
+    bus = bootstrap.bootstrap(start_orm=False, chain_sessions=True)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(counting_session_factory)
+    bus.handle(commands.CreateBatch("batch1", "sku-001", 100, None), uow)
+    opened.clear()
+    # the allocation and the read model insert for its Allocated event
+    bus.handle(commands.Allocate("order-01", "sku-001", 10), uow)
+
+    assert len(opened) == 1
+    assert get_allocated_batch_ref(
+        sqlite_session_factory(), "order-01", "sku-001"
+    ) == "batch1"
+
+
+def test_chain_carries_on_after_a_block_fails_to_flush(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None)
+    session.commit()
+    session.close()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow.chain():
+        with uow:
+            product = uow.products.get(sku="sku-001")
+            product.allocate(model.Orderline("order-01", "sku-001", 10))
+            uow.commit()
+        with pytest.raises(exc.IntegrityError), uow:
+            product = uow.products.get(sku="sku-001")
+            product.add_batch(model.Batch("batch1", "sku-001", 10, eta=None))
+            uow.commit()
+        with uow:
+            product = uow.products.get(sku="sku-001")
+            product.allocate(model.Orderline("order-02", "sku-001", 10))
+            uow.commit()
+
+    session = sqlite_session_factory()
+    assert get_allocated_batch_ref(session, "order-01", "sku-001") == "batch1"
+    assert get_allocated_batch_ref(session, "order-02", "sku-001") == "batch1"
+    session.close()
+
+
+def test_optimistic_conflicts_in_a_chain_can_be_retried(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None, product_version=1)
+    session.commit()
+    session.close()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, optimistic=True,
+    )
+    conflicts = 0
+    with uow.chain():
+        with uow:
+            product = uow.products.get(sku="sku-001")
+            product.allocate(model.Orderline("order-01", "sku-001", 10))
+            uow.commit()
+        for attempt in range(2):
+            try:
+                with uow:
+                    product = uow.products.get(sku="sku-001")
+                    product.allocate(model.Orderline("order-02", "sku-001", 10))
+                    if attempt == 0:
+                        # as if another transaction had committed meanwhile
+                        uow.session.execute(
+                            "UPDATE products SET version_number = version_number + 1"
+                        )
+                    uow.commit()
+                break
+            except unit_of_work.ConcurrencyConflict:
+                conflicts += 1
+
+    assert conflicts == 1
+    session = sqlite_session_factory()
+    assert get_allocated_batch_ref(session, "order-01", "sku-001") == "batch1"
+    assert get_allocated_batch_ref(session, "order-02", "sku-001") == "batch1"
+    session.close()
+
+
+def test_optimistic_commit_conflicts_if_the_version_moved_on(
+        sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None, product_version=1)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, optimistic=True,
+    )
+    with uow:
+        product = uow.products.get(sku="sku-001")
+        # as if another transaction had committed a change meanwhile
+        uow.session.execute(
+            "UPDATE products SET version_number = 2 WHERE sku = 'sku-001'"
+        )
+        product.allocate(model.Orderline("order-01", "sku-001", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow.commit()
+        assert list(product.events) == []
+
+    assert list(session.execute("SELECT * FROM allocations")) == []
+
+
+def test_bus_retries_a_command_that_lost_a_race(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None, product_version=1)
+    session.commit()
+
+    def concurrent_change(session, flush_context, instances):
+        session.execute(
+            "UPDATE products SET version_number = version_number + 1"
+            " WHERE sku = 'sku-001'"
+        )
+
+    event.listen(sqlite_session_factory, "before_flush", concurrent_change,
+                 once=True)
+    bus = bootstrap.bootstrap(start_orm=False)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, optimistic=True,
+    )
+    bus.handle(commands.Allocate("order-01", "sku-001", 10), uow)
+
+    session = sqlite_session_factory()
+    assert get_allocated_batch_ref(session, "order-01", "sku-001") == "batch1"
+    # the fake concurrent change was rolled back with the first attempt
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='sku-001'"
+    )
+    assert version == 2
+
+
+def test_sqlite_runs_concurrent_allocations_one_after_the_other(
+        sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None, product_version=1)
+    session.commit()
+    session.close()
+
+    # no FOR UPDATE in sqlite; BEGIN IMMEDIATE makes the second transaction
+    # wait for the first to commit, rather than both reading version 1
+    exceptions = []  # type: List[Exception]
+    threads = [
+        threading.Thread(target=try_to_allocate,
+                         args=(orderid, "sku-001", exceptions,
+                               sqlite_session_factory))
+        for orderid in ("order1", "order2")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='sku-001'"
+    )
+    assert version == 3
+    [[allocated]] = session.execute("SELECT count(*) FROM allocations")
+    assert allocated == 2
+    session.close()
+
+
+def test_allocate_many_retries_only_the_sku_that_lost_a_race(
+        sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "sku-001", 100, None, product_version=1)
+    insert_batch(session, "batch2", "sku-002", 100, None, product_version=1)
+    session.commit()
+    session.close()
+
+    raced = []
+
+    def concurrent_change(session, flush_context, instances):
+        if not raced and any(
+            getattr(product, "sku", None) == "sku-002" for product in session.dirty
+        ):
+            raced.append(True)
+            session.execute(
+                "UPDATE products SET version_number = version_number + 1"
+                " WHERE sku = 'sku-002'"
+            )
+
+    event.listen(sqlite_session_factory, "before_flush", concurrent_change)
+    bus = bootstrap.bootstrap(start_orm=False)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, optimistic=True,
+    )
+    bus.handle(commands.AllocateMany([
+        commands.Allocate("order-01", "sku-001", 10),
+        commands.Allocate("order-02", "sku-002", 10),
+    ]), uow)
+
+    assert raced
+    session = sqlite_session_factory()
+    assert get_allocated_batch_ref(session, "order-01", "sku-001") == "batch1"
+    assert get_allocated_batch_ref(session, "order-02", "sku-002") == "batch2"
+    # each Allocated was published once, the first sku's too
+    assert sorted(session.execute("SELECT orderid FROM allocations_view")) == [
+        ("order-01",), ("order-02",),
+    ]
+    [[allocated]] = session.execute("SELECT count(*) FROM outbox")
+    assert allocated == 2
+    session.close()
+
+
+def try_to_allocate_optimistically(orderid: AnyStr, sku: AnyStr, exceptions: List):
+    bus = bootstrap.bootstrap(start_orm=False)
+    try:
+        bus.handle(
+            commands.Allocate(orderid, sku, 10),
+            unit_of_work.SqlAlchemyUnitOfWork(optimistic=True),
+        )
+    except Exception as e:
+        print(traceback.format_exc())
+        exceptions.append(e)
+
+
+def test_concurrent_optimistic_allocations_are_retried(postgres_session_factory):
+    sku, batch = random_element("sku"), random_element("batch")
+    session = postgres_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []  # type: List[Exception]
+    threads = [
+        threading.Thread(target=try_to_allocate_optimistically,
+                         args=(random_element("order"), sku, exceptions))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku",
+        dict(sku=sku),
+    )
+    assert version == 3
+
+
 def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory):
     sku, batch = random_element("sku"), random_element("batch")
     session = postgres_session_factory()
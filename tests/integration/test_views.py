@@ -25,3 +25,56 @@ def test_allocations_view(sqlite_session_factory):
         {"sku": "sku1", "batchref": "batch1"},
         {"sku": "sku2", "batchref": "batch2"},
     ]
+
+
+def add_batches(uow, count):
+    for i in range(count):
+        messagebus.handle(
+            commands.CreateBatch(f"batch{i:03}", f"sku{i % 3}", 10 + i, None),
+            uow,
+        )
+
+
+def test_batches_are_paged_by_keyset(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    add_batches(uow, 25)
+
+    refs, cursor, pages = [], 0, 0
+    while cursor is not None:
+        rows, cursor = views.batches_page(uow, after=cursor, limit=10)
+        refs.extend(row["ref"] for row in rows)
+        pages += 1
+
+    assert refs == [f"batch{i:03}" for i in range(25)]
+    assert pages == 3
+
+
+def test_batches_stream_does_not_load_products(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    add_batches(uow, 5)
+
+    rows = list(views.stream_batches(uow, chunk_size=2))
+
+    assert rows[0] == dict(ref="batch000", sku="sku0", qty=10, eta=None)
+    assert [row["ref"] for row in rows] == [f"batch{i:03}" for i in range(5)]
+    assert uow.products.seen == set()
+
+
+def test_writes_go_ahead_while_a_stream_is_being_read(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    add_batches(uow, 5)
+    rows = views.stream_batches(
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, read_only=True),
+        chunk_size=2,
+    )
+    first = next(rows)
+
+    # the stream's transaction is still open, but hasn't taken the write lock
+    messagebus.handle(commands.Allocate("order1", "sku0", 5), uow)
+
+    assert views.allocations("order1", uow) == [
+        {"sku": "sku0", "batchref": "batch000"},
+    ]
+    assert [first["ref"]] + [row["ref"] for row in rows] == [
+        f"batch{i:03}" for i in range(5)
+    ]
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import List
+
+from allocation.domain import commands, events
+from allocation.service_layer import async_messagebus, retries, unit_of_work
+
+
+class FakeProduct:
+
+    def __init__(self, pending):
+        self.events = deque(pending)
+
+
+class FakeRepository:
+
+    def __init__(self):
+        self.seen = set()
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+
+    def __init__(self):
+        self.products = FakeRepository()
+
+    def _commit(self): ...
+
+    def rollback(self): ...
+
+
+@dataclass
+class Ping(commands.Command):
+    times: int
+
+
+def raise_messages(uow, *messages):
+    uow.products.seen.add(FakeProduct(messages))
+
+
+def test_handlers_for_one_event_run_concurrently():
+    started = []  # type: List[str]
+
+    async def handler(name, event, uow):
+        started.append(name)
+        while len(started) < 2:
+            await asyncio.sleep(0)
+
+    async def first(event, uow):
+        await handler("first", event, uow)
+
+    async def second(event, uow):
+        await handler("second", event, uow)
+
+    bus = async_messagebus.AsyncMessageBus(
+        {events.OutOfStock: [first, second]}, {}, uow_factory=FakeUnitOfWork,
+    )
+    asyncio.run(asyncio.wait_for(bus.handle(events.OutOfStock("sku")), 1))
+    assert sorted(started) == ["first", "second"]
+
+
+def test_sync_handlers_run_on_an_executor_thread():
+    threads = []
+
+    def sync_handler(event, uow):
+        threads.append(threading.get_ident())
+
+    bus = async_messagebus.AsyncMessageBus(
+        {events.OutOfStock: [sync_handler]}, {}, uow_factory=FakeUnitOfWork,
+    )
+    asyncio.run(bus.handle(events.OutOfStock("sku")))
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_messages_raised_by_handlers_are_handled_in_order():
+    handled = []  # type: List[int]
+
+    async def ping(cmd, uow):
+        handled.append(cmd.times)
+        if cmd.times:
+            raise_messages(uow, Ping(cmd.times - 1))
+        return cmd.times
+
+    bus = async_messagebus.AsyncMessageBus({}, {Ping: ping}, FakeUnitOfWork)
+    results = asyncio.run(bus.handle(Ping(3)))
+    assert handled == [3, 2, 1, 0]
+    assert results == [3, 2, 1, 0]
+
+
+def test_each_handler_gets_its_own_unit_of_work():
+    uows = []
+
+    def record(event, uow):
+        uows.append(uow)
+
+    bus = async_messagebus.AsyncMessageBus(
+        {events.OutOfStock: [record, lambda e, uow: record(e, uow)]},
+        {},
+        uow_factory=FakeUnitOfWork,
+    )
+    asyncio.run(bus.handle(events.OutOfStock("sku")))
+    assert len(uows) == 2 and uows[0] is not uows[1]
+
+
+def test_dead_letters_can_be_replayed():
+    failing = [True]
+
+    @retries.retry_policy(attempts=1)
+    def flaky(event, uow):
+        if failing[0]:
+            raise ConnectionError("smtp is down")
+        raise_messages(uow, Ping(0))
+
+    pinged = []
+    bus = async_messagebus.AsyncMessageBus(
+        {events.OutOfStock: [flaky]},
+        {Ping: lambda cmd, uow: pinged.append(cmd)},
+        uow_factory=FakeUnitOfWork,
+    )
+    asyncio.run(bus.handle(events.OutOfStock("sku")))
+    [letter] = bus.dead_letters.list()
+    assert letter.handler.endswith("flaky")
+
+    failing[0] = False
+    assert asyncio.run(bus.replay_dead_letters()) == 1
+    assert bus.dead_letters.list() == []
+    assert pinged == [Ping(0)]
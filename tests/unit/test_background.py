@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from allocation.service_layer import background
+
+
+def blocked_pool(**kwargs):
+    release = threading.Event()
+    started = threading.Event()
+    pool = background.BackgroundWorkerPool(workers=1, **kwargs)
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    pool.submit(blocker)
+    started.wait(5)
+    return pool, release
+
+
+def test_runs_submitted_tasks_and_drains_on_shutdown():
+    done = []
+    pool = background.BackgroundWorkerPool(workers=2, queue_size=100)
+    for i in range(50):
+        pool.submit(lambda i=i: done.append(i))
+    assert pool.shutdown(timeout=5)
+    assert sorted(done) == list(range(50))
+    assert pool.stats()["completed"] == 50
+    assert pool.stats()["queue_depth"] == 0
+
+
+def test_drop_newest_rejects_when_the_queue_is_full():
+    done = []
+    pool, release = blocked_pool(queue_size=1, overflow=background.DROP_NEWEST)
+    assert pool.submit(lambda: done.append("queued"))
+    assert not pool.submit(lambda: done.append("rejected"))
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["queue_depth"] == 1
+    release.set()
+    pool.shutdown(timeout=5)
+    assert done == ["queued"]
+
+
+def test_drop_oldest_makes_room_for_the_new_task():
+    done = []
+    pool, release = blocked_pool(queue_size=1, overflow=background.DROP_OLDEST)
+    pool.submit(lambda: done.append("old"))
+    assert pool.submit(lambda: done.append("new"))
+    release.set()
+    pool.shutdown(timeout=5)
+    assert done == ["new"]
+    assert pool.stats()["rejected"] == 1
+
+
+def test_caller_runs_when_the_queue_is_full():
+    ran_on = []
+    pool, release = blocked_pool(queue_size=1, overflow=background.CALLER_RUNS)
+    pool.submit(lambda: None)
+    pool.submit(lambda: ran_on.append(threading.current_thread()))
+    assert ran_on == [threading.current_thread()]
+    assert pool.stats()["ran_inline"] == 1
+    release.set()
+    pool.shutdown(timeout=5)
+
+
+def test_failing_tasks_are_counted_and_do_not_kill_workers():
+    done = []
+    pool = background.BackgroundWorkerPool(workers=1)
+    pool.submit(lambda: 1 / 0)
+    pool.submit(lambda: done.append(True))
+    pool.shutdown(timeout=5)
+    assert done == [True]
+    assert pool.stats()["failed"] == 1
+
+
+def test_rejects_work_after_shutdown():
+    pool = background.BackgroundWorkerPool(workers=1)
+    pool.shutdown()
+    with pytest.raises(background.PoolClosed):
+        pool.submit(lambda: None)
+
+
+def test_shutdown_returns_within_its_timeout():
+    release = threading.Event()
+    pool = background.BackgroundWorkerPool(workers=4, queue_size=4)
+    for _ in range(8):
+        pool.submit(lambda: release.wait(1))
+
+    start = time.monotonic()
+    assert not pool.shutdown(timeout=0.1)
+    assert time.monotonic() - start < 0.5
+    release.set()
@@ -1,3 +1,4 @@
+import random
 from datetime import date, timedelta
 
 from allocation.domain.model import Batch, Orderline
@@ -45,3 +46,31 @@ def test_can_only_deallocate_allocated_lines():
     batch, line = make_batch_and_line("SKU-0101", 20, 8)
     batch.deallocate(line)
     assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_matches_a_full_recount_under_random_operations():
+    rnd = random.Random(42)
+    batch = Batch("Batch 001", "SKU-0101", 1000)
+    lines = [Orderline(f"order-{i}", "SKU-0101", rnd.randint(1, 50))
+             for i in range(200)]
+    for _ in range(2000):
+        operation = rnd.choice(["allocate", "deallocate", "deallocate_one"])
+        if operation == "allocate":
+            batch.allocate(rnd.choice(lines))
+        elif operation == "deallocate":
+            batch.deallocate(rnd.choice(lines))
+        elif batch._allocations:
+            batch.deallocate_one()
+        recount = sum(line.qty for line in batch._allocations)
+        assert batch.allocated_quantity == recount
+        assert batch.available_quantity == 1000 - recount
+
+
+def test_order_lines_share_their_sku_string():
+    line1 = Orderline("order-1", "".join(["SKU-", "0101"]), 1)
+    line2 = Orderline("order-2", "".join(["SKU-", "0101"]), 1)
+    assert line1.sku is line2.sku
+
+
+def test_order_lines_accept_skus_that_are_not_strings():
+    assert Orderline("order-1", 101, 1).sku == 101
@@ -4,10 +4,12 @@ from unittest import mock
 
 import pytest
 
+from allocation import bootstrap
 from allocation.adapters.repository import AbstractRepository
 from allocation.domain import events, commands
+from allocation.domain import model
 from allocation.domain.model import Product
-from allocation.service_layer import unit_of_work, messagebus, handlers
+from allocation.service_layer import unit_of_work, messagebus, handlers, retries
 
 TODAY = datetime.today()
 TOMORROW = TODAY + timedelta(days=1)
@@ -55,7 +57,7 @@ class FakeUnitOfWorkWithFakeMessageBus(FakeUnitOfWork):
     def publish_events(self):
         for product in self.products.seen:
             while product.events:
-                self.events_published.append(product.events.pop(0))
+                self.events_published.append(product.events.popleft())
 
 
 class TestAddBatch:
@@ -72,12 +74,6 @@ class TestAddBatch:
         assert "b2" in [b.ref for b in uow.products.get("sku-1").batches]
 
 
-@pytest.fixture(autouse=True)
-def fake_redis_publish():
-    with mock.patch("allocation.adapters.redis_eventpublisher.publish"):
-        yield
-
-
 class TestAllocate:
     def test_allocates(self):
         uow = FakeUnitOfWork()
@@ -115,6 +111,57 @@ class TestAllocate:
             )
 
 
+class TestAllocateMany:
+    def test_allocates_lines_across_skus_in_order(self):
+        uow = FakeUnitOfWork()
+        messagebus.handle(commands.CreateBatch("b1", "sku1", 100, None), uow)
+        messagebus.handle(commands.CreateBatch("b2", "sku2", 10, None), uow)
+
+        [results] = messagebus.handle(commands.AllocateMany([
+            commands.Allocate("o1", "sku1", 30),
+            commands.Allocate("o1", "sku2", 10),
+            commands.Allocate("o2", "sku1", 20),
+            commands.Allocate("o2", "sku2", 5),
+        ]), uow)
+
+        assert results == ["b1", "b2", "b1", None]
+        assert uow.products.get("sku1").batches[0].available_quantity == 50
+        assert uow.products.get("sku2").batches[0].available_quantity == 0
+        assert uow.committed
+
+    def test_sends_email_for_each_line_out_of_stock(self):
+        uow = FakeUnitOfWork()
+        messagebus.handle(commands.CreateBatch("b1", "sku1", 10, None), uow)
+
+        with mock.patch("allocation.adapters.email.send") as mock_send_mail:
+            messagebus.handle(commands.AllocateMany([
+                commands.Allocate("o1", "sku1", 20),
+                commands.Allocate("o2", "sku1", 20),
+            ]), uow)
+            assert mock_send_mail.call_count == 2
+
+    def test_errors_for_invalid_sku(self):
+        uow = FakeUnitOfWork()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku sku1!"):
+            messagebus.handle(
+                commands.AllocateMany([commands.Allocate("o1", "sku1", 1)]),
+                uow,
+            )
+
+    def test_allocates_nothing_if_any_sku_is_invalid(self):
+        uow = FakeUnitOfWork()
+        messagebus.handle(commands.CreateBatch("b1", "sku1", 10, None), uow)
+        uow.committed = False
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku sku2!"):
+            messagebus.handle(commands.AllocateMany([
+                commands.Allocate("o1", "sku1", 1),
+                commands.Allocate("o2", "sku2", 1),
+            ]), uow)
+        assert not uow.committed
+        assert uow.products.get("sku1").batches[0].available_quantity == 10
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         uow = FakeUnitOfWork()
@@ -145,3 +192,36 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+    def test_errors_for_invalid_batchref(self):
+        uow = FakeUnitOfWork()
+        messagebus.handle(commands.CreateBatch("b1", "sku-001", 100), uow)
+        with pytest.raises(handlers.InvalidBatchref, match="Invalid batch ref b2!"):
+            messagebus.handle(commands.ChangeBatchQuantity("b2", 50), uow)
+
+    def test_uses_the_deallocation_policy_it_was_bootstrapped_with(self):
+        uow = FakeUnitOfWork()
+        bus = bootstrap.bootstrap(
+            start_orm=False, deallocation_policy=model.smallest_overshoot,
+        )
+        for message in [
+            commands.CreateBatch("b1", "sku-001", 60),
+            commands.CreateBatch("b2", "sku-001", 60, TOMORROW),
+            commands.Allocate("small", "sku-001", 5),
+            commands.Allocate("big", "sku-001", 50),
+        ]:
+            bus.handle(message, uow)
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 54), uow)
+
+        product = uow.products.get(sku="sku-001")
+        assert product.get_allocation("small")[0].ref == "b2"
+        assert product.get_allocation("big")[0].ref == "b1"
+
+    def test_injected_handlers_keep_their_retry_policy(self):
+        handler = bootstrap.inject(
+            handlers.change_batch_quantity, policy=model.fewest_lines,
+        )
+        assert retries.policy_for(handler) is handlers.CONFLICT_RETRIES
+        assert (retries.handler_name(handler)
+                == retries.handler_name(handlers.change_batch_quantity))
@@ -0,0 +1,159 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from allocation import bootstrap
+from allocation.adapters.memory_store import InMemoryStore, LockTimeout, SnapshotWriter
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, messagebus, unit_of_work
+
+
+@pytest.fixture
+def bus():
+    # the read model lives in SQL, there is nothing to keep in memory
+    with mock.patch("allocation.adapters.email.send"):
+        yield bootstrap.bootstrap(start_orm=False, event_handlers={
+            **messagebus.EVENT_HANDLERS,
+            events.Allocated: [],
+            events.Deallocated: [handlers.reallocate],
+        })
+
+
+def test_handles_commands_against_the_store(bus):
+    store = InMemoryStore()
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    bus.handle(commands.CreateBatch("b1", "sku1", 100, None), uow)
+    bus.handle(commands.CreateBatch("b2", "sku1", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "sku1", 60), uow)
+    bus.handle(commands.ChangeBatchQuantity("b1", 50), uow)
+
+    product = store.get("sku1")
+    assert store.sku_for("b2") == "sku1"
+    assert product.get_batch("b1").available_quantity == 50
+    assert product.get_batch("b2").available_quantity == 40
+    assert product.version_number == 5
+
+
+def test_uncommitted_changes_are_rolled_back():
+    store = InMemoryStore([model.Product("sku1", [
+        model.Batch("b1", "sku1", 100, eta=None),
+    ])])
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    with uow:
+        product = uow.products.get("sku1")
+        product.allocate(model.Orderline("o1", "sku1", 10))
+        product.add_batch(model.Batch("b2", "sku1", 5, eta=None))
+        uow.products.add(model.Product("sku2", []))
+
+    assert store.get("sku1").get_batch("b1").available_quantity == 100
+    assert store.get("sku1").version_number == 0
+    assert store.sku_for("b2") is None
+    assert store.get("sku2") is None
+
+
+def test_units_of_work_get_their_own_copy_of_a_product():
+    store = InMemoryStore([model.Product("sku1", [
+        model.Batch("b1", "sku1", 100, eta=None),
+    ])])
+    first = unit_of_work.InMemoryUnitOfWork(store)
+    second = unit_of_work.InMemoryUnitOfWork(store)
+    with first:
+        first.products.get("sku1").allocate(model.Orderline("o1", "sku1", 10))
+        first.commit()
+    with second:
+        product = second.products.get("sku1")
+        product.allocate(model.Orderline("o2", "sku1", 10))
+
+        assert [e.orderid for e in first.collect_new_events()] == ["o1"]
+        assert [e.orderid for e in second.collect_new_events()] == ["o2"]
+        assert store.get("sku1") is not product
+        assert store.get("sku1").get_batch("b1").available_quantity == 90
+
+
+def test_a_checked_out_product_is_locked_until_commit():
+    store = InMemoryStore([model.Product("sku1", [])])
+    holder = unit_of_work.InMemoryUnitOfWork(store)
+    waiter = unit_of_work.InMemoryUnitOfWork(store, lock_timeout=0.01)
+    with holder:
+        holder.products.get("sku1")
+        with waiter, pytest.raises(LockTimeout):
+            waiter.products.get("sku1")
+        holder.commit()
+        with waiter:
+            assert waiter.products.get("sku1") is not None
+
+
+def test_a_missing_sku_stays_locked_until_commit():
+    store = InMemoryStore()
+    holder = unit_of_work.InMemoryUnitOfWork(store)
+    waiter = unit_of_work.InMemoryUnitOfWork(store, lock_timeout=0.01)
+    with holder:
+        assert holder.products.get("sku1") is None
+        with waiter, pytest.raises(LockTimeout):
+            waiter.products.get("sku1")
+        holder.products.add(model.Product("sku1", []))
+        holder.commit()
+    with waiter:
+        assert waiter.products.get("sku1") is not None
+
+
+def test_concurrent_batches_for_a_new_sku_create_it_once(bus):
+    store = InMemoryStore()
+    start_line = threading.Barrier(8)
+    failures = []
+
+    def add_batch(n):
+        start_line.wait()
+        try:
+            bus.handle(commands.CreateBatch(f"b{n}", "sku1", 10, None),
+                       unit_of_work.InMemoryUnitOfWork(store))
+        except Exception as e:  # pylint: disable=broad-except
+            failures.append(e)
+
+    threads = [threading.Thread(target=add_batch, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    assert len(store.get("sku1").batches) == 8
+
+
+def test_concurrent_allocations_never_overallocate(bus):
+    store = InMemoryStore()
+    bus.handle(commands.CreateBatch("b1", "sku1", 100, None),
+               unit_of_work.InMemoryUnitOfWork(store))
+
+    def allocate(n):
+        uow = unit_of_work.InMemoryUnitOfWork(store)
+        for i in range(30):
+            bus.handle(commands.Allocate(f"o{n}-{i}", "sku1", 1), uow)
+
+    threads = [threading.Thread(target=allocate, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    product = store.get("sku1")
+    assert product.get_batch("b1").available_quantity == 0
+    assert product.version_number == 101
+
+
+def test_snapshots_can_be_saved_and_loaded(tmp_path, bus):
+    store = InMemoryStore()
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    bus.handle(commands.CreateBatch("b1", "sku1", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "sku1", 10), uow)
+    writer = SnapshotWriter(store, str(tmp_path / "products.pickle"), interval=60)
+    writer.start()
+    writer.stop(timeout=5)
+
+    loaded = InMemoryStore.load(str(tmp_path / "products.pickle"))
+    uow = unit_of_work.InMemoryUnitOfWork(loaded)
+    with uow:
+        product = uow.products.get_by_batchref("b1")
+        assert product.get_batch("b1").available_quantity == 90
+        assert product.get_allocation("o1")[0].ref == "b1"
@@ -0,0 +1,189 @@
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import List
+
+import pytest
+
+from allocation.domain import commands, events
+from allocation.service_layer import background, messagebus, retries, unit_of_work
+
+
+class FakeProduct:
+
+    def __init__(self, pending):
+        self.events = deque(pending)
+
+
+class FakeRepository:
+
+    def __init__(self):
+        self.seen = set()
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+
+    def __init__(self):
+        self.products = FakeRepository()
+
+    def _commit(self): ...
+
+    def rollback(self): ...
+
+
+@dataclass
+class UrgentOutOfStock(events.OutOfStock):
+    pass
+
+
+@dataclass
+class Ping(commands.Command):
+    times: int
+
+
+def test_event_subclasses_get_their_parents_handlers():
+    seen = []  # type: List[events.Event]
+    bus = messagebus.MessageBus(
+        event_handlers={
+            events.OutOfStock: [lambda e, uow: seen.append(("base", e))],
+            UrgentOutOfStock: [lambda e, uow: seen.append(("urgent", e))],
+        },
+        command_handlers={},
+    )
+    event = UrgentOutOfStock("sku1")
+    bus.handle(event, FakeUnitOfWork())
+    assert seen == [("urgent", event), ("base", event)]
+
+
+def test_buses_in_one_process_use_their_own_handlers():
+    bus1 = messagebus.MessageBus({}, {Ping: lambda cmd, uow: "bus1"})
+    bus2 = messagebus.MessageBus({}, {Ping: lambda cmd, uow: "bus2"})
+    assert bus1.handle(Ping(1), FakeUnitOfWork()) == ["bus1"]
+    assert bus2.handle(Ping(1), FakeUnitOfWork()) == ["bus2"]
+
+
+def test_handles_messages_raised_by_handlers_in_order():
+    uow = FakeUnitOfWork()
+    handled = []  # type: List[int]
+
+    def ping(cmd, uow):
+        handled.append(cmd.times)
+        if cmd.times:
+            uow.products.seen = {FakeProduct([Ping(cmd.times - 1)])}
+
+    bus = messagebus.MessageBus({}, {Ping: ping})
+    bus.handle(Ping(5000), uow)
+    assert handled == list(range(5000, -1, -1))
+
+
+def test_errors_for_commands_without_a_handler():
+    bus = messagebus.MessageBus({}, {})
+    with pytest.raises(Exception, match="No handler"):
+        bus.handle(Ping(1), FakeUnitOfWork())
+
+
+def test_fire_and_forget_handlers_run_on_the_background_pool():
+    release = threading.Event()
+    handled = []  # type: List[str]
+
+    @background.fire_and_forget
+    def slow_notification(event, uow):
+        release.wait(5)
+        handled.append(threading.current_thread().name)
+
+    pool = background.BackgroundWorkerPool(workers=1)
+    bus = messagebus.MessageBus(
+        {events.OutOfStock: [slow_notification]}, {}, background_pool=pool,
+    )
+    bus.handle(events.OutOfStock("sku1"), FakeUnitOfWork())
+    assert handled == []
+    release.set()
+    pool.shutdown(timeout=5)
+    assert handled == ["background-0"]
+
+
+class Flaky:
+
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, event, uow):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("flaky")
+
+
+def test_failed_handlers_are_deferred_to_the_retry_scheduler():
+    flaky = retries.retry_policy(attempts=3, backoff=60)(Flaky(failures=1))
+    scheduler = retries.RetryScheduler(uow_factory=FakeUnitOfWork)
+    bus = messagebus.MessageBus(
+        {events.OutOfStock: [flaky]}, {}, retry_scheduler=scheduler,
+    )
+    bus.handle(events.OutOfStock("sku1"), FakeUnitOfWork())
+    assert flaky.calls == 1
+    assert len(scheduler) == 1
+
+    scheduler.clock = lambda: float("inf")
+    scheduler.run_due()
+    assert flaky.calls == 2
+    assert bus.dead_letters.list() == []
+
+
+def test_handlers_that_give_up_are_dead_lettered_and_can_be_replayed():
+    flaky = retries.retry_policy(attempts=2, backoff=60)(Flaky(failures=2))
+    scheduler = retries.RetryScheduler(uow_factory=FakeUnitOfWork)
+    bus = messagebus.MessageBus(
+        {events.OutOfStock: [flaky]}, {}, retry_scheduler=scheduler,
+    )
+    event = events.OutOfStock("sku1")
+    bus.handle(event, FakeUnitOfWork())
+    scheduler.clock = lambda: float("inf")
+    scheduler.run_due()
+
+    [letter] = bus.dead_letters.list()
+    assert letter.event == event
+    assert letter.attempts == 2
+    assert "flaky" in letter.error
+
+    assert bus.replay_dead_letters(FakeUnitOfWork()) == 1
+    assert flaky.calls == 3
+    assert bus.dead_letters.list() == []
+
+
+def test_without_a_retry_scheduler_failed_handlers_are_dead_lettered_at_once():
+    flaky = retries.retry_policy(attempts=5)(Flaky(failures=1))
+    bus = messagebus.MessageBus({events.OutOfStock: [flaky]}, {})
+    bus.handle(events.OutOfStock("sku1"), FakeUnitOfWork())
+
+    assert flaky.calls == 1
+    [letter] = bus.dead_letters.list()
+    assert letter.attempts == 1
+
+
+def test_errors_outside_the_policy_are_not_retried():
+    flaky = retries.retry_policy(retry_on=(ConnectionError,))(
+        Flaky(failures=1, error=ValueError)
+    )
+    bus = messagebus.MessageBus({events.OutOfStock: [flaky]}, {})
+    bus.handle(events.OutOfStock("sku1"), FakeUnitOfWork())
+    assert flaky.calls == 1
+    assert len(bus.dead_letters.list()) == 1
+
+
+def test_commands_are_retried_inline_when_their_handler_asks_to_be():
+    flaky = retries.retry_policy(
+        backoff=0, retry_on=(unit_of_work.ConcurrencyConflict,),
+    )(Flaky(failures=2, error=unit_of_work.ConcurrencyConflict))
+    bus = messagebus.MessageBus({}, {Ping: flaky})
+    bus.handle(Ping(1), FakeUnitOfWork())
+    assert flaky.calls == 3
+
+
+def test_commands_are_not_retried_by_default():
+    flaky = Flaky(failures=1)
+    bus = messagebus.MessageBus({}, {Ping: flaky})
+    with pytest.raises(ConnectionError):
+        bus.handle(Ping(1), FakeUnitOfWork())
+    assert flaky.calls == 1
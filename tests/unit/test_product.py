@@ -1,7 +1,8 @@
+import random
 from datetime import date, timedelta
 import pytest
 
-from allocation.domain import model, events
+from allocation.domain import commands, model, events
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -57,3 +58,229 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_every_change_to_the_batches_increments_version_number():
+    sku = "sku-01"
+    product = model.Product(sku=sku, batches=[], version_number=7)
+    product.add_batch(model.Batch("b1", sku, 100, eta=None))
+    assert product.version_number == 8
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 9
+
+
+def test_prefers_warehouse_batches_to_shipments():
+    sku = "SKU-0101"
+    shipment = model.Batch("shipment batch", sku, 50, eta=tomorrow)
+    in_stock = model.Batch("in-stock batch", sku, 50, eta=None)
+
+    product = model.Product(sku, [shipment, in_stock])
+    product.allocate(model.Orderline("order 01", sku, 20))
+
+    assert in_stock.available_quantity == 30
+    assert shipment.available_quantity == 50
+
+
+def test_allocates_to_batches_added_later():
+    sku = "SKU-0101"
+    product = model.Product(sku, [model.Batch("b1", sku, 10, eta=tomorrow)])
+    product.allocate(model.Orderline("order 01", sku, 10))
+
+    product.add_batch(model.Batch("b2", sku, 10, eta=later))
+    assert product.allocate(model.Orderline("order 02", sku, 10)) == "b2"
+
+
+def test_allocates_again_to_a_batch_whose_quantity_went_up():
+    sku = "SKU-0101"
+    early = model.Batch("early", sku, 10, eta=today)
+    late = model.Batch("late", sku, 10, eta=later)
+    product = model.Product(sku, [early, late])
+    product.allocate(model.Orderline("order 01", sku, 10))
+
+    product.change_batch_quantity("early", 20)
+    assert product.allocate(model.Orderline("order 02", sku, 5)) == "early"
+
+
+def test_allocation_order_matches_sorting_the_batches():
+    rnd = random.Random(7)
+    sku = "SKU-0101"
+    etas = [None, today, tomorrow, later]
+    batches = [
+        model.Batch(f"b{i}", sku, rnd.randint(0, 30), eta=rnd.choice(etas))
+        for i in range(40)
+    ]
+    product = model.Product(sku, batches)
+    for i in range(300):
+        line = model.Orderline(f"order-{i}", sku, rnd.randint(1, 10))
+        expected = next(
+            (b.ref for b in sorted(batches) if b.can_allocate(line)), None
+        )
+        assert product.allocate(line) == expected
+
+
+def test_allocate_many_allocates_every_line_with_one_version_increment():
+    sku = "SKU-0101"
+    early = model.Batch("early", sku, 10, eta=today)
+    late = model.Batch("late", sku, 10, eta=later)
+    product = model.Product(sku, [early, late], version_number=3)
+
+    batchrefs = product.allocate_many([
+        model.Orderline("order-01", sku, 8),
+        model.Orderline("order-02", sku, 5),
+        model.Orderline("order-03", sku, 20),
+    ])
+
+    assert batchrefs == ["early", "late", None]
+    assert product.version_number == 4
+    assert list(product.events) == [
+        events.Allocated("order-01", sku, 8, "early"),
+        events.Allocated("order-02", sku, 5, "late"),
+        events.OutOfStock(sku),
+    ]
+
+
+def test_looks_up_batches_by_ref():
+    sku = "SKU-0101"
+    batch = model.Batch("b1", sku, 10, eta=today)
+    product = model.Product(sku, [batch])
+    product.add_batch(model.Batch("b2", sku, 10, eta=later))
+
+    assert product.get_batch("b1") is batch
+    assert product.get_batch("b2").eta == later
+    assert product.get_batch("b3") is None
+
+
+def test_looks_up_allocations_by_orderid():
+    sku = "SKU-0101"
+    small = model.Batch("small", sku, 10, eta=today)
+    big = model.Batch("big", sku, 100, eta=later)
+    product = model.Product(sku, [small, big])
+    line1 = model.Orderline("order-01", sku, 10)
+    line2 = model.Orderline("order-02", sku, 5)
+    product.allocate(line1)
+    product.allocate(line2)
+
+    assert product.get_allocation("order-01") == (small, line1)
+    assert product.get_allocation("order-02") == (big, line2)
+
+    product.change_batch_quantity("small", 5)
+    assert product.get_allocation("order-01") is None
+    assert product.get_allocation("order-02") == (big, line2)
+
+
+def test_shrinking_a_batch_reallocates_with_a_single_command():
+    sku = "SKU-0101"
+    batch = model.Batch("b1", sku, 30, eta=today)
+    product = model.Product(sku, [batch])
+    for orderid in ["order-01", "order-02", "order-03"]:
+        product.allocate(model.Orderline(orderid, sku, 10))
+    product.events.clear()
+
+    product.change_batch_quantity("b1", 5)
+
+    assert batch.available_quantity == 5
+    [command] = product.events
+    assert isinstance(command, commands.AllocateMany)
+    assert sorted(line.orderid for line in command.lines) == [
+        "order-01", "order-02", "order-03",
+    ]
+
+
+def test_fewest_lines_frees_the_biggest_lines_first():
+    lines = {
+        model.Orderline("order-01", "sku", 2),
+        model.Orderline("order-02", "sku", 9),
+        model.Orderline("order-03", "sku", 4),
+    }
+    chosen = model.fewest_lines(lines, 10)
+    assert [line.orderid for line in chosen] == ["order-02", "order-03"]
+
+
+def test_smallest_overshoot_frees_as_little_as_possible():
+    lines = {
+        model.Orderline("order-01", "sku", 3),
+        model.Orderline("order-02", "sku", 50),
+        model.Orderline("order-03", "sku", 4),
+    }
+    chosen = model.smallest_overshoot(lines, 4)
+    assert [line.orderid for line in chosen] == ["order-03"]
+
+    chosen = model.smallest_overshoot(lines, 6)
+    assert sorted(line.orderid for line in chosen) == ["order-01", "order-03"]
+
+
+def test_change_batch_quantity_uses_the_given_policy():
+    sku = "SKU-0101"
+    batch = model.Batch("b1", sku, 60, eta=today)
+    product = model.Product(sku, [batch])
+    product.allocate(model.Orderline("small", sku, 5))
+    product.allocate(model.Orderline("big", sku, 50))
+
+    product.change_batch_quantity("b1", 54, policy=model.smallest_overshoot)
+    assert batch.available_quantity == 4
+    assert product.get_allocation("small") is None
+
+    product.change_batch_quantity("b1", 30, policy=model.fewest_lines)
+    assert batch.available_quantity == 30
+    assert product.get_allocation("big") is None
+
+
+def random_product(rnd, engine, count):
+    sku = "SKU-0101"
+    etas = [None, today, tomorrow, later]
+    batches = [
+        model.Batch(f"b{i}", sku, rnd.randint(0, 30), eta=rnd.choice(etas))
+        for i in range(count)
+    ]
+    return model.Product(sku, batches, allocation_engine=engine)
+
+
+@pytest.mark.parametrize("count", [0, 60])
+def test_numpy_engine_makes_the_same_choices_as_the_python_engine(count):
+    pytest.importorskip("numpy")
+    python_rnd, numpy_rnd = random.Random(11), random.Random(11)
+    python_product = random_product(python_rnd, "python", count)
+    numpy_product = random_product(numpy_rnd, "numpy", count)
+    ops = random.Random(3)
+    for i in range(500):
+        op = ops.choice(
+            ["allocate", "allocate_many", "add"] + (["change"] if count else [])
+        )
+        if op == "allocate":
+            line = model.Orderline(f"order-{i}", "SKU-0101", ops.randint(1, 12))
+            assert python_product.allocate(line) == numpy_product.allocate(line)
+        elif op == "allocate_many":
+            lines = [
+                model.Orderline(f"order-{i}-{j}", "SKU-0101", ops.randint(1, 12))
+                for j in range(ops.randint(1, 10))
+            ]
+            assert (python_product.allocate_many(lines)
+                    == numpy_product.allocate_many(lines))
+        elif op == "change":
+            ref, qty = f"b{ops.randrange(count)}", ops.randint(0, 40)
+            python_product.change_batch_quantity(ref, qty)
+            numpy_product.change_batch_quantity(ref, qty)
+        else:
+            eta = ops.choice([None, today, later])
+            python_product.add_batch(model.Batch(f"new-{i}", "SKU-0101", 20, eta))
+            numpy_product.add_batch(model.Batch(f"new-{i}", "SKU-0101", 20, eta))
+    assert python_product.events == numpy_product.events
+    assert ([b.available_quantity for b in python_product.batches]
+            == [b.available_quantity for b in numpy_product.batches])
+
+
+def test_picks_the_numpy_engine_for_products_with_many_batches():
+    pytest.importorskip("numpy")
+    from allocation.domain.numpy_engine import NumpyBatchQueue
+    few = [model.Batch(f"b{i}", "sku", 10) for i in range(3)]
+    many = [model.Batch(f"b{i}", "sku", 10)
+            for i in range(model.NUMPY_ENGINE_THRESHOLD)]
+    assert isinstance(model.allocation_queue(few), model.BatchQueue)
+    assert isinstance(model.allocation_queue(many), NumpyBatchQueue)
+    assert isinstance(model.allocation_queue(many, "python"), model.BatchQueue)
+
+
+def test_looks_up_deallocation_policies_by_name():
+    assert model.deallocation_policy("smallest_overshoot") is model.smallest_overshoot
+    with pytest.raises(ValueError, match="Unknown deallocation policy"):
+        model.deallocation_policy("newest_lines")
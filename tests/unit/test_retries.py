@@ -0,0 +1,65 @@
+import threading
+
+from allocation.service_layer import retries
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_policy_backs_off_exponentially_up_to_a_cap():
+    policy = retries.RetryPolicy(backoff=1, multiplier=2, max_backoff=5)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+
+
+def test_jitter_takes_up_to_its_fraction_off_each_delay():
+    policy = retries.RetryPolicy(backoff=1, multiplier=1, jitter=0.5)
+    delays = [policy.delay(1) for _ in range(200)]
+    assert all(0.5 <= delay <= 1 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_policy_only_retries_listed_errors_until_out_of_attempts():
+    policy = retries.RetryPolicy(attempts=3, retry_on=(ConnectionError,))
+    assert policy.should_retry(ConnectionError(), attempt=2)
+    assert not policy.should_retry(ConnectionError(), attempt=3)
+    assert not policy.should_retry(ValueError(), attempt=1)
+
+
+def test_retry_policy_decorator_attaches_policy_to_handler():
+    @retries.retry_policy(attempts=7)
+    def handler(event, uow): ...
+
+    def undecorated(event, uow): ...
+
+    assert retries.policy_for(handler).attempts == 7
+    assert retries.policy_for(undecorated) is retries.DEFAULT_RETRY_POLICY
+
+
+def test_scheduler_runs_retries_once_they_are_due_in_order():
+    clock, ran = FakeClock(), []
+    scheduler = retries.RetryScheduler(uow_factory=object, clock=clock)
+    scheduler.schedule(2, lambda uow: ran.append("later"))
+    scheduler.schedule(1, lambda uow: ran.append("sooner"))
+
+    assert scheduler.run_due() == 0
+    clock.now = 1.5
+    assert scheduler.run_due() == 1
+    clock.now = 5
+    scheduler.run_due()
+    assert ran == ["sooner", "later"]
+    assert len(scheduler) == 0
+
+
+def test_scheduler_thread_runs_due_retries():
+    scheduler = retries.RetryScheduler(uow_factory=object)
+    done = threading.Event()
+    scheduler.start()
+    scheduler.schedule(0.01, lambda uow: done.set())
+    assert done.wait(1)
+    scheduler.stop(timeout=1)